@@ -228,6 +228,11 @@ public class ICONSConnection extends Thread implements MqttCallback {
      */
     @Override
     public void messageArrived(String topic, MqttMessage message) throws Exception {
+        //A zero length message clears the state retained for a device that has gone offline.
+        if (message.getPayload().length == 0) {
+            return;
+        }
+
         try {
 
             String rxData = new String(message.getPayload());
@@ -236,6 +241,12 @@ public class ICONSConnection extends Thread implements MqttCallback {
             String location = JSONProcessor.GetLocation(json);
             String ipAddress = JSONProcessor.GetIPAddress(json);
 
+            //The icons_gw publishes this when a device stops responding. The device
+            //is not updated so it is removed when its data times out.
+            if (JSONProcessor.IsOffline(json)) {
+                return;
+            }
+
             if (location != null && ipAddress != null) {
                 processDevice(location, ipAddress, json);
 
@@ -27,6 +27,7 @@ public class JSONProcessor {
     public static final String SERVER_SERVICE_LIST= "SERVER_SERVICE_LIST";
     public static final String LOCAL_RX_TIME_MS   = "LOCAL_RX_TIME_MS";
     public static final String SESSION_ID 		  = "SESSION_ID";
+    public static final String OFFLINE            = "OFFLINE";
     public static final String SERVICE_LIST       = "SERVICE_LIST";
     
     /**
@@ -121,6 +122,15 @@ public class JSONProcessor {
 		return JSONProcessor.GetValue(JSONProcessor.IP_ADDRESS, json);
 	}
 	
+	/**
+	 * @brief Determine if the JSON message reports that a device is offline.
+	 * @param json The json message.
+	 * return True if the device is offline.
+	 */
+	public static boolean IsOffline(JSONObject json) {
+		return json.optBoolean(JSONProcessor.OFFLINE, false);
+	}
+
 	/**
 	 * @brief Check for an IP address match
 	 * @param ipAddress The IP address string.
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import  json
+
+try:
+    import  msgpack
+except ImportError:
+    msgpack = None
+
+class DevStateCodecError(Exception):
+    pass
+
+class DevStateCodec(object):
+    """@brief Responsible for encoding and decoding device state messages.
+              Device state is published as JSON text or, where bandwidth matters,
+              in a compact encoding. A compact message is a format byte followed by
+              a MessagePack map in which the keys that devices and the icons_gw
+              always send are replaced by their index in a key list. A subscriber
+              can tell the two apart from the first byte of the message as a JSON
+              message always starts with a { character."""
+
+    FORMAT_COMPACT_V1   = 1
+
+    # The keys are replaced by their index in this list. Keys may be added to the
+    # end of the list. Any other change requires a new format.
+    KEY_LIST_V1         = ("IP_ADDRESS",
+                           "UNIT_NAME",
+                           "PRODUCT_ID",
+                           "GROUP_NAME",
+                           "SERVICE_LIST",
+                           "SERVER_SERVICE_LIST",
+                           "LOCATION",
+                           "OS",
+                           "INTERFACE",
+                           "OFFLINE",
+                           "AYT_MSG")
+    KEY_CODE_DICT_V1    = dict( [(key, code) for code, key in enumerate(KEY_LIST_V1)] )
+
+    @staticmethod
+    def IsCompactAvailable():
+        """@return True if the python module required for the compact encoding is installed."""
+        return msgpack is not None
+
+    @staticmethod
+    def CheckCompactAvailable():
+        """@brief Raise a DevStateCodecError if the compact encoding cannot be used."""
+        if msgpack is None:
+            raise DevStateCodecError("The msgpack python module is required for the compact encoding (pip install msgpack).")
+
+    @staticmethod
+    def EncodeJSON(devDict):
+        """@brief Encode a device state message as JSON text.
+           @param devDict The device dict.
+           @return The JSON text."""
+        return json.dumps(devDict)
+
+    @staticmethod
+    def EncodeCompact(devDict):
+        """@brief Encode a device state message in the compact encoding.
+           @param devDict The device dict.
+           @return The message bytes."""
+        DevStateCodec.CheckCompactAvailable()
+        keyCodeDict = DevStateCodec.KEY_CODE_DICT_V1
+        codedDict = dict( [(keyCodeDict.get(key, key), value) for key, value in devDict.items()] )
+        return bytes( (DevStateCodec.FORMAT_COMPACT_V1,) ) + msgpack.packb(codedDict, use_bin_type=True)
+
+    @staticmethod
+    def IsCompact(payload):
+        """@brief Determine if a message is in the compact encoding.
+           @param payload The message bytes.
+           @return True if the message is in the compact encoding."""
+        return len(payload) > 0 and payload[0] == DevStateCodec.FORMAT_COMPACT_V1
+
+    @staticmethod
+    def Decode(payload):
+        """@brief Decode a device state message in either encoding.
+           @param payload The message bytes.
+           @return The device dict or None if the message is empty (E.G a
+                   retained message being cleared)."""
+        if len(payload) == 0:
+            return None
+
+        if DevStateCodec.IsCompact(payload):
+            DevStateCodec.CheckCompactAvailable()
+            try:
+                codedDict = msgpack.unpackb(payload[1:], raw=False, strict_map_key=False)
+
+            except (ValueError, TypeError) as ex:
+                raise DevStateCodecError("Invalid compact device state message: %s" % (str(ex)) )
+
+            if not isinstance(codedDict, dict):
+                raise DevStateCodecError("Invalid compact device state message.")
+
+            keyList = DevStateCodec.KEY_LIST_V1
+            return dict( [(keyList[key] if isinstance(key, int) and 0 <= key < len(keyList) else key, value) for key, value in codedDict.items()] )
+
+        return json.loads( payload.decode() )
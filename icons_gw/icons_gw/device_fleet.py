@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+
+import  socket
+import  struct
+import  json
+import  random
+import  heapq
+import  asyncio
+import  threading
+import  multiprocessing
+from    queue import Queue, Empty
+from    time import time
+
+from    p3lib.uio import UIO as UO
+from    p3lib.mqtt_rpc import MQTTRPCProviderClient
+
+class QuietUIO(UO):
+    """@brief A UIO that discards info messages so that the cost of displaying
+              every message is not included in a measurement."""
+
+    def info(self, text, highlight=False):
+        pass
+
+class MQTTBrokerStandIn(threading.Thread):
+    """@brief A minimal MQTT 3.1.1 broker that stands in for the ICONS MQTT server.
+              It supports connect, subscribe (including + and # wildcards), unsubscribe,
+              publish (QOS 0, 1 and 2, messages are forwarded at QOS 0), retained
+              messages and ping. Authentication and persistent sessions are not supported."""
+
+    CONNECT         = 1
+    CONNACK         = 2
+    PUBLISH         = 3
+    PUBACK          = 4
+    PUBREC          = 5
+    PUBREL          = 6
+    PUBCOMP         = 7
+    SUBSCRIBE       = 8
+    SUBACK          = 9
+    UNSUBSCRIBE     = 10
+    UNSUBACK        = 11
+    PINGREQ         = 12
+    PINGRESP        = 13
+    DISCONNECT      = 14
+
+    @staticmethod
+    def EncodeLength(length):
+        """@brief Encode an MQTT remaining length field.
+           @param length The length to encode.
+           @return The encoded bytes."""
+        encoded = bytearray()
+        while True:
+            byte = length % 128
+            length = length // 128
+            if length > 0:
+                byte = byte | 0x80
+            encoded.append(byte)
+            if length == 0:
+                return bytes(encoded)
+
+    @staticmethod
+    def GetPacket(packetType, flags, body):
+        """@brief Get an MQTT packet.
+           @param packetType The MQTT control packet type.
+           @param flags The fixed header flags.
+           @param body The variable header and payload bytes.
+           @return The packet bytes."""
+        return bytes( ( (packetType << 4) | flags, ) ) + MQTTBrokerStandIn.EncodeLength( len(body) ) + body
+
+    @staticmethod
+    def IsTopicMatch(topicFilter, topic):
+        """@brief Determine if a topic matches a subscription topic filter.
+           @param topicFilter The subscription topic filter.
+           @param topic The topic a message was published on.
+           @return True if the topic matches the filter."""
+        filterLevelList = topicFilter.split('/')
+        topicLevelList = topic.split('/')
+        for index, filterLevel in enumerate(filterLevelList):
+            if filterLevel == '#':
+                return True
+            if index >= len(topicLevelList):
+                return False
+            if filterLevel != '+' and filterLevel != topicLevelList[index]:
+                return False
+        return len(filterLevelList) == len(topicLevelList)
+
+    def __init__(self, host="127.0.0.1", port=0, publishCallback=None):
+        """@brief Constructor
+           @param host The address to listen on.
+           @param port The TCP port to listen on. If 0 a free port is used.
+           @param publishCallback If not None this is called with the topic, payload
+                  and retain flag of every message published. It is called on the
+                  broker thread."""
+        threading.Thread.__init__(self, daemon=True)
+        self._host = host
+        self._port = port
+        self._publishCallback = publishCallback
+        self._subscriptionDict = {}
+        self._retainedDict = {}
+        self._loop = None
+        self._server = None
+        self._stopEvent = None
+        self._clientTaskSet = set()
+        self._readyEvent = threading.Event()
+        self.publishCount = 0
+        self.connectCount = 0
+
+    @property
+    def port(self):
+        """@return The TCP port the broker is listening on."""
+        return self._port
+
+    def run(self):
+        asyncio.run( self._serve() )
+
+    def start(self):
+        """@brief Start the broker and wait for it to listen for connections."""
+        threading.Thread.start(self)
+        self._readyEvent.wait()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopEvent = asyncio.Event()
+        self._server = await asyncio.start_server(self._handleClient, self._host, self._port)
+        self._port = self._server.sockets[0].getsockname()[1]
+        self._readyEvent.set()
+
+        await self._stopEvent.wait()
+
+        self._server.close()
+        self._closeClients()
+        await asyncio.gather(*self._clientTaskSet, return_exceptions=True)
+
+    def shutDown(self):
+        """@brief Stop the broker. All client connections are closed."""
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._stopEvent.set)
+        self.join()
+
+    def disconnectAll(self):
+        """@brief Close all client connections (E.G to simulate a network failure)."""
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._closeClients)
+
+    def _closeClients(self):
+        for writer in list(self._subscriptionDict):
+            writer.close()
+
+    async def _readPacket(self, reader):
+        """@brief Read an MQTT packet.
+           @param reader The client StreamReader.
+           @return A tuple containing the packet type, fixed header flags and body bytes."""
+        header = (await reader.readexactly(1))[0]
+        multiplier = 1
+        length = 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length = length + (byte & 0x7f)*multiplier
+            multiplier = multiplier*128
+            if not byte & 0x80:
+                break
+        body = await reader.readexactly(length)
+        return (header >> 4, header & 0x0f, body)
+
+    async def _handleClient(self, reader, writer):
+        """@brief Handle an MQTT client connection.
+           @param reader The client StreamReader.
+           @param writer The client StreamWriter."""
+        self._subscriptionDict[writer] = set()
+        self._clientTaskSet.add( asyncio.current_task() )
+        try:
+            while True:
+                packetType, flags, body = await self._readPacket(reader)
+
+                if packetType == MQTTBrokerStandIn.CONNECT:
+                    self.connectCount = self.connectCount + 1
+                    writer.write( MQTTBrokerStandIn.GetPacket(MQTTBrokerStandIn.CONNACK, 0, b"\x00\x00") )
+
+                elif packetType == MQTTBrokerStandIn.PUBLISH:
+                    self._handlePublish(writer, flags, body)
+
+                elif packetType == MQTTBrokerStandIn.PUBREL:
+                    writer.write( MQTTBrokerStandIn.GetPacket(MQTTBrokerStandIn.PUBCOMP, 0, body[:2]) )
+
+                elif packetType == MQTTBrokerStandIn.SUBSCRIBE:
+                    self._handleSubscribe(writer, body)
+
+                elif packetType == MQTTBrokerStandIn.UNSUBSCRIBE:
+                    for topicFilter in self._getTopicList(body[2:], False):
+                        self._subscriptionDict[writer].discard(topicFilter)
+                    writer.write( MQTTBrokerStandIn.GetPacket(MQTTBrokerStandIn.UNSUBACK, 0, body[:2]) )
+
+                elif packetType == MQTTBrokerStandIn.PINGREQ:
+                    writer.write( MQTTBrokerStandIn.GetPacket(MQTTBrokerStandIn.PINGRESP, 0, b"") )
+
+                elif packetType == MQTTBrokerStandIn.DISCONNECT:
+                    break
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+        finally:
+            self._subscriptionDict.pop(writer, None)
+            self._clientTaskSet.discard( asyncio.current_task() )
+            writer.close()
+
+    def _getTopicList(self, data, hasQOS):
+        """@brief Get the topic filters from a subscribe or unsubscribe packet payload.
+           @param data The payload bytes.
+           @param hasQOS True if each topic filter is followed by a requested QOS byte.
+           @return A list of topic filter strings."""
+        topicList = []
+        offset = 0
+        while offset < len(data):
+            length = struct.unpack(">H", data[offset:offset+2])[0]
+            topicList.append( data[offset+2:offset+2+length].decode() )
+            offset = offset + 2 + length
+            if hasQOS:
+                offset = offset + 1
+        return topicList
+
+    def _handleSubscribe(self, writer, body):
+        """@brief Handle a subscribe packet. Retained messages that match are sent to the client."""
+        topicList = self._getTopicList(body[2:], True)
+        writer.write( MQTTBrokerStandIn.GetPacket(MQTTBrokerStandIn.SUBACK, 0, body[:2] + bytes( len(topicList) ) ) )
+        for topicFilter in topicList:
+            self._subscriptionDict[writer].add(topicFilter)
+            for topic, payload in self._retainedDict.items():
+                if MQTTBrokerStandIn.IsTopicMatch(topicFilter, topic):
+                    writer.write( self._getPublishPacket(topic, payload, True) )
+
+    def _getPublishPacket(self, topic, payload, retain):
+        topicBytes = topic.encode()
+        body = struct.pack(">H", len(topicBytes)) + topicBytes + payload
+        return MQTTBrokerStandIn.GetPacket(MQTTBrokerStandIn.PUBLISH, 1 if retain else 0, body)
+
+    def _handlePublish(self, writer, flags, body):
+        """@brief Handle a publish packet. The message is forwarded to all subscribers."""
+        qos = (flags >> 1) & 0x03
+        retain = bool(flags & 0x01)
+        topicLength = struct.unpack(">H", body[:2])[0]
+        topic = body[2:2+topicLength].decode()
+        offset = 2 + topicLength
+        if qos > 0:
+            packetID = body[offset:offset+2]
+            offset = offset + 2
+            if qos == 1:
+                writer.write( MQTTBrokerStandIn.GetPacket(MQTTBrokerStandIn.PUBACK, 0, packetID) )
+            else:
+                writer.write( MQTTBrokerStandIn.GetPacket(MQTTBrokerStandIn.PUBREC, 0, packetID) )
+        payload = body[offset:]
+
+        self.publishCount = self.publishCount + 1
+        if self._publishCallback:
+            self._publishCallback(topic, payload, retain)
+
+        if retain:
+            if len(payload) > 0:
+                self._retainedDict[topic] = payload
+            else:
+                self._retainedDict.pop(topic, None)
+
+        packet = None
+        for subscriber, topicFilterSet in self._subscriptionDict.items():
+            for topicFilter in topicFilterSet:
+                if MQTTBrokerStandIn.IsTopicMatch(topicFilter, topic):
+                    if packet is None:
+                        packet = self._getPublishPacket(topic, payload, False)
+                    subscriber.write(packet)
+                    break
+
+class PortRPCProvider(object):
+    """@brief Stands in for the ICONS RPC provider methods by handing out ports from a counter.
+              Leases never expire."""
+
+    FIRST_PORT = 10000
+    MAX_PORT_LIST_SIZE = 256
+    LEASE_TTL = 300
+
+    def __init__(self):
+        self._nextPort = PortRPCProvider.FIRST_PORT
+
+    def getFreeTCPPort(self):
+        port = self._nextPort
+        self._nextPort = self._nextPort + 1
+        return port
+
+    def getFreeTCPPortList(self, args):
+        count = min( int(args[0]), PortRPCProvider.MAX_PORT_LIST_SIZE)
+        return [self.getFreeTCPPort() for _ in range(0, count)]
+
+    def leaseTCPPortList(self, args):
+        return {"PORTS": self.getFreeTCPPortList(args), "TTL": PortRPCProvider.LEASE_TTL}
+
+    def renewTCPPortList(self, args):
+        return args[1]
+
+    def releaseTCPPortList(self, args):
+        return len(args[1])
+
+class RPCProviderOptions(object):
+    """@brief The options required by an MQTTRPCProviderClient."""
+
+    def __init__(self, server, port, sid=1, cid=1, keepalive=60):
+        self.server     = server
+        self.port       = port
+        self.sid        = sid
+        self.cid        = cid
+        self.keepalive  = keepalive
+
+class SimulatedDeviceFleet(threading.Thread):
+    """@brief Impersonates a number of ydev devices. Each AYT message received is
+              answered with a message from every device, as AYTListener._listener()
+              does, after a random delay of up to jitterSeconds."""
+
+    UDP_DEV_DISCOVERY_PORT  = 2934
+    UDP_RX_BUFFER_SIZE      = 2048
+    RX_POLL_SECONDS         = 0.2
+    AYT_KEY                 = "AYT"
+    DEFAULT_AYT_MSG         = "-!#8[dkG^v's!dRznE}6}8sP9}QoIR#?O&pg)Qra"
+    DEFAULT_SERVICE_LIST    = "WEB:80,SSH:22"
+    PRODUCT_ID              = "SIM"
+    OS                      = "Linux"
+
+    @staticmethod
+    def GetIPAddress(index):
+        """@brief Get the unique IP address of a simulated device.
+           @param index The device index.
+           @return The IP address string."""
+        return "10.%d.%d.%d" % ( (index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff)
+
+    @staticmethod
+    def GetUnitName(index):
+        """@param index The device index.
+           @return The unit name of a simulated device."""
+        return "SIM%d" % (index)
+
+    @staticmethod
+    def GetDevDict(index, serviceList, aytMsg):
+        """@brief Get the dict that a ydev instance would send in response to an AYT message.
+           @param index The device index.
+           @param serviceList The service list string (E.G WEB:80,SSH:22).
+           @param aytMsg The AYT message string.
+           @return The device dict."""
+        return {"UNIT_NAME":    SimulatedDeviceFleet.GetUnitName(index),
+                "PRODUCT_ID":   SimulatedDeviceFleet.PRODUCT_ID,
+                "SERVICE_LIST": serviceList,
+                "GROUP_NAME":   "",
+                "AYT_MSG":      aytMsg,
+                "IP_ADDRESS":   SimulatedDeviceFleet.GetIPAddress(index),
+                "OS":           SimulatedDeviceFleet.OS}
+
+    def __init__(self, uo, deviceCount, serviceList=DEFAULT_SERVICE_LIST, jitterSeconds=0, aytMsg=DEFAULT_AYT_MSG, bindAddress=''):
+        """@brief Constructor
+           @param uo A UIO instance.
+           @param deviceCount The number of devices to impersonate.
+           @param serviceList The service list of every device.
+           @param jitterSeconds The maximum delay before a device responds to an AYT message.
+           @param aytMsg The AYT message string that devices respond to.
+           @param bindAddress The address to bind the device discovery port to."""
+        threading.Thread.__init__(self, daemon=True)
+        self._uo = uo
+        self._deviceCount = deviceCount
+        self._jitterSeconds = jitterSeconds
+        self._aytMsg = aytMsg
+        self._responseList = []
+        for index in range(0, deviceCount):
+            devDict = SimulatedDeviceFleet.GetDevDict(index, serviceList, aytMsg)
+            self._responseList.append( json.dumps( devDict, sort_keys=True, indent=4, separators=(',', ': ')).encode() )
+        self._sendQueue = Queue()
+        self._running = False
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((bindAddress, SimulatedDeviceFleet.UDP_DEV_DISCOVERY_PORT))
+        self._sock.settimeout(SimulatedDeviceFleet.RX_POLL_SECONDS)
+
+        self.aytCount = 0
+        self.responseCount = 0
+        # The time each device first responded, indexed by unit name.
+        self.firstResponseTimeDict = {}
+
+    def run(self):
+        self._running = True
+        senderThread = threading.Thread(target=self._sendResponses, daemon=True)
+        senderThread.start()
+        try:
+            while self._running:
+                try:
+                    rxData, addressPort = self._sock.recvfrom(SimulatedDeviceFleet.UDP_RX_BUFFER_SIZE)
+
+                except socket.timeout:
+                    continue
+
+                try:
+                    rxDict = json.loads(rxData)
+                    if isinstance(rxDict, dict) and rxDict.get(SimulatedDeviceFleet.AYT_KEY, "").strip() == self._aytMsg:
+                        self.aytCount = self.aytCount + 1
+                        now = time()
+                        self._sendQueue.put( [(now+random.uniform(0, self._jitterSeconds), index, addressPort) for index in range(0, self._deviceCount)] )
+
+                except ValueError:
+                    pass
+
+        except OSError:
+            pass
+
+        finally:
+            self._sendQueue.put(None)
+            senderThread.join()
+
+    def _sendResponses(self):
+        """@brief Send the device responses when they are due."""
+        pendingList = []
+        while True:
+            timeout = None
+            if pendingList:
+                timeout = max(pendingList[0][0]-time(), 0)
+            try:
+                responseList = self._sendQueue.get(timeout=timeout)
+                if responseList is None:
+                    break
+                for response in responseList:
+                    heapq.heappush(pendingList, response)
+
+            except Empty:
+                pass
+
+            now = time()
+            while pendingList and pendingList[0][0] <= now:
+                _, index, addressPort = heapq.heappop(pendingList)
+                try:
+                    self._sock.sendto(self._responseList[index], addressPort)
+                    self.responseCount = self.responseCount + 1
+                    unitName = SimulatedDeviceFleet.GetUnitName(index)
+                    if unitName not in self.firstResponseTimeDict:
+                        self.firstResponseTimeDict[unitName] = time()
+
+                except OSError:
+                    # The socket has been closed.
+                    return
+
+    def shutDown(self):
+        """@brief Stop responding to AYT messages."""
+        self._running = False
+        self.join()
+        self._sock.close()
+
+class DeviceFleetProcess(multiprocessing.Process):
+    """@brief Runs a simulated device fleet, an MQTT broker stand in and an ICONS RPC
+              provider stand in in a separate process so that the CPU they use is not
+              attributed to the icons_gw under test."""
+
+    START_TIMEOUT_SECONDS = 10
+
+    def __init__(self, deviceCount, serviceList=SimulatedDeviceFleet.DEFAULT_SERVICE_LIST, jitterSeconds=0, aytMsg=SimulatedDeviceFleet.DEFAULT_AYT_MSG):
+        """@brief Constructor
+           @param deviceCount The number of devices to impersonate.
+           @param serviceList The service list of every device.
+           @param jitterSeconds The maximum delay before a device responds to an AYT message.
+           @param aytMsg The AYT message string that devices respond to."""
+        multiprocessing.Process.__init__(self, daemon=True)
+        self._deviceCount = deviceCount
+        self._serviceList = serviceList
+        self._jitterSeconds = jitterSeconds
+        self._aytMsg = aytMsg
+        self._stopEvent = multiprocessing.Event()
+        self._resultQueue = multiprocessing.Queue()
+        self.brokerPort = None
+
+    def start(self):
+        """@brief Start the process and wait for the MQTT broker to be ready."""
+        multiprocessing.Process.start(self)
+        try:
+            self.brokerPort = self._resultQueue.get(timeout=DeviceFleetProcess.START_TIMEOUT_SECONDS)
+
+        except Empty:
+            self.terminate()
+            raise Exception("The device fleet failed to start.")
+
+    def run(self):
+        uo = QuietUIO()
+        firstPublishTimeDict = {}
+
+        def publishCallback(topic, payload, retain):
+            if topic not in firstPublishTimeDict:
+                firstPublishTimeDict[topic] = time()
+
+        broker = MQTTBrokerStandIn(publishCallback=publishCallback)
+        broker.start()
+
+        rpcProvider = MQTTRPCProviderClient(uo, RPCProviderOptions("127.0.0.1", broker.port), (PortRPCProvider(),) )
+        rpcProvider.connect()
+        rpcProvider._client.loop_start()
+
+        fleet = SimulatedDeviceFleet(uo, self._deviceCount, self._serviceList, self._jitterSeconds, self._aytMsg)
+        fleet.start()
+
+        self._resultQueue.put(broker.port)
+        self._stopEvent.wait()
+
+        fleet.shutDown()
+        rpcProvider._client.disconnect()
+        rpcProvider._client.loop_stop()
+        broker.shutDown()
+
+        self._resultQueue.put({"aytCount":              fleet.aytCount,
+                               "responseCount":         fleet.responseCount,
+                               "publishCount":          broker.publishCount,
+                               "connectCount":          broker.connectCount,
+                               "firstResponseTimeDict": fleet.firstResponseTimeDict,
+                               "firstPublishTimeDict":  firstPublishTimeDict})
+
+    def shutDown(self):
+        """@brief Stop the process.
+           @return A dict containing the aytCount, responseCount, publishCount and
+                   connectCount (the number of MQTT connections made to the broker)
+                   and the time each device first responded (firstResponseTimeDict,
+                   indexed by unit name) and the time the first message was published
+                   on each topic (firstPublishTimeDict, indexed by topic)."""
+        self._stopEvent.set()
+        resultDict = self._resultQueue.get()
+        self.join()
+        return resultDict
@@ -1,27 +1,40 @@
 #!/usr/bin/env python3
 
 import  os
+import  asyncio
 import  socket
 import  sys
 import  traceback
 import  threading
 import  _thread
 import  json
+import  hashlib
+import  random
+import  selectors
+import  errno
+import  struct
+import  ctypes
+from    bisect import bisect_left
+from    http.server import HTTPServer, BaseHTTPRequestHandler
+from    collections import deque, OrderedDict
+from    concurrent.futures import ThreadPoolExecutor
 from    optparse import OptionParser
-from    time import sleep
+from    time import sleep, time
 import  getpass
 import  paho.mqtt.client as mqtt
 from    paramiko import AuthenticationException
 from    texttable import Texttable
 
 from    p3lib.helper import GetFreeTCPPort
-from    p3lib.mqtt_rpc import MQTTRPCCallerClient
+from    p3lib.mqtt_rpc import MQTTRPCClient
 from    p3lib.uio import UIO as UO
 from    p3lib.ssh import SSH, SSHTunnelManager
 from    p3lib.pconfig import ConfigManager
 from    p3lib.boot_manager import BootManager
 from    p3lib.netif import NetIF
 
+from    icons_gw.dev_state_codec import DevStateCodec, DevStateCodecError
+
 LOCALHOST = 'localhost'
 LOCALHOST_IP = '127.0.0.1'
 
@@ -31,6 +44,9 @@ class IconsClientError(Exception):
 class IconsGWError(Exception):
   pass
 
+class IconsRPCError(IconsClientError):
+  pass
+
 class IconsGWConfig(object):
     """@brief Responsible for managing the icons dest client configuration."""
 
@@ -46,6 +62,7 @@ class IconsGWConfig(object):
     DISABLE_SYSLOG_FILE      = "disable_icons_gw_syslog"
     MQTT_SERVER_PORT         = 1883
     DEFAULT_DEV_POLL_PERIOD  = 10
+    DEFAULT_DEV_POLL_MIN_PERIOD = 1
     CONFIG_FILENAME          = "icons_gw.cfg"
     DEFAULT_AYT_MSG          = "-!#8[dkG^v's!dRznE}6}8sP9}QoIR#?O&pg)Qra"
     
@@ -119,22 +136,55 @@ class IconsGWConfig(object):
         return nameList
                  
     def _enterDiscoveryInterface(self):
-        """@brief Allow the user to enter a network interface name to discover YView devices on.
-                  This is optional. If the user enters none then AYT broadcast messages are sent 
+        """@brief Allow the user to enter the network interfaces and/or subnets to discover YView devices on.
+                  This is optional. If the user selects all interfaces then AYT broadcast messages are sent
                   over all network interfaces."""
         self._uio.info("Select the interface/s to find YView devices over.")
         self._uio.info("")
         ifNameList = self._showAvalableNetworkInterfaces()
-        idSelected = ConfigManager.GetDecInt(self._uio, "Enter the ID from the above list", minValue=1, maxValue=len(ifNameList)+1)
-        if idSelected == 1:
-             self._configManager.addAttr(IconsGWConfig.AYT_DISCOVERY_INTERFACE, None)
-        else:
-            selectedIndex = idSelected-2
-            if selectedIndex < len(ifNameList):
-                self._configManager.addAttr(IconsGWConfig.AYT_DISCOVERY_INTERFACE, ifNameList[selectedIndex])
+        self._uio.info("")
+        self._uio.info("Enter one or more IDs from the above list and/or subnets (E.G 192.168.2.0/24) separated by commas.")
+        while True:
+            itemList = []
+            try:
+                response = ConfigManager.GetString(self._uio, "Interface/s", self._configManager.getAttr(IconsGWConfig.AYT_DISCOVERY_INTERFACE), allowEmpty=False)
+                for item in response.split(","):
+                    item = item.strip()
+                    if len(item) == 0:
+                        continue
+
+                    if item.find("/") >= 0:
+                        # Check the subnet is on a local interface.
+                        AreYouThereThread.GetDiscoveryNetworkList(item)
+                        itemList.append(item)
+                        continue
+
+                    idSelected = int(item)
+                    if idSelected == 1:
+                        itemList = None
+                        break
+
+                    selectedIndex = idSelected-2
+                    if selectedIndex < 0 or selectedIndex >= len(ifNameList):
+                        raise Exception("{} ID is not valid for {} interface list.".format(idSelected, ",".join(ifNameList)))
+                    itemList.append(ifNameList[selectedIndex])
+
+            except ValueError:
+                self._uio.error("{} is not a valid ID or subnet.".format(item))
+                continue
+
+            except Exception as ex:
+                self._uio.error( str(ex) )
+                continue
+
+            if itemList is None:
+                self._configManager.addAttr(IconsGWConfig.AYT_DISCOVERY_INTERFACE, None)
+            elif itemList:
+                self._configManager.addAttr(IconsGWConfig.AYT_DISCOVERY_INTERFACE, ",".join(itemList))
             else:
-                raise Exception("{} ID is not valid for {} interface list.".format(idSelected, ",".join(ifNameList)))
-         
+                continue
+            break
+
     def _editConfig(self, key):
         """@brief Edit an icons_gw persistent config attribute.
            @param key The dictionary key to edit."""
@@ -489,6 +539,574 @@ class ServiceConfig(object):
     def __str__(self):
         return "%s,%s,%d,%s,%s" % (self.deviceType, self.serviceName, self.port, self.host, self.groupName)
 
+class HostAddressCache(object):
+    """@brief Responsible for looking up the IPv4 addresses of hosts. Only the first
+              lookup of a host blocks the caller. An address is then used until its
+              TTL expires after which the previous address is still returned while
+              the host is looked up again on another thread. If this lookup fails
+              the previous address is kept and the lookup is tried again later."""
+
+    DEFAULT_TTL_SECONDS  = 300
+    RETRY_SECONDS        = 30
+
+    def __init__(self, ttl=DEFAULT_TTL_SECONDS, lookup=socket.gethostbyname):
+        """@brief Constructor
+           @param ttl The number of seconds an address is used before the host is looked up again.
+           @param lookup The method called to look up the address of a host."""
+        self._ttl = ttl
+        self._lookup = lookup
+        self._lock = threading.Lock()
+        # A list of the address and the time it expires keyed by host.
+        self._addressDict = {}
+        self._refreshSet = set()
+        self.lookupCount = 0
+        self.lookupErrorCount = 0
+
+    def get(self, host):
+        """@brief Get the address of a host.
+           @param host The host name or address.
+           @return The IPv4 address of the host. socket.error is raised if the
+                   host has not been looked up before and cannot be found."""
+        with self._lock:
+            entry = self._addressDict.get(host)
+            if entry:
+                if time() >= entry[1] and host not in self._refreshSet:
+                    self._refreshSet.add(host)
+                    refreshThread = threading.Thread(target=self._refresh, args=(host,))
+                    refreshThread.daemon = True
+                    refreshThread.start()
+                return entry[0]
+
+        self.lookupCount += 1
+        address = self._lookup(host)
+        with self._lock:
+            self._addressDict[host] = [address, time()+self._ttl]
+        return address
+
+    def _refresh(self, host):
+        """@brief Look up the address of a host again.
+           @param host The host name or address."""
+        try:
+            self.lookupCount += 1
+            address = self._lookup(host)
+            expiryTime = time()+self._ttl
+
+        except (socket.error, UnicodeError):
+            self.lookupErrorCount += 1
+            address = None
+            expiryTime = time()+min(self._ttl, HostAddressCache.RETRY_SECONDS)
+
+        with self._lock:
+            self._refreshSet.discard(host)
+            entry = self._addressDict.get(host)
+            if entry:
+                if address:
+                    entry[0] = address
+                entry[1] = expiryTime
+
+# The C structures used by the sendmmsg system call.
+class IOVec(ctypes.Structure):
+    _fields_ = [("iov_base",        ctypes.c_void_p),
+                ("iov_len",         ctypes.c_size_t)]
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name",        ctypes.c_void_p),
+                ("msg_namelen",     ctypes.c_uint32),
+                ("msg_iov",         ctypes.c_void_p),
+                ("msg_iovlen",      ctypes.c_size_t),
+                ("msg_control",     ctypes.c_void_p),
+                ("msg_controllen",  ctypes.c_size_t),
+                ("msg_flags",       ctypes.c_int)]
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr",         MsgHdr),
+                ("msg_len",         ctypes.c_uint)]
+
+def getLinuxLibcFunction(name, argTypeList):
+    """@brief Get a Linux libc function.
+       @param name The name of the function.
+       @param argTypeList The ctypes types of the function arguments. The function returns an int.
+       @return The function or None if not available on this platform."""
+    if not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        # The symbols already loaded into this process include libc.
+        libc = ctypes.CDLL(None, use_errno=True)
+        function = getattr(libc, name)
+
+    except (AttributeError, OSError):
+        return None
+
+    function.argtypes = argTypeList
+    function.restype = ctypes.c_int
+    return function
+
+class UDPSender(object):
+    """@brief Responsible for sending UDP datagrams from one socket for each address
+              family. The sockets are opened when first needed and then reused. On
+              Linux the datagrams sent to a destination in one call are sent in a
+              single sendmmsg system call. Counts of the datagrams, bytes and system
+              calls sent and of the send errors are held."""
+
+    # The maximum number of datagrams in a sendmmsg call (UIO_MAXIOV).
+    MAX_BATCH_SIZE  = 1024
+    # The fields of the C structures in native byte order and alignment. The
+    # msg_len field that follows the msghdr in an mmsghdr is set by the kernel.
+    IOVEC_STRUCT    = struct.Struct("PN")
+    MSGHDR_STRUCT   = struct.Struct("PIPNPNi")
+    IOVEC_SIZE      = ctypes.sizeof(IOVec)
+    MMSGHDR_SIZE    = ctypes.sizeof(MMsgHdr)
+
+    @staticmethod
+    def _GetSockAddr(family, addressPort):
+        """@brief Get the C sockaddr structure for a destination.
+           @param family The address family.
+           @param addressPort A tuple of the IP address and port.
+           @return The sockaddr bytes or None if the address is not a numeric address."""
+        try:
+            address = socket.inet_pton(family, addressPort[0])
+
+        except (OSError, ValueError):
+            return None
+
+        if family == socket.AF_INET6:
+            return struct.pack("=H", family) + struct.pack("!HI", addressPort[1], 0) + address + struct.pack("=I", 0)
+        return struct.pack("=H", family) + struct.pack("!H", addressPort[1]) + address + bytes(8)
+
+    def __init__(self, useSendmmsg=True):
+        """@brief Constructor
+           @param useSendmmsg If True use the sendmmsg system call if available."""
+        self._lock = threading.Lock()
+        self._sockDict = {}
+        self._sendmmsg = getLinuxLibcFunction("sendmmsg", [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]) if useSendmmsg else None
+        self.datagramCount = 0
+        self.byteCount = 0
+        self.syscallCount = 0
+        self.errorCount = 0
+
+    def _getSocket(self, family):
+        """@brief Get the socket for an address family.
+           @param family The address family.
+           @return The socket."""
+        with self._lock:
+            sock = self._sockDict.get(family)
+            if not sock:
+                sock = socket.socket(family, socket.SOCK_DGRAM)
+                if family == socket.AF_INET:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                self._sockDict[family] = sock
+            return sock
+
+    def _count(self, datagramCount, byteCount, syscallCount, errorCount=0):
+        """@brief Update the counts."""
+        with self._lock:
+            self.datagramCount += datagramCount
+            self.byteCount += byteCount
+            self.syscallCount += syscallCount
+            self.errorCount += errorCount
+
+    def send(self, payload, addressPort):
+        """@brief Send a datagram.
+           @param payload The datagram bytes.
+           @param addressPort A tuple of the address and port number to send the datagram to."""
+        self.sendBatch((payload,), addressPort)
+
+    def sendBatch(self, payloadList, addressPort):
+        """@brief Send datagrams to a destination. OSError is raised if a datagram
+                  cannot be sent (the following datagrams are not sent).
+           @param payloadList A list of datagram bytes.
+           @param addressPort A tuple of the address and port number to send the datagrams to."""
+        family = socket.AF_INET6 if ":" in addressPort[0] else socket.AF_INET
+        sock = self._getSocket(family)
+        sockAddr = None
+        if self._sendmmsg and len(payloadList) > 1:
+            sockAddr = UDPSender._GetSockAddr(family, addressPort)
+
+        if sockAddr:
+            for index in range(0, len(payloadList), UDPSender.MAX_BATCH_SIZE):
+                self._sendmmsgBatch(sock, payloadList[index:index+UDPSender.MAX_BATCH_SIZE], sockAddr)
+
+        else:
+            for payload in payloadList:
+                try:
+                    sock.sendto(payload, addressPort)
+
+                except OSError:
+                    self._count(0, 0, 1, 1)
+                    raise
+
+                self._count(1, len(payload), 1)
+
+    def _sendmmsgBatch(self, sock, payloadList, sockAddr):
+        """@brief Send up to MAX_BATCH_SIZE datagrams in sendmmsg system calls.
+           @param sock The socket to send from.
+           @param payloadList A list of datagram bytes.
+           @param sockAddr The destination sockaddr bytes."""
+        count = len(payloadList)
+        # The payloads and the sockaddr are copied into one buffer, the iovec and
+        # mmsghdr structures that point into it are packed into another.
+        payloadBuffer = ctypes.create_string_buffer(sockAddr + b"".join(payloadList))
+        payloadAddress = ctypes.addressof(payloadBuffer)
+        msgBuffer = ctypes.create_string_buffer( count*(UDPSender.IOVEC_SIZE+UDPSender.MMSGHDR_SIZE) )
+        msgAddress = ctypes.addressof(msgBuffer)
+        iovAddress = msgAddress + count*UDPSender.MMSGHDR_SIZE
+        iovOffset = count*UDPSender.MMSGHDR_SIZE
+        payloadOffset = len(sockAddr)
+        for index, payload in enumerate(payloadList):
+            UDPSender.MSGHDR_STRUCT.pack_into(msgBuffer, index*UDPSender.MMSGHDR_SIZE, payloadAddress, len(sockAddr), iovAddress + index*UDPSender.IOVEC_SIZE, 1, 0, 0, 0)
+            UDPSender.IOVEC_STRUCT.pack_into(msgBuffer, iovOffset + index*UDPSender.IOVEC_SIZE, payloadAddress + payloadOffset, len(payload))
+            payloadOffset += len(payload)
+
+        sentCount = 0
+        while sentCount < count:
+            result = self._sendmmsg(sock.fileno(), msgAddress + sentCount*UDPSender.MMSGHDR_SIZE, count-sentCount, 0)
+            if result < 0:
+                self._count(0, 0, 1, 1)
+                errNo = ctypes.get_errno()
+                raise OSError(errNo, os.strerror(errNo))
+
+            self._count(result, sum( [len(payload) for payload in payloadList[sentCount:sentCount+result]] ), 1)
+            sentCount += result
+
+    def close(self):
+        """@brief Close the sockets."""
+        with self._lock:
+            for sock in self._sockDict.values():
+                sock.close()
+            self._sockDict = {}
+
+class DatagramReceiver(object):
+    """@brief Responsible for reading the datagrams waiting on a non blocking IPv4 UDP
+              socket into a ring of buffers that is allocated once. On Linux up to
+              batchSize datagrams are read in a single recvmmsg system call, otherwise
+              they are read one at a time with recvfrom_into. No memory is allocated for
+              the datagram data so a datagram that is not needed (E.G our own AYT
+              message) costs no more than reading it."""
+
+    DEFAULT_BATCH_SIZE  = 64
+    MSG_DONTWAIT        = 0x40
+    # The port and address fields of a struct sockaddr_in.
+    SOCKADDR_IN_STRUCT  = struct.Struct("!2xH4s")
+    SOCKADDR_IN_SIZE    = 16
+    MSG_LEN_OFFSET      = MMsgHdr.msg_len.offset
+
+    def __init__(self, bufferSize, batchSize=DEFAULT_BATCH_SIZE, useRecvmmsg=True):
+        """@brief Constructor
+           @param bufferSize The size of each datagram buffer. Longer datagrams are truncated.
+           @param batchSize The maximum number of datagrams read at once.
+           @param useRecvmmsg If True use the recvmmsg system call if available."""
+        self._bufferSize = bufferSize
+        self._batchSize = max(batchSize, 1)
+        self._buffer = ctypes.create_string_buffer(self._batchSize*bufferSize)
+        self._bufferView = memoryview(self._buffer).cast("B")
+        self._recvmmsg = None
+        if useRecvmmsg:
+            self._recvmmsg = getLinuxLibcFunction("recvmmsg", [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p])
+        if self._recvmmsg:
+            self._initRecvmmsg()
+        self.syscallCount = 0
+
+    def _initRecvmmsg(self):
+        """@brief Build the iovec and mmsghdr structures used by every recvmmsg call.
+                  The kernel sets the source address and length of each datagram. The
+                  address length of an IPv4 source address is the same every time so
+                  the structures do not need to be set again before each call."""
+        sockAddrSize = DatagramReceiver.SOCKADDR_IN_SIZE
+        self._addrBuffer = ctypes.create_string_buffer(self._batchSize*sockAddrSize)
+        self._msgBuffer = ctypes.create_string_buffer( self._batchSize*(UDPSender.MMSGHDR_SIZE+UDPSender.IOVEC_SIZE) )
+        bufferAddress = ctypes.addressof(self._buffer)
+        addrAddress = ctypes.addressof(self._addrBuffer)
+        iovOffset = self._batchSize*UDPSender.MMSGHDR_SIZE
+        iovAddress = ctypes.addressof(self._msgBuffer) + iovOffset
+        for index in range(0, self._batchSize):
+            UDPSender.MSGHDR_STRUCT.pack_into(self._msgBuffer, index*UDPSender.MMSGHDR_SIZE, addrAddress + index*sockAddrSize, sockAddrSize, iovAddress + index*UDPSender.IOVEC_SIZE, 1, 0, 0, 0)
+            UDPSender.IOVEC_STRUCT.pack_into(self._msgBuffer, iovOffset + index*UDPSender.IOVEC_SIZE, bufferAddress + index*self._bufferSize, self._bufferSize)
+
+    def read(self, sock):
+        """@brief Read the datagrams waiting on a socket.
+           @param sock The non blocking socket to read from.
+           @return A list of (datagram, addressPort) tuples. Each datagram is a memoryview
+                   of a buffer that is only valid until read() is called again. The list
+                   is empty if no datagrams were waiting."""
+        if self._recvmmsg:
+            return self._readRecvmmsg(sock)
+
+        datagramList = []
+        for index in range(0, self._batchSize):
+            offset = index*self._bufferSize
+            try:
+                self.syscallCount += 1
+                rxByteCount, addressPort = sock.recvfrom_into(self._bufferView[offset:offset+self._bufferSize])
+
+            except (BlockingIOError, InterruptedError):
+                break
+
+            datagramList.append( (self._bufferView[offset:offset+rxByteCount], addressPort) )
+
+        return datagramList
+
+    def _readRecvmmsg(self, sock):
+        """@brief Read the datagrams waiting on a socket with a recvmmsg system call.
+           @param sock The socket to read from.
+           @return See read()."""
+        self.syscallCount += 1
+        rxCount = self._recvmmsg(sock.fileno(), ctypes.addressof(self._msgBuffer), self._batchSize, DatagramReceiver.MSG_DONTWAIT, None)
+        if rxCount < 0:
+            errNo = ctypes.get_errno()
+            if errNo in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(errNo, os.strerror(errNo))
+
+        datagramList = []
+        sockAddrSize = DatagramReceiver.SOCKADDR_IN_SIZE
+        for index in range(0, rxCount):
+            rxByteCount, = struct.unpack_from("I", self._msgBuffer, index*UDPSender.MMSGHDR_SIZE + DatagramReceiver.MSG_LEN_OFFSET)
+            port, address = DatagramReceiver.SOCKADDR_IN_STRUCT.unpack_from(self._addrBuffer, index*sockAddrSize)
+            offset = index*self._bufferSize
+            datagramList.append( (self._bufferView[offset:offset+min(rxByteCount, self._bufferSize)], (socket.inet_ntoa(address), port)) )
+
+        return datagramList
+
+class DiscoveryNetwork(object):
+    """@brief Details of a local network on which devices are discovered."""
+
+    def __init__(self, ifName, ipAddress, maskBitCount):
+        """@brief Constructor
+           @param ifName The name of the local network interface.
+           @param ipAddress The IP address of the local network interface.
+           @param maskBitCount The number of bits in the subnet mask."""
+        self.ifName = ifName
+        self.ipAddress = ipAddress
+        self.maskBitCount = maskBitCount
+        self._hostBits = (1<<(32-maskBitCount))-1
+        intIP = NetIF.IPStr2int(ipAddress)
+        self._networkInt = intIP & ~self._hostBits
+        self.broadcastAddress = NetIF.Int2IPStr(intIP | self._hostBits)
+
+    def contains(self, ipAddress):
+        """@brief Determine if an address is on this network.
+           @param ipAddress The IP address string.
+           @return True if the address is on this network."""
+        try:
+            return NetIF.IPStr2int(ipAddress) & ~self._hostBits == self._networkInt
+
+        except (OSError, ValueError):
+            return False
+
+    def __eq__(self, other):
+        return isinstance(other, DiscoveryNetwork) and \
+               (self.ifName, self.ipAddress, self.maskBitCount) == (other.ifName, other.ipAddress, other.maskBitCount)
+
+    def __hash__(self):
+        return hash( (self.ifName, self.ipAddress, self.maskBitCount) )
+
+    def __str__(self):
+        return "%s:%s/%d" % (self.ifName, self.ipAddress, self.maskBitCount)
+
+class InterfaceWatcher(threading.Thread):
+    """@brief Responsible for detecting changes to the local network interfaces.
+              On Linux the kernel notifies us of link and address changes over a
+              netlink socket. If this is not available the interfaces are read
+              periodically and compared with the previous state."""
+
+    POLL_SECONDS            = 5
+    NETLINK_RX_TIMEOUT      = 1
+    # Netlink messages arrive in bursts (E.G link up then address added) so
+    # we wait for this period of quiet before reporting a change.
+    NETLINK_SETTLE_SECONDS  = 0.1
+    NETLINK_RX_BUFFER_SIZE  = 65536
+    RTMGRP_LINK             = 0x01
+    RTMGRP_IPV4_IFADDR      = 0x10
+
+    def __init__(self, uo, changeCallback, pollSeconds=POLL_SECONDS):
+        """@brief Constructor
+           @param uo The UserOutput object
+           @param changeCallback The method called (on this thread) when the local network interfaces change.
+           @param pollSeconds The period in seconds between reading the interfaces if netlink is not available."""
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._uo = uo
+        self._changeCallback = changeCallback
+        self._pollSeconds = pollSeconds
+        self._stopEvent = threading.Event()
+
+    def _openNetlinkSocket(self):
+        """@brief Open a netlink socket that receives link and IPv4 address change messages.
+           @return The socket or None if netlink is not supported on this platform."""
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind( (0, InterfaceWatcher.RTMGRP_LINK | InterfaceWatcher.RTMGRP_IPV4_IFADDR) )
+            sock.settimeout(InterfaceWatcher.NETLINK_RX_TIMEOUT)
+            return sock
+
+        except (AttributeError, OSError):
+            return None
+
+    def _waitForNetlinkChange(self, sock):
+        """@brief Wait for a netlink message.
+           @param sock The netlink socket.
+           @return True if the interfaces changed."""
+        try:
+            sock.recv(InterfaceWatcher.NETLINK_RX_BUFFER_SIZE)
+
+        except socket.timeout:
+            return False
+
+        sock.settimeout(InterfaceWatcher.NETLINK_SETTLE_SECONDS)
+        try:
+            while True:
+                sock.recv(InterfaceWatcher.NETLINK_RX_BUFFER_SIZE)
+
+        except socket.timeout:
+            pass
+
+        finally:
+            sock.settimeout(InterfaceWatcher.NETLINK_RX_TIMEOUT)
+
+        return True
+
+    @staticmethod
+    def _ReadIFDict():
+        """@return The local network interfaces dict or None if they could not be read."""
+        try:
+            return NetIF().getIFDict(readNow=True)
+
+        except Exception:
+            return None
+
+    def run(self):
+        sock = self._openNetlinkSocket()
+        if sock:
+            self._uo.info("Watching for network interface changes (netlink).")
+        else:
+            self._uo.info("Watching for network interface changes (every %.1f seconds)." % (self._pollSeconds) )
+            lastIFDict = InterfaceWatcher._ReadIFDict()
+
+        try:
+            while not self._stopEvent.is_set():
+                if sock:
+                    changed = self._waitForNetlinkChange(sock)
+
+                else:
+                    if self._stopEvent.wait(self._pollSeconds):
+                        break
+                    ifDict = InterfaceWatcher._ReadIFDict()
+                    changed = ifDict != lastIFDict
+                    lastIFDict = ifDict
+
+                if changed and not self._stopEvent.is_set():
+                    self._uo.info("Network interfaces changed.")
+                    try:
+                        self._changeCallback()
+
+                    except Exception:
+                        self._uo.errorException()
+
+        finally:
+            if sock:
+                sock.close()
+
+    def shutDown(self):
+        """@brief shutdown the thread"""
+        self._stopEvent.set()
+
+class AYTScheduler(object):
+    """@brief Responsible for deciding when AYT messages are sent. AYT messages are sent
+              every minimum period after startup or after a change in the devices
+              found (a new device, a change in the number of services a device
+              provides or a device that stops responding). While nothing changes the
+              period doubles after each AYT message up to the maximum period."""
+
+    BACKOFF_FACTOR = 2
+
+    def __init__(self, minPeriod, maxPeriod):
+        """@brief Constructor
+           @param minPeriod The poll period in seconds after a change.
+           @param maxPeriod The poll period in seconds when nothing changes."""
+        self._lock = threading.Lock()
+        self._maxPeriod = maxPeriod
+        self._minPeriod = min(minPeriod, maxPeriod)
+        self._wakeCallback = None
+        self.pollCount = 0
+        self.sentCount = 0
+        self.reset()
+
+    def reset(self):
+        """@brief Restart fast polling and forget the devices seen. This is called
+                  when a new connection to the ICONS is made."""
+        with self._lock:
+            self._period = self._minPeriod
+            self._changed = True
+            self._pollNow = False
+            self._lastPollTime = None
+            self._seenIPSet = set()
+            self._prevSeenIPSet = set()
+
+    @property
+    def period(self):
+        """@return The current poll period in seconds."""
+        return self._period
+
+    def setWakeCallback(self, wakeCallback):
+        """@brief Set the method called (with no arguments) when the time of the next
+                  AYT message is brought forward.
+           @param wakeCallback The method to call or None."""
+        self._wakeCallback = wakeCallback
+
+    def changed(self, pollNow=False):
+        """@brief Called when a change is detected. Polling restarts at the minimum period.
+           @param pollNow If True then an AYT message should be sent now."""
+        with self._lock:
+            self._changed = True
+            self._period = self._minPeriod
+            if pollNow:
+                self._pollNow = True
+        wakeCallback = self._wakeCallback
+        if wakeCallback:
+            wakeCallback()
+
+    def deviceSeen(self, ipAddress):
+        """@brief Called when a response is received from a device.
+           @param ipAddress The IP address of the device."""
+        # polled() replaces the set so it must not be added to while this happens.
+        with self._lock:
+            self._seenIPSet.add(ipAddress)
+
+    def getWaitSeconds(self, now=None):
+        """@param now The current time. If None then the time is read.
+           @return The number of seconds until the next AYT message should be sent."""
+        with self._lock:
+            if self._pollNow or self._lastPollTime is None:
+                return 0
+            if now is None:
+                now = time()
+            return max(0, self._lastPollTime + self._period - now)
+
+    def polled(self, now=None, sentCount=0):
+        """@brief Called after an AYT message is sent to set the period until the next one.
+           @param now The current time. If None then the time is read.
+           @param sentCount The number of AYT messages sent (one per destination address)."""
+        if now is None:
+            now = time()
+        with self._lock:
+            # Devices that responded to the previous AYT message but not to the last one are missing.
+            seenIPSet = self._seenIPSet
+            if self._lastPollTime is not None and not self._prevSeenIPSet <= seenIPSet:
+                self._changed = True
+            self._prevSeenIPSet = seenIPSet
+            self._seenIPSet = set()
+
+            if self._changed:
+                self._period = self._minPeriod
+                self._changed = False
+            else:
+                self._period = min(self._period*AYTScheduler.BACKOFF_FACTOR, self._maxPeriod)
+            self._pollNow = False
+            self._lastPollTime = now
+            self.pollCount = self.pollCount + 1
+            self.sentCount = self.sentCount + sentCount
+
 class AreYouThereThread(threading.Thread):
     """Responsible for sendng UDP messages that are intended to elict responses"""
 
@@ -502,6 +1120,12 @@ class AreYouThereThread(threading.Thread):
         aytDict={"AYT": ayt_msg_str}
         return IconsClient.DictToJSON(aytDict)
 
+    @staticmethod
+    def GetAYTMsgBytes(ayt_msg_str):
+        """@brief Get the AYT message as it is sent.
+           @return The AYT message bytes."""
+        return str.encode( AreYouThereThread.GetJSONAYTMsg(ayt_msg_str) )
+
     @staticmethod
     def IsAYTMsg(msg, exepectedAYTString):
         aytMsg = False
@@ -511,7 +1135,7 @@ class AreYouThereThread(threading.Thread):
                 aytString = aDict["AYT"]
                 if aytString == exepectedAYTString:
                     aytMsg = True
-        except:
+        except (ValueError, TypeError):
             pass
         return aytMsg
 
@@ -546,183 +1170,1686 @@ class AreYouThereThread(threading.Thread):
         
         return subNetMultiCastAddressList
     
-    def __init__(self, uo, sock, options):
+    @staticmethod
+    def IsAllInterfaces(netIF):
+        """@brief Determine if devices should be discovered on all interfaces.
+           @param netIF The configured discovery interface/s.
+           @return True if AYT messages should be broadcast on all interfaces."""
+        return netIF is None or len(netIF.strip()) == 0
+
+    @staticmethod
+    def GetDiscoveryNetworkList(netIF, ifDict=None):
+        """@brief Get the local networks on which devices are discovered.
+           @param netIF A comma separated list of local network interface names and/or
+                  subnets (E.G eth0,192.168.2.0/24). If None or empty then all the local
+                  networks (except loopback) are returned.
+           @param ifDict The local network interfaces dict as returned by NetIF.getIFDict().
+                  If None then the local network interfaces are read.
+           @return A list of DiscoveryNetwork instances."""
+        if ifDict is None:
+            ifDict = NetIF().getIFDict(readNow=True)
+
+        allNetworkList = []
+        for ifName, ipList in ifDict.items():
+            for elem in ipList:
+                elems = elem.split("/")
+                if len(elems) == 2:
+                    try:
+                        allNetworkList.append( DiscoveryNetwork(ifName, elems[0], int(elems[1])) )
+                    except (OSError, ValueError):
+                        pass
+
+        if AreYouThereThread.IsAllInterfaces(netIF):
+            return [network for network in allNetworkList if not network.ipAddress.startswith("127.")]
+
+        networkList = []
+        for item in netIF.split(","):
+            item = item.strip()
+            if len(item) == 0:
+                continue
+
+            if item.find("/") >= 0:
+                # A subnet selects the interface addresses on it.
+                subnetAddress, maskBitCount = item.split("/", 1)
+                try:
+                    subnet = DiscoveryNetwork("", subnetAddress, int(maskBitCount))
+                except (OSError, ValueError):
+                    raise Exception("{} is not a valid subnet.".format(item))
+                matchList = [network for network in allNetworkList if subnet.contains(network.ipAddress)]
+                if not matchList:
+                    raise Exception("{} is not the subnet of a local network interface.".format(item))
+
+            else:
+                if item not in ifDict:
+                    raise Exception("{} is not a local network interface name.".format(item))
+                matchList = [network for network in allNetworkList if network.ifName == item]
+
+            for network in matchList:
+                if network not in networkList:
+                    networkList.append(network)
+
+        return networkList
+
+    @staticmethod
+    def GetDestList(options, networkList):
+        """@brief Get the addresses that AYT messages should be sent to.
+           @param options Command line options.
+           @param networkList The DiscoveryNetwork instances returned by GetDiscoveryNetworkList().
+           @return A list of (destination address, source address) tuples. The source
+                   address is the local interface address that the AYT message should
+                   be sent from or None if it may be sent from any address."""
+        if options.no_lan:
+            return [(LOCALHOST_IP, None)]
+
+        # If the user configured YView devices discovery on all interfaces.
+        if AreYouThereThread.IsAllInterfaces(options.net_if):
+            return [(AreYouThereThread.MULTICAST_ADDRESS, None)]
+
+        return [(network.broadcastAddress, network.ipAddress) for network in networkList]
+
+    def __init__(self, uo, sock, options, sockDict=None, networksChangedCallback=None, scheduler=None, polledCallback=None):
         """@brief Constructor
            @param uo The UserOutput object
            @param sock The UDP socket to send AYT messages on
-           @param options Command line options."""
+           @param options Command line options.
+           @param sockDict A dict of the UDP sockets bound to local interface addresses
+                  indexed by address. AYT messages for a network are sent on the socket
+                  bound to the interface address on that network if present so that
+                  device responses are received on that socket.
+           @param networksChangedCallback If not None this is called with the list of
+                  DiscoveryNetwork instances when the local network interfaces change.
+           @param scheduler The AYTScheduler that decides when AYT messages are sent. If None
+                  then one is created from the command line options.
+           @param polledCallback If not None this is called (with no arguments) after
+                  each AYT message is sent."""
         threading.Thread.__init__(self)
         self._running = False
         self.setDaemon(True)
         self._uo = uo
         self._sock = sock
         self._options = options
-        self._messagePeriod = self._options.dev_poll_period
+        self._sockDict = sockDict if sockDict else {}
+        self._networksChangedCallback = networksChangedCallback
         self._aytMsg = self._options.ayt_msg
+        # The AYT message and the addresses it is sent to only change if the
+        # network interfaces change so they are not rebuilt on every poll.
+        self._aytMsgBytes = AreYouThereThread.GetAYTMsgBytes(self._aytMsg)
+        networkList = [] if self._options.no_lan else AreYouThereThread.GetDiscoveryNetworkList(self._options.net_if)
+        self._destList = AreYouThereThread.GetDestList(self._options, networkList)
+        self._wakeEvent = threading.Event()
+        self._interfaceWatcher = None
+        if scheduler is None:
+            scheduler = AYTScheduler(self._options.dev_poll_min_period, self._options.dev_poll_period)
+        self._scheduler = scheduler
+        self._scheduler.setWakeCallback(self._wakeEvent.set)
+        self._polledCallback = polledCallback
+
+    def _interfacesChanged(self):
+        """@brief Called by the InterfaceWatcher when the local network interfaces change.
+                  The AYT destination addresses are updated and an AYT message is sent
+                  now so that devices on new interfaces are found without delay."""
+        networkList = AreYouThereThread.GetDiscoveryNetworkList(self._options.net_if)
+        self._destList = AreYouThereThread.GetDestList(self._options, networkList)
+        if self._networksChangedCallback:
+            self._networksChangedCallback(networkList)
+        self._scheduler.changed(pollNow=True)
 
     def run(self):
         self._running = True
         self._uo.info("Started the AYT thread")
+        if not self._options.no_lan:
+            self._interfaceWatcher = InterfaceWatcher(self._uo, self._interfacesChanged)
+            self._interfaceWatcher.start()
+
         while self._running:
-            if self._options.no_lan:
-                destAddressList = (LOCALHOST_IP,)
-            else:
-                # If the user configured YView devices discovery on all interfaces.
-                if self._options.net_if is None:
-                    destAddressList = (AreYouThereThread.MULTICAST_ADDRESS,)
-                else:
-                    destAddressList = AreYouThereThread.GetSubnetMultiCastAddress(self._options.net_if)
-            try:
-                for destAddress in destAddressList:
-                    self._sock.sendto( str.encode( AreYouThereThread.GetJSONAYTMsg(self._aytMsg) ), (destAddress, AreYouThereThread.UDP_DEV_DISCOVERY_PORT) )
-            except:
-                self._uo.error("Failed to send AYT message.")
-                self._uo.errorException()
+            self._wakeEvent.clear()
+            waitSeconds = self._scheduler.getWaitSeconds()
+            if waitSeconds > 0:
+                # Woken early if a change brings the next AYT message forward.
+                self._wakeEvent.wait(waitSeconds)
+                continue
 
-            sleep(self._messagePeriod)
+            sentCount = 0
+            for destAddress, srcAddress in self._destList:
+                try:
+                    sock = self._sockDict.get(srcAddress, self._sock)
+                    sock.sendto( self._aytMsgBytes, (destAddress, AreYouThereThread.UDP_DEV_DISCOVERY_PORT) )
+                    sentCount = sentCount + 1
+                except:
+                    self._uo.error("Failed to send AYT message to %s." % (destAddress) )
+                    self._uo.errorException()
+
+            self._scheduler.polled(sentCount=sentCount)
+            if self._polledCallback:
+                try:
+                    self._polledCallback()
+                except:
+                    self._uo.errorException()
         self._uo.info("Shutdown the AYT thread")
 
     def shutDown(self):
         """@brief shutdown the thread"""
         self._running = False
+        self._scheduler.setWakeCallback(None)
+        self._wakeEvent.set()
+        if self._interfaceWatcher:
+            self._interfaceWatcher.shutDown()
+            self._interfaceWatcher = None
+
+class RPCResponseWaiter(object):
+    """@brief Holds the response to an RPC until the thread that called the RPC collects it."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._response = None
+
+    def setResponse(self, response):
+        """@brief Set the response to the RPC and wake the caller.
+           @param response The RPC response."""
+        self._response = response
+        self._event.set()
+
+    def wait(self, timeout):
+        """@brief Wait for the response to the RPC.
+           @param timeout The maximum time to wait in seconds.
+           @return The RPC response or None if no response was received."""
+        if self._event.wait(timeout):
+            return self._response
+        return None
 
-class RPCCallerOptions(object):
-    """@brief Responsible for holding the options required for the MQTT RPC caller"""
-    def __init__(self, host, port, sid, cid, keepalive):
-        """@brief Constructor
-           @param host The MQTT server address
-           @param port The TCPIP port of the MQTT server
-           @param sid The MQTT RPC server identifier. This provides the RPC.
-           @param cid The identifier of the MQTT client.
-           @param keepalive The MQTT server connection keepalive time in seconds."""
-        self.server=host
-        self.port=port
-        self.sid=sid
-        self.cid=cid
-        self.keepalive=keepalive
+class DeviceRegistry(object):
+    """@brief Responsible for holding the devices known to the gateway.
+              Devices are keyed by their IP address with secondary indexes by unit
+              name and by the ICONS server ports allocated to them so that lookups
+              do not need to scan every known device."""
 
-class IconsClient(object):
+    def __init__(self):
+        """@brief Constructor"""
+        self._lock = threading.RLock()
+        self._devDictByIP = {}
+        self._ipSetByUnitName = {}
+        self._ipByServerPort = {}
+        self._lastSeenDict = {}
 
-    ICONS_RECONNECT_DELAY           = 5
-    MQTT_DEFAULT_KEEPALIVE_SECONDS  = 60
+    @staticmethod
+    def GetServerPortList(devDict):
+        """@brief Get the ICONS server ports allocated to a device.
+           @param devDict The dictionary of the devices parameters.
+           @return A list of the server TCP ports."""
+        portList = []
+        if IconsClient.JSON_SERVER_SERVICE_LIST in devDict:
+            for service in devDict[IconsClient.JSON_SERVER_SERVICE_LIST].split(','):
+                elems = service.split(':')
+                if len(elems) == 2:
+                    try:
+                        portList.append( int(elems[1]) )
+                    except ValueError:
+                        pass
+        return portList
 
-    JSON_UNIT_NAME           = "UNIT_NAME"
-    JSON_GROUP_NAME          = "GROUP_NAME"
-    JSON_PRODUCT_ID          = "PRODUCT_ID"
-    JSON_IP_ADDRESS_KEY      = "IP_ADDRESS"
-    JSON_SERVICE_LIST        = 'SERVICE_LIST'
-    JSON_SERVER_SERVICE_LIST = 'SERVER_SERVICE_LIST'
-    JSON_LOCATION            = "LOCATION"
+    def __len__(self):
+        return len(self._devDictByIP)
+
+    def __contains__(self, ipAddress):
+        return ipAddress in self._devDictByIP
+
+    def get(self, ipAddress):
+        """@brief Get a known device.
+           @param ipAddress The IP address of the device.
+           @return The device dict or None if unknown."""
+        return self._devDictByIP.get(ipAddress)
+
+    def getByUnitName(self, unitName):
+        """@brief Get the known devices with the given unit name.
+           @param unitName The UNIT_NAME of the device.
+           @return A list of device dicts (empty if none found)."""
+        with self._lock:
+            ipSet = self._ipSetByUnitName.get(unitName, ())
+            return [self._devDictByIP[ipAddress] for ipAddress in ipSet]
+
+    def getByServerPort(self, serverPort):
+        """@brief Get the device that an ICONS server port is forwarded to.
+           @param serverPort The TCP port on the ICONS server.
+           @return The device dict or None if the port is not allocated to a known device."""
+        ipAddress = self._ipByServerPort.get(serverPort)
+        if ipAddress is None:
+            return None
+        return self._devDictByIP.get(ipAddress)
+
+    def getDevList(self):
+        """@return A list of all the known device dicts."""
+        return list(self._devDictByIP.values())
+
+    def getServerPortCount(self):
+        """@return The number of ICONS server ports forwarded to known devices."""
+        return len(self._ipByServerPort)
+
+    def touch(self, ipAddress, now=None):
+        """@brief Record that a response was received from a known device.
+           @param ipAddress The IP address of the device.
+           @param now The time the response was received. If None then the time is read."""
+        if ipAddress in self._devDictByIP:
+            if now is None:
+                now = time()
+            self._lastSeenDict[ipAddress] = now
+
+    def getLastSeen(self, ipAddress):
+        """@param ipAddress The IP address of the device.
+           @return The time a response was last received from the device or None if unknown."""
+        return self._lastSeenDict.get(ipAddress)
+
+    def isMissing(self, ipAddress, maxSeconds, now=None):
+        """@brief Determine if a known device has stopped responding.
+           @param ipAddress The IP address of the device.
+           @param maxSeconds The number of seconds a device may not respond for.
+           @param now The current time. If None then the time is read.
+           @return True if the device has not responded for more than maxSeconds."""
+        if now is None:
+            now = time()
+        lastSeen = self._lastSeenDict.get(ipAddress)
+        return lastSeen is not None and now - lastSeen > maxSeconds
+
+    def getMissingDevList(self, maxSeconds, now=None):
+        """@brief Get the known devices that have stopped responding.
+           @param maxSeconds The number of seconds a device may not respond for.
+           @param now The current time. If None then the time is read.
+           @return A list of device dicts."""
+        if now is None:
+            now = time()
+        with self._lock:
+            return [self._devDictByIP[ipAddress] for ipAddress, lastSeen in self._lastSeenDict.items() if now - lastSeen > maxSeconds]
+
+    def add(self, devDict):
+        """@brief Add a device. If a device with the same IP address is already
+                  known it is replaced.
+           @param devDict The dictionary of the devices parameters. This must
+                  contain an IP address."""
+        ipAddress = devDict[IconsClient.JSON_IP_ADDRESS_KEY]
+        with self._lock:
+            self.remove(ipAddress)
+
+            self._devDictByIP[ipAddress] = devDict
+
+            unitName = devDict.get(IconsClient.JSON_UNIT_NAME)
+            if unitName is not None:
+                self._ipSetByUnitName.setdefault(unitName, set()).add(ipAddress)
+
+            for serverPort in DeviceRegistry.GetServerPortList(devDict):
+                self._ipByServerPort[serverPort] = ipAddress
+
+    def remove(self, ipAddress):
+        """@brief Remove a device if known.
+           @param ipAddress The IP address of the device.
+           @return The removed device dict or None if the device was not known."""
+        with self._lock:
+            devDict = self._devDictByIP.pop(ipAddress, None)
+            if devDict is None:
+                return None
+            self._lastSeenDict.pop(ipAddress, None)
+
+            unitName = devDict.get(IconsClient.JSON_UNIT_NAME)
+            ipSet = self._ipSetByUnitName.get(unitName)
+            if ipSet is not None:
+                ipSet.discard(ipAddress)
+                if not ipSet:
+                    del self._ipSetByUnitName[unitName]
+
+            for serverPort in DeviceRegistry.GetServerPortList(devDict):
+                if self._ipByServerPort.get(serverPort) == ipAddress:
+                    del self._ipByServerPort[serverPort]
+
+            return devDict
+
+    def clear(self):
+        """@brief Forget all known devices."""
+        with self._lock:
+            self._devDictByIP = {}
+            self._ipSetByUnitName = {}
+            self._ipByServerPort = {}
+            self._lastSeenDict = {}
+
+class GWStats(object):
+    """@brief Responsible for holding the counters and gauges that describe the
+              operation of the gateway. These are updated from the hot paths of
+              the gateway so updates are kept as cheap as possible."""
+
+    # The default histogram bucket upper bounds for latencies in seconds.
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        """@brief Constructor"""
+        self._lock = threading.Lock()
+        self._valueDict = {}
+        self._callbackDict = {}
+        self._gaugeNameSet = set()
+        # Each observed value has a [count, sum, max, bucket counts or None] list.
+        self._observedDict = {}
+        self._bucketDict = {}
+
+    def incr(self, name, value=1):
+        """@brief Increment a counter.
+           @param name The name of the counter.
+           @param value The value to add to the counter."""
+        with self._lock:
+            self._valueDict[name] = self._valueDict.get(name, 0) + value
+
+    def set(self, name, value):
+        """@brief Set a gauge value.
+           @param name The name of the gauge.
+           @param value The value of the gauge."""
+        with self._lock:
+            self._valueDict[name] = value
+            self._gaugeNameSet.add(name)
+
+    def setCallback(self, name, callback, isCounter=False):
+        """@brief Set a gauge whose value is only read when the stats are read.
+                  This avoids updating gauges that change frequently in the hot paths.
+           @param name The name of the gauge.
+           @param callback The method called (with no arguments) to read the gauge value.
+           @param isCounter True if the value only increases (E.G a count held elsewhere)."""
+        with self._lock:
+            self._callbackDict[name] = callback
+            if isCounter:
+                self._gaugeNameSet.discard(name)
+            else:
+                self._gaugeNameSet.add(name)
+
+    def setHistogram(self, name, bucketList=LATENCY_BUCKETS):
+        """@brief Count the observations of a value in buckets as well as holding their
+                  count, sum and maximum. The buckets are reported before the first
+                  observation.
+           @param name The name of the observed value.
+           @param bucketList The ascending upper bounds of the buckets."""
+        with self._lock:
+            self._bucketDict[name] = tuple(bucketList)
+            # The last count is for observations above the largest bound.
+            self._observedDict[name] = [0, 0, 0, [0]*(len(bucketList)+1)]
+            self._gaugeNameSet.add(name+"_max")
+
+    def observe(self, name, value):
+        """@brief Record an observation (E.G a latency). The count, sum and maximum
+                  of the observations are held.
+           @param name The name of the observed value.
+           @param value The observed value."""
+        with self._lock:
+            observation = self._observedDict.get(name)
+            if observation is None:
+                observation = self._observedDict[name] = [0, 0, 0, None]
+                self._gaugeNameSet.add(name+"_max")
+            observation[0] += 1
+            observation[1] += value
+            if value > observation[2]:
+                observation[2] = value
+            if observation[3] is not None:
+                observation[3][bisect_left(self._bucketDict[name], value)] += 1
+
+    def get(self, name):
+        """@brief Get a counter or gauge value.
+           @param name The name of the counter or gauge.
+           @return The value or 0 if it has not been set."""
+        callback = self._callbackDict.get(name)
+        if callback:
+            return callback()
+        return self._valueDict.get(name, 0)
+
+    def isGauge(self, name):
+        """@param name The name of a value returned by getDict().
+           @return True if the value is a gauge, False if it is a counter."""
+        return name in self._gaugeNameSet
+
+    def _getObservedDict(self):
+        """@return A copy of the observations. Must be called with the lock held."""
+        return dict( [(name, observation[:3]+[list(observation[3]) if observation[3] else None]) for name, observation in self._observedDict.items()] )
+
+    def _getValueDict(self, observedDict):
+        """@brief Get a copy of the counter and gauge values.
+           @param observedDict A copy of the observations. The count, sum and maximum
+                  of each are added as values.
+           @return A dict of values."""
+        with self._lock:
+            valueDict = dict(self._valueDict)
+            callbackDict = dict(self._callbackDict)
+            observedDict.update( self._getObservedDict() )
+        for name, callback in callbackDict.items():
+            valueDict[name] = callback()
+        for name, (count, total, maxValue, _) in observedDict.items():
+            valueDict[name+"_count"] = count
+            valueDict[name+"_sum"] = total
+            valueDict[name+"_max"] = maxValue
+        return valueDict
+
+    def getDict(self):
+        """@return A copy of all the counter and gauge values."""
+        return self._getValueDict({})
+
+    def getPrometheusText(self, prefix):
+        """@brief Get the stats in the Prometheus text exposition format.
+           @param prefix The text added to the start of each stat name.
+           @return The text."""
+        observedDict = {}
+        valueDict = self._getValueDict(observedDict)
+
+        lineList = []
+        for name in sorted(observedDict.keys()):
+            count, total, _, bucketCountList = observedDict[name]
+            metricName = prefix+name
+            if bucketCountList:
+                lineList.append("# TYPE %s histogram" % (metricName) )
+                bucketCount = 0
+                for bound, boundCount in zip(self._bucketDict[name], bucketCountList):
+                    bucketCount = bucketCount + boundCount
+                    lineList.append('%s_bucket{le="%s"} %d' % (metricName, bound, bucketCount) )
+                lineList.append('%s_bucket{le="+Inf"} %d' % (metricName, count) )
+            else:
+                lineList.append("# TYPE %s summary" % (metricName) )
+            lineList.append("%s_sum %s" % (metricName, total) )
+            lineList.append("%s_count %d" % (metricName, count) )
+            del valueDict[name+"_count"]
+            del valueDict[name+"_sum"]
+
+        for name in sorted(valueDict.keys()):
+            value = valueDict[name]
+            if value is None:
+                continue
+            metricName = prefix+name
+            lineList.append("# TYPE %s %s" % (metricName, "gauge" if self.isGauge(name) else "counter") )
+            lineList.append("%s %s" % (metricName, value) )
 
-    RPC_SERVER_ID            = 1
+        return "\n".join(lineList)+"\n"
 
-    @staticmethod
-    def DictToJSON(aDict):
-        """@brief convert a python dictionary into JSON text
-           @param aDict The python dictionary to be converted
-           @return The JSON text representing aDict"""
-        return json.dumps(aDict)
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """@brief Responsible for answering the HTTP requests made to the MetricsServer."""
 
-    @staticmethod
-    def JSONToDict(jsonText):
-        """@brief Convert from JSON text to a python dict. Throws a ValueError
-                  if the text is formatted incorrectly.
-           @param jsonText The JSON text to be converted to a dict
-           @return a python dict object"""
-        return json.loads(jsonText)
+    def do_GET(self):
+        if self.path.split("?")[0] != MetricsServer.PATH:
+            self.send_error(404)
+            return
 
-    @staticmethod
-    def ReportException(uo, ex, debug):
-        """@brief Report an exception. If debug is set then a stack trasce is
-                  reported.
-           @param ex The exception to report"""
-        if debug:
-            lines = traceback.format_exc().splitlines()
-            for line in lines:
-                uo.error(line)
-        else:
-            uo.error(ex)
+        body = self.server.stats.getPrometheusText(MetricsServer.PREFIX).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", MetricsServer.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-    @staticmethod
-    def TX_UDP(theDict, addressPort):
-        """"@brief Send the service details to the remote host in a UDP packet.
-            @param theDict, The device dict
-            @param addressPort A tuple of the address and port number to send the data to."""
-        msg = IconsClient.DictToJSON(theDict)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg.encode(), addressPort)
+    def log_message(self, format, *args):
+        # Don't report every scrape.
+        pass
 
-    def __init__(self, uo, options):
-        """@brief Constructor
-           @param uop A UIO instance
-           @param options An options instance with the following attrs
-                  options.location = A string that describes the location of this destination client (may not start /)
-           """
+class MetricsServer(threading.Thread):
+    """@brief Responsible for serving the gateway stats over HTTP in the Prometheus
+              text format so that they can be scraped while the gateway runs."""
+
+    PATH            = "/metrics"
+    PREFIX          = "icons_gw_"
+    CONTENT_TYPE    = "text/plain; version=0.0.4; charset=utf-8"
+    DEFAULT_ADDRESS = LOCALHOST_IP
+
+    def __init__(self, uo, stats, address, port):
+        """@brief Constructor. The server socket is opened here so that an address in
+                  use is reported to the caller.
+           @param uo A UIO instance.
+           @param stats The GWStats instance to serve.
+           @param address The local address to serve on.
+           @param port The TCP port to serve on."""
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
         self._uo = uo
-        self._options = options
+        self._server = HTTPServer((address, port), MetricsRequestHandler)
+        self._server.stats = stats
 
-        self._knownDeviceList = []
-        self._ssh = None
-        self._sshTunnelManager = None
-        self._mqttClient = None
-        self._mqttRPCCallerClient = None
-        self._mqttClientConnected = False
+    def run(self):
+        address, port = self._server.server_address[:2]
+        self._uo.info("Serving the icons_gw stats on http://%s:%d%s" % (address, port, MetricsServer.PATH) )
+        self._server.serve_forever()
 
-    def on_connect(self, client, userdata, flags, rc):
-        """@brief called on completion of the connection attempt."""
-        if rc == 0:
-            self._mqttClientConnected=True
-            self._uo.info("Connected to the MQTT server via local port %d" % (self._localMQTTPort) )
-        else:
-            self._mqttClientConnected = False
-            self._uo.error("Failed to connect to the MQTT server via local port %d (return code = %d)" % (self._localMQTTPort, rc) )
+    def shutDown(self):
+        """@brief shutdown the thread"""
+        self._server.shutdown()
+        self._server.server_close()
 
-        self._connectAttemptInProgress = False
+class DeviceResponseQueue(object):
+    """@brief Responsible for holding the datagrams received from devices until they are
+              processed. The queue is bounded. When it is full a datagram from a source
+              address that already has a datagram in the queue replaces that datagram
+              (only the latest state of a device matters) and other datagrams are dropped."""
 
-    def on_disconnect(self, client, userdata, rc):
-        self._uo.info("MQTT client dissconnected")
-        self._mqttClientConnected = False
+    DEFAULT_SIZE = 1024
 
-    def _waitForConnectSuccess(self, pollSeconds=0.5):
-        """@brief Wait for the connect attempt to succeed.
-           @param pollSeconds he poll time in seconds."""
-        while self._connectAttemptInProgress:
-            sleep(pollSeconds)
-            self._uo.info("Connecting to the MQTT server.")
+    def __init__(self, maxSize):
+        """@brief Constructor
+           @param maxSize The maximum number of datagrams held in the queue."""
+        self._maxSize = max(maxSize, 1)
+        self._condition = threading.Condition()
+        self._entryDeque = deque()
+        self._lastEntryDict = {}
+        self._closed = False
+        self.dropCount = 0
+        self.coalesceCount = 0
+
+    def __len__(self):
+        return len(self._entryDeque)
+
+    def put(self, rxData, addressPort, rxTime, ifName=None):
+        """@brief Add a datagram to the queue.
+           @param rxData The datagram bytes.
+           @param addressPort The source address and port of the datagram.
+           @param rxTime The time the datagram was received.
+           @param ifName The name of the interface the datagram was received on if known.
+           @return True if the datagram was queued, False if it was dropped."""
+        with self._condition:
+            if len(self._entryDeque) >= self._maxSize:
+                entry = self._lastEntryDict.get(addressPort)
+                if entry is None:
+                    self.dropCount = self.dropCount + 1
+                    return False
+
+                entry[0] = rxData
+                entry[2] = rxTime
+                entry[3] = ifName
+                self.coalesceCount = self.coalesceCount + 1
+                return True
 
-        if not self._mqttClientConnected:
-            raise IconsClientError("Failed to connect to MQTT server.")
+            entry = [rxData, addressPort, rxTime, ifName]
+            self._entryDeque.append(entry)
+            self._lastEntryDict[addressPort] = entry
+            self._condition.notify()
+            return True
 
-    def isConnected(self):
-        """@brief Get the connected status.
-           @return True if the MQTT client is connected."""
-        return self._mqttClientConnected
+    def get(self):
+        """@brief Get the next datagram from the queue, blocking until one is available.
+           @return A list containing the datagram bytes, source address, receive time and
+                   receive interface name or None if the queue has been closed."""
+        with self._condition:
+            while not self._entryDeque:
+                if self._closed:
+                    return None
+                self._condition.wait()
+
+            entry = self._entryDeque.popleft()
+            if self._lastEntryDict.get(entry[1]) is entry:
+                del self._lastEntryDict[entry[1]]
+            return entry
+
+    def close(self):
+        """@brief Close the queue. Any threads blocked in get() return None once the
+                  queue is empty."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+class StatsReporter(threading.Thread):
+    """@brief Responsible for periodically reporting the gateway stats to the user
+              and optionally publishing them."""
+
+    STATS_KEY = "STATS"
+    RATES_KEY = "RATES"
+    TIME_KEY  = "TIME"
+
+    def __init__(self, uo, stats, periodSeconds, publishCallback=None):
+        """@brief Constructor
+           @param uo A UIO instance.
+           @param stats The GWStats instance to report.
+           @param periodSeconds The period between reports in seconds.
+           @param publishCallback If not None this is called with the JSON text of
+                  the stats and the per second rates of the counters at each report."""
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._uo = uo
+        self._stats = stats
+        self._periodSeconds = periodSeconds
+        self._publishCallback = publishCallback
+        self._stopEvent = threading.Event()
 
-    def _connectToMQTTServer(self):
-        """@brief Connect to the MQTT server through an ssh tunnel."""
+    def run(self):
+        prevStatsDict = None
+        prevTime = None
+        while not self._stopEvent.wait(self._periodSeconds):
+            statsDict = self._stats.getDict()
+            now = time()
+            statsStr = ", ".join( ["%s=%s" % (name, statsDict[name]) for name in sorted(statsDict.keys())] )
+            self._uo.info("STATS: %s" % (statsStr) )
+
+            if self._publishCallback:
+                rateDict = {}
+                if prevStatsDict is not None and now > prevTime:
+                    for name, value in statsDict.items():
+                        if name in prevStatsDict and not self._stats.isGauge(name):
+                            rateDict[name] = (value-prevStatsDict[name])/(now-prevTime)
+                try:
+                    self._publishCallback( IconsClient.DictToJSON({StatsReporter.TIME_KEY: now,
+                                                                   StatsReporter.STATS_KEY: statsDict,
+                                                                   StatsReporter.RATES_KEY: rateDict}) )
+                except Exception as ex:
+                    self._uo.warn("Failed to publish the icons_gw stats: %s" % (str(ex)) )
+                prevStatsDict = statsDict
+                prevTime = now
 
-        self._uo.info("Connecting to MQTT server on ssh server")
-        self._localMQTTPort = GetFreeTCPPort() #Get a free TCPIP port on the local machine
-        self._sshTunnelManager = SSHTunnelManager(self._uo, self._ssh, not self._options.no_comp )
-        self._sshTunnelManager.startFwdSSHTunnel(self._localMQTTPort, LOCALHOST, self._options.mqtt_port)
-        self._uo.info("Connecting local port %d to the %d port on the ssh server (%s:%d)" % (self._localMQTTPort, self._options.mqtt_port, self._options.server, self._options.server_port) )
+    def shutDown(self):
+        """@brief shutdown the thread"""
+        self._stopEvent.set()
 
-        self._uo.info("Connecting to MQTT server (port %d) on ssh server" % (self._options.mqtt_port) )
-        self._mqttClient = mqtt.Client()
-        self._mqttClient.on_connect = self.on_connect
-        self._mqttClient.on_disconnect = self.on_disconnect
+class PublishChangeFilter(object):
+    """@brief Responsible for deciding if a device state message needs to be published.
+              A digest of the last payload published for each device is held so that
+              unchanged payloads are only re published at the heartbeat interval."""
+
+    DIGEST_SIZE = 16
+
+    def __init__(self, heartbeatSeconds):
+        """@brief Constructor
+           @param heartbeatSeconds The maximum period in seconds between publishing
+                  unchanged payloads for a device. If 0 then every payload is published."""
+        self._heartbeatSeconds = heartbeatSeconds
+        self._lastPublishDict = {}
+
+    def isPublishRequired(self, key, payload, now=None):
+        """@brief Determine if a payload should be published. If it should then
+                  it is recorded as the last payload published for the key.
+           @param key The key that identifies the device.
+           @param payload The payload text.
+           @param now The current time in seconds. If None the current time is read.
+           @return True if the payload should be published."""
+        if self._heartbeatSeconds <= 0:
+            return True
+
+        if now is None:
+            now = time()
+
+        digest = hashlib.blake2b(payload.encode(), digest_size=PublishChangeFilter.DIGEST_SIZE).digest()
+        lastPublish = self._lastPublishDict.get(key)
+        if lastPublish and lastPublish[0] == digest and now-lastPublish[1] < self._heartbeatSeconds:
+            return False
+
+        self._lastPublishDict[key] = (digest, now)
+        return True
+
+    def forget(self, key):
+        """@brief Forget the last payload published for a device so that the next
+                  payload is published.
+           @param key The key that identifies the device."""
+        self._lastPublishDict.pop(key, None)
+
+    def clear(self):
+        """@brief Forget the last payload published for all devices."""
+        self._lastPublishDict = {}
+
+class PublishTopicOptions(object):
+    """@brief Responsible for holding the MQTT QOS, retain flag and device state
+              encoding used to publish on each topic. These are configured with MQTT
+              topic filters so that wildcards (+ and #) may be used."""
+
+    DEFAULT_QOS = 0
+
+    @staticmethod
+    def GetQOSList(qosText):
+        """@brief Get the QOS of each topic filter from text.
+           @param qosText A comma separated list of TOPIC_FILTER:QOS entries.
+           @return A list of (topic filter, QOS) tuples."""
+        qosList = []
+        for entry in qosText.split(","):
+            entry = entry.strip()
+            if not entry:
+                continue
+            topicFilter, _, qos = entry.rpartition(":")
+            if not topicFilter or qos not in ("0", "1", "2"):
+                raise IconsGWError("%s is not a valid TOPIC:QOS entry (QOS must be 0, 1 or 2)." % (entry) )
+            qosList.append( (topicFilter, int(qos)) )
+        return qosList
+
+    @staticmethod
+    def GetTopicFilterList(topicFilterText):
+        """@brief Get a list of topic filters from text.
+           @param topicFilterText A comma separated list of topic filters.
+           @return A list of topic filters."""
+        return [topicFilter.strip() for topicFilter in topicFilterText.split(",") if topicFilter.strip()]
+
+    def __init__(self, qosText="", retainText="", compactText=""):
+        """@brief Constructor
+           @param qosText A comma separated list of TOPIC_FILTER:QOS entries. The QOS of the
+                  first matching entry is used. Topics that match no entry use QOS 0.
+           @param retainText A comma separated list of topic filters. Messages published on
+                  topics that match one of these are retained by the MQTT server.
+           @param compactText A comma separated list of topic filters. Device state published
+                  on topics that match one of these uses the compact encoding rather than JSON."""
+        self._qosList = PublishTopicOptions.GetQOSList(qosText)
+        self._retainList = PublishTopicOptions.GetTopicFilterList(retainText)
+        self._compactList = PublishTopicOptions.GetTopicFilterList(compactText)
+        if self._compactList:
+            try:
+                DevStateCodec.CheckCompactAvailable()
+            except DevStateCodecError as ex:
+                raise IconsGWError( str(ex) )
+        self._topicOptionsDict = {}
+        self._compactDict = {}
+
+    def get(self, topic):
+        """@brief Get the options used to publish on a topic.
+           @param topic The MQTT topic.
+           @return A tuple containing the QOS and retain flag."""
+        topicOptions = self._topicOptionsDict.get(topic)
+        if topicOptions is None:
+            qos = PublishTopicOptions.DEFAULT_QOS
+            for topicFilter, filterQOS in self._qosList:
+                if mqtt.topic_matches_sub(topicFilter, topic):
+                    qos = filterQOS
+                    break
+            retain = any( [mqtt.topic_matches_sub(topicFilter, topic) for topicFilter in self._retainList] )
+            topicOptions = (qos, retain)
+            self._topicOptionsDict[topic] = topicOptions
+        return topicOptions
+
+    def isCompact(self, topic):
+        """@brief Determine if device state is published on a topic in the compact encoding.
+           @param topic The MQTT topic.
+           @return True if the compact encoding is used, False if JSON is used."""
+        compact = self._compactDict.get(topic)
+        if compact is None:
+            compact = any( [mqtt.topic_matches_sub(topicFilter, topic) for topicFilter in self._compactList] )
+            self._compactDict[topic] = compact
+        return compact
+
+class PublishQueue(object):
+    """@brief Responsible for holding the messages to be published to the ICONS MQTT
+              server until the MQTT client can accept them. The queue is bounded and
+              holds one message per topic. A message for a topic that already has a
+              message waiting replaces it (only the latest state of a device matters).
+              When the queue is full messages for other topics are dropped. The number
+              of messages handed to the MQTT client that it has not yet sent (QOS 0)
+              or had acknowledged (QOS 1 and 2) is limited so that messages are not
+              buffered without limit by the MQTT client when the connection is slow.
+              This class does not publish messages itself. Messages are published by
+              the thread that calls publish() so no lock is held while the MQTT client
+              is called.
+              A request to clear the message retained by the MQTT server for a topic
+              is held separately from the message for the topic so that it is sent
+              after that message."""
+
+    DEFAULT_SIZE            = 1024
+    DEFAULT_MAX_IN_FLIGHT   = 64
+
+    def __init__(self, maxSize, maxInFlight, topicOptions):
+        """@brief Constructor
+           @param maxSize The maximum number of messages held in the queue.
+           @param maxInFlight The maximum number of messages handed to the MQTT client
+                  that have not been published. If 0 there is no limit.
+           @param topicOptions The PublishTopicOptions instance that provides the QOS
+                  and retain flag for each topic."""
+        self._maxSize = max(maxSize, 1)
+        self._maxInFlight = maxInFlight
+        self._topicOptions = topicOptions
+        self._lock = threading.Lock()
+        self._entryDict = OrderedDict()
+        self._inFlightCount = 0
+        self._inFlightDict = {}
+        self._publishingCount = 0
+        self._publishedMIDSet = set()
+        self.dropCount = 0
+        self.coalesceCount = 0
+
+    def __len__(self):
+        return len(self._entryDict)
+
+    @property
+    def inFlightCount(self):
+        """@return The number of messages handed to the MQTT client that have not been published."""
+        return self._inFlightCount
+
+    def put(self, topic, payload, queueTime=None):
+        """@brief Add a message to the queue.
+           @param topic The MQTT topic.
+           @param payload The message text.
+           @param queueTime The time the message was queued. If None the current time is read.
+           @return True if the message was queued, False if it was dropped."""
+        if queueTime is None:
+            queueTime = time()
+        with self._lock:
+            if topic in self._entryDict:
+                # Keep the position of the message being replaced so that a device
+                # that changes often does not hold back the others.
+                self._entryDict[topic] = (payload, queueTime)
+                self.coalesceCount = self.coalesceCount + 1
+
+            elif len(self._entryDict) >= self._maxSize:
+                self.dropCount = self.dropCount + 1
+                return False
+
+            else:
+                self._entryDict[topic] = (payload, queueTime)
+
+            # The message replaces the retained message so it does not need clearing.
+            self._entryDict.pop( PublishQueue.GetClearKey(topic), None)
+            return True
+
+    @staticmethod
+    def GetClearKey(topic):
+        """@brief Get the key of a request to clear the retained message of a topic.
+           @param topic The MQTT topic.
+           @return The key."""
+        return (topic,)
+
+    def clearRetained(self, topic, queueTime=None):
+        """@brief Queue a request to clear the message retained by the MQTT server for a
+                  topic (a zero length retained message). This is sent after any message
+                  waiting for the topic. It is discarded if another message for the topic
+                  is queued before it is sent. The queue size does not limit these requests.
+           @param topic The MQTT topic.
+           @param queueTime The time the request was queued. If None the current time is read."""
+        if queueTime is None:
+            queueTime = time()
+        with self._lock:
+            clearKey = PublishQueue.GetClearKey(topic)
+            self._entryDict.pop(clearKey, None)
+            self._entryDict[clearKey] = (None, queueTime)
+
+    def _getNext(self):
+        """@brief Get the next message to publish and reserve an in flight slot for it.
+           @return A tuple containing the topic, payload and queue time or None if no
+                   message can be published now."""
+        with self._lock:
+            if not self._entryDict:
+                return None
+            if self._maxInFlight > 0 and self._inFlightCount >= self._maxInFlight:
+                return None
+            topic, (payload, queueTime) = self._entryDict.popitem(last=False)
+            self._inFlightCount = self._inFlightCount + 1
+            self._publishingCount = self._publishingCount + 1
+            return (topic, payload, queueTime)
+
+    def publish(self, mqttClient, latencyCallback=None):
+        """@brief Hand the waiting messages to the MQTT client until the in flight
+                  limit is reached or the MQTT client cannot accept them.
+           @param mqttClient The paho MQTT client instance.
+           @param latencyCallback If not None this method is called with the time in
+                  seconds from a message being queued to it being published.
+           @return The number of messages handed to the MQTT client."""
+        sentCount = 0
+        while True:
+            entry = self._getNext()
+            if entry is None:
+                return sentCount
+
+            topic, payload, queueTime = entry
+            if isinstance(topic, tuple):
+                qos, _ = self._topicOptions.get(topic[0])
+                msgInfo = mqttClient.publish(topic[0], None, qos=qos, retain=True)
+            else:
+                qos, retain = self._topicOptions.get(topic)
+                msgInfo = mqttClient.publish(topic, payload, qos=qos, retain=retain)
+            with self._lock:
+                self._publishingCount = self._publishingCount - 1
+                if msgInfo.rc != mqtt.MQTT_ERR_SUCCESS:
+                    self._inFlightCount = self._inFlightCount - 1
+                    # Put the message back at the front unless it has been replaced.
+                    if topic not in self._entryDict:
+                        self._entryDict[topic] = (payload, queueTime)
+                        self._entryDict.move_to_end(topic, last=False)
+                    return sentCount
+
+                # The MQTT client may report that the message was published before publish() returns.
+                if msgInfo.mid in self._publishedMIDSet:
+                    self._inFlightCount = self._inFlightCount - 1
+                    latency = time()-queueTime
+                else:
+                    self._inFlightDict[msgInfo.mid] = queueTime
+                    latency = None
+                # Other messages (E.G RPC requests) are also reported so only hold the
+                # IDs while a message is being handed to the MQTT client.
+                if self._publishingCount == 0:
+                    self._publishedMIDSet = set()
+
+            if latency is not None and latencyCallback:
+                latencyCallback(latency)
+            sentCount = sentCount + 1
+
+    def published(self, mid):
+        """@brief Called when the MQTT client reports that a message has been published.
+           @param mid The MQTT message ID.
+           @return The time in seconds from the message being queued to being published
+                   or None if not known."""
+        with self._lock:
+            queueTime = self._inFlightDict.pop(mid, None)
+            if queueTime is None:
+                if self._publishingCount > 0:
+                    self._publishedMIDSet.add(mid)
+                return None
+            self._inFlightCount = self._inFlightCount - 1
+        return time()-queueTime
+
+    def resetInFlight(self):
+        """@brief Forget the messages handed to the MQTT client. This is called when a new
+                  connection is made as the messages handed to the previous MQTT client
+                  will not be reported as published."""
+        with self._lock:
+            self._inFlightCount = self._publishingCount
+            self._inFlightDict = {}
+            self._publishedMIDSet = set()
+
+    def clear(self):
+        """@brief Remove all the messages waiting to be published."""
+        with self._lock:
+            self._entryDict = OrderedDict()
+
+class ServerPortAllocator(object):
+    """@brief Responsible for obtaining free TCP ports on the ICONS server from the
+              ICONS MQTT RPC provider. Ports are requested in batches so that a
+              single RPC round trip can provide the ports for many services.
+              If the RPC provider has a port pool the ports are leased to the
+              gateway location and the leases are renewed in bulk.
+              An older RPC provider that returns an error for an RPC is only
+              called with the RPCs it supports from then on. An RPC that is not
+              answered does not change the RPCs used as the response may have
+              been lost.
+              Only one thread requests ports from the RPC provider at a time. The
+              lock is not held while it does so, so that other threads can be given
+              the ports the allocator already holds."""
+
+    DEFAULT_BATCH_SIZE = 16
+    RENEW_DIVISOR      = 3
+
+    def __init__(self, rpcCall, batchSize, location=None):
+        """@brief Constructor
+           @param rpcCall The method used to call an RPC on the ICONS (rpcCall(methodName, argList)).
+                  This returns None if no response is received and raises an IconsRPCError
+                  if the provider returns an error.
+           @param batchSize The minimum number of ports to request in each RPC.
+           @param location The gateway location that ports are leased to. If None then
+                  ports are not leased."""
+        self._rpcCall = rpcCall
+        self._batchSize = max(batchSize, 1)
+        self._lock = threading.Lock()
+        self._fetchDone = threading.Condition(self._lock)
+        self._fetching = False
+        self._portList = []
+        self._batchSupported = True
+        self._location = location
+        self._leaseSupported = location is not None
+        self._leaseTTL = None
+        self._leasedPortSet = set()
+        self._lastRenewTime = None
+        self._reservedPortSet = set()
+        self._prevReservedPortSet = set()
+
+    @staticmethod
+    def _CheckResponse(methodName, response):
+        """@brief Check that a response was received to an RPC.
+           @param methodName The name of the RPC.
+           @param response The response to the RPC."""
+        if response is None:
+            raise IconsGWError("No response to the %s RPC. Check MQTT RPC server is running." % (methodName) )
+
+    def _leasePorts(self, requiredCount):
+        """@brief Lease ports from the RPC provider port pool. This is called without the lock held.
+           @param requiredCount The number of ports required.
+           @return A list of the ports leased or None if the RPC provider does not have a port pool."""
+        try:
+            response = self._rpcCall("leaseTCPPortList", [max(requiredCount, self._batchSize), self._location])
+
+        except IconsRPCError:
+            return None
+
+        ServerPortAllocator._CheckResponse("leaseTCPPortList", response)
+        if not isinstance(response, dict) or not isinstance(response.get("PORTS"), list):
+            return None
+
+        portList = [port for port in response["PORTS"] if port > 0]
+        with self._lock:
+            self._leasedPortSet.update(portList)
+            self._leaseTTL = response.get("TTL")
+            if self._lastRenewTime is None:
+                self._lastRenewTime = time()
+        return portList
+
+    def _fetchPorts(self, requiredCount):
+        """@brief Request free ports from the RPC provider. This is called without the lock held.
+           @param requiredCount The number of ports required.
+           @return A list of the ports received. This may hold more than requiredCount ports."""
+        if self._leaseSupported:
+            portList = self._leasePorts(requiredCount)
+            if portList is not None:
+                return portList
+
+            # Older RPC providers do not lease ports.
+            self._leaseSupported = False
+
+        if self._batchSupported:
+            try:
+                response = self._rpcCall("getFreeTCPPortList", [max(requiredCount, self._batchSize)])
+                ServerPortAllocator._CheckResponse("getFreeTCPPortList", response)
+                if isinstance(response, list):
+                    return [port for port in response if port > 0]
+
+            except IconsRPCError:
+                pass
+
+            # Older RPC providers only support getting one port per RPC.
+            self._batchSupported = False
+
+        portList = []
+        for _ in range(0, requiredCount):
+            port = self._rpcCall("getFreeTCPPort", "")
+            ServerPortAllocator._CheckResponse("getFreeTCPPort", port)
+            if port < 0:
+                break
+            portList.append(port)
+        return portList
+
+    def getPorts(self, count, preferredPortList=None):
+        """@brief Get free TCP ports on the ICONS server.
+           @param count The number of ports required.
+           @param preferredPortList If not None a list of the ports that should be used if
+                  they are held by the allocator (E.G the ports a device used before the
+                  gateway reconnected). None elements are ignored.
+           @return A list of count TCP port numbers. Preferred ports are returned at
+                   the same index as in preferredPortList."""
+        with self._lock:
+            while True:
+                portList = [None]*count
+                if preferredPortList:
+                    for index, port in enumerate(preferredPortList[:count]):
+                        if port is not None and (port in self._reservedPortSet or port in self._portList):
+                            portList[index] = port
+
+                requiredCount = portList.count(None)
+                freePortList = [port for port in self._portList if port not in portList]
+                if len(freePortList) >= requiredCount:
+                    break
+
+                if self._fetching:
+                    # Wait for the ports another thread is requesting.
+                    self._fetchDone.wait()
+                    continue
+
+                fetchCount = requiredCount-len(freePortList)
+                self._fetching = True
+                self._lock.release()
+                try:
+                    fetchedPortList = self._fetchPorts(fetchCount)
+
+                finally:
+                    self._lock.acquire()
+                    self._fetching = False
+                    self._fetchDone.notify_all()
+
+                self._portList.extend(fetchedPortList)
+                # Other threads may have taken ports while the RPC was in progress so
+                # request more unless the RPC provider has run out.
+                if len(fetchedPortList) < fetchCount:
+                    freePortList = [port for port in self._portList if port not in portList]
+                    if len(freePortList) < requiredCount:
+                        raise IconsGWError("Failed to get an available TCPIP port. Check MQTT RPC server is running.")
+
+            freePortIter = iter(freePortList[:requiredCount])
+            portList = [port if port is not None else next(freePortIter) for port in portList]
+            self._reservedPortSet.difference_update(portList)
+            usedPortSet = set(portList)
+            self._portList = [port for port in self._portList if port not in usedPortSet]
+            return portList
+
+    def claimPorts(self, portList):
+        """@brief Lease the given ports again (E.G the ports used before the gateway reconnected).
+                  Claimed ports are only returned by getPorts() when preferred until the
+                  leases are next renewed, after which they are used as free ports.
+           @param portList A list of TCP port numbers.
+           @return A list of the ports claimed."""
+        if not self._leaseSupported or not portList:
+            return []
+
+        try:
+            response = self._rpcCall("renewTCPPortList", [self._location, portList])
+
+        except IconsRPCError:
+            # Older RPC providers do not lease ports.
+            self._leaseSupported = False
+            return []
+
+        if not isinstance(response, list):
+            return []
+
+        with self._lock:
+            claimedList = [port for port in response if port not in self._leasedPortSet]
+            self._leasedPortSet.update(claimedList)
+            self._reservedPortSet.update(claimedList)
+            if self._lastRenewTime is None:
+                self._lastRenewTime = time()
+        return claimedList
+
+    def releasePorts(self, portList):
+        """@brief Return ports that are no longer forwarded so that they may be reused.
+           @param portList A list of TCP port numbers."""
+        with self._lock:
+            self._portList.extend(portList)
+
+    def isRenewDue(self, now=None):
+        """@param now The current time. If None then the time is read.
+           @return True if the port leases should be renewed."""
+        if not self._leaseSupported or not self._leasedPortSet or not self._leaseTTL:
+            return False
+        if now is None:
+            now = time()
+        return now-self._lastRenewTime >= self._leaseTTL/ServerPortAllocator.RENEW_DIVISOR
+
+    def renewLeases(self):
+        """@brief Renew the leases of all the ports held in a single RPC. Free ports
+                  beyond a batch are released back to the RPC provider port pool.
+           @return A list of the ports whose leases could not be renewed."""
+        with self._lock:
+            self._lastRenewTime = time()
+            # Claimed ports not used since the last renewal become free ports.
+            unusedPortSet = self._reservedPortSet & self._prevReservedPortSet
+            self._reservedPortSet.difference_update(unusedPortSet)
+            self._portList.extend(unusedPortSet)
+            self._prevReservedPortSet = set(self._reservedPortSet)
+
+            releaseList = self._portList[self._batchSize:]
+            del self._portList[self._batchSize:]
+            self._leasedPortSet.difference_update(releaseList)
+            renewList = list(self._leasedPortSet)
+
+        try:
+            if releaseList:
+                self._rpcCall("releaseTCPPortList", [self._location, releaseList])
+
+            renewedList = None
+            if renewList:
+                renewedList = self._rpcCall("renewTCPPortList", [self._location, renewList])
+
+        except IconsRPCError:
+            # The RPC provider has been replaced by one that does not lease ports.
+            self._leaseSupported = False
+            return []
+
+        lostPortList = []
+        # If no response is received the leases are renewed on the next attempt.
+        if isinstance(renewedList, list):
+            lostPortSet = set(renewList).difference(renewedList)
+            if lostPortSet:
+                with self._lock:
+                    self._leasedPortSet.difference_update(lostPortSet)
+                    self._reservedPortSet.difference_update(lostPortSet)
+                    self._portList = [port for port in self._portList if port not in lostPortSet]
+                lostPortList = list(lostPortSet)
+
+        return lostPortList
+
+class PortAssignmentCache(object):
+    """@brief Responsible for remembering the ICONS port used for each service of each
+              device so that devices keep the same ports when the gateway reconnects or
+              restarts. The assignments are saved to a compact JSON file which loads in
+              a few milliseconds for thousands of devices."""
+
+    FILENAME     = "icons_gw_ports.json"
+    LOCATION_KEY = "LOCATION"
+    PORTS_KEY    = "PORTS"
+    REMOVED_KEY  = "REMOVED"
+    DEFAULT_EXPIRY_SECONDS = 7*24*60*60
+
+    def __init__(self, filename, location):
+        """@brief Constructor
+           @param filename The file the assignments are saved in. If None or empty the
+                  assignments are not saved.
+           @param location The gateway location. Assignments saved for another location
+                  are not loaded."""
+        self._filename = filename
+        self._location = location
+        self._lock = threading.Lock()
+        self._portDictByIP = {}
+        self._keyByPort = {}
+        self._removedTimeByIP = {}
+        self._changed = False
+
+    def __len__(self):
+        return len(self._keyByPort)
+
+    def _set(self, ipAddress, serviceName, port):
+        """@brief Set an assignment. The caller must hold the lock.
+           @return True if the assignment changed."""
+        serviceDict = self._portDictByIP.setdefault(ipAddress, {})
+        if serviceDict.get(serviceName) == port:
+            return False
+
+        # A port is only assigned to one service.
+        oldKey = self._keyByPort.get(port)
+        if oldKey is not None:
+            oldServiceDict = self._portDictByIP[oldKey[0]]
+            del oldServiceDict[oldKey[1]]
+            if not oldServiceDict:
+                del self._portDictByIP[oldKey[0]]
+                self._removedTimeByIP.pop(oldKey[0], None)
+
+        oldPort = serviceDict.get(serviceName)
+        if oldPort is not None:
+            del self._keyByPort[oldPort]
+
+        # The old assignment may have removed the dict for this device.
+        self._portDictByIP.setdefault(ipAddress, serviceDict)[serviceName] = port
+        self._keyByPort[port] = (ipAddress, serviceName)
+        return True
+
+    def load(self):
+        """@brief Load the saved assignments.
+           @return The number of assignments loaded."""
+        if not self._filename or not os.path.isfile(self._filename):
+            return 0
+
+        with open(self._filename, 'r') as fd:
+            cacheDict = json.load(fd)
+
+        with self._lock:
+            self._portDictByIP = {}
+            self._keyByPort = {}
+            self._removedTimeByIP = {}
+            if cacheDict.get(PortAssignmentCache.LOCATION_KEY) == self._location:
+                for ipAddress, serviceDict in cacheDict.get(PortAssignmentCache.PORTS_KEY, {}).items():
+                    for serviceName, port in serviceDict.items():
+                        self._set(ipAddress, serviceName, int(port))
+                for ipAddress, removedTime in cacheDict.get(PortAssignmentCache.REMOVED_KEY, {}).items():
+                    if ipAddress in self._portDictByIP:
+                        self._removedTimeByIP[ipAddress] = float(removedTime)
+            self._changed = False
+            return len(self._keyByPort)
+
+    def save(self):
+        """@brief Save the assignments if they have changed. The file is replaced
+                  atomically so a partly written file is never loaded."""
+        if not self._filename:
+            return
+
+        with self._lock:
+            if not self._changed:
+                return
+            cacheDict = {PortAssignmentCache.LOCATION_KEY: self._location,
+                         PortAssignmentCache.PORTS_KEY: {ipAddress: dict(serviceDict) for ipAddress, serviceDict in self._portDictByIP.items()},
+                         PortAssignmentCache.REMOVED_KEY: dict(self._removedTimeByIP) }
+            self._changed = False
+
+        try:
+            tmpFilename = self._filename + ".tmp"
+            with open(tmpFilename, 'w') as fd:
+                json.dump(cacheDict, fd, separators=(',', ':'))
+            os.replace(tmpFilename, self._filename)
+
+        except:
+            with self._lock:
+                self._changed = True
+            raise
+
+    def get(self, ipAddress, serviceName):
+        """@param ipAddress The IP address of the device.
+           @param serviceName The name of the service.
+           @return The ICONS port last used for the service or None if unknown."""
+        serviceDict = self._portDictByIP.get(ipAddress)
+        if serviceDict is None:
+            return None
+        return serviceDict.get(serviceName)
+
+    def getPortList(self):
+        """@return A list of all the ICONS ports assigned."""
+        with self._lock:
+            return list(self._keyByPort.keys())
+
+    def set(self, ipAddress, serviceName, port):
+        """@brief Record the ICONS port used for a service.
+           @param ipAddress The IP address of the device.
+           @param serviceName The name of the service.
+           @param port The TCP port on the ICONS."""
+        with self._lock:
+            if self._set(ipAddress, serviceName, port):
+                self._changed = True
+            # The device is back.
+            if self._removedTimeByIP.pop(ipAddress, None) is not None:
+                self._changed = True
+
+    def remove(self, ipAddress):
+        """@brief Forget the ports used for a device.
+           @param ipAddress The IP address of the device."""
+        with self._lock:
+            self._remove(ipAddress)
+
+    def _remove(self, ipAddress):
+        """@brief Forget the ports used for a device. The caller must hold the lock."""
+        self._removedTimeByIP.pop(ipAddress, None)
+        serviceDict = self._portDictByIP.pop(ipAddress, None)
+        if serviceDict:
+            for port in serviceDict.values():
+                del self._keyByPort[port]
+            self._changed = True
+
+    def setRemoved(self, ipAddress, now=None):
+        """@brief Record that a device has been removed. Its ports are kept until
+                  they expire.
+           @param ipAddress The IP address of the device.
+           @param now The time the device was removed. If None then the time is read."""
+        if now is None:
+            now = time()
+        with self._lock:
+            if ipAddress in self._portDictByIP:
+                self._removedTimeByIP[ipAddress] = now
+                self._changed = True
+
+    def expire(self, maxSeconds, now=None):
+        """@brief Forget the ports of the devices removed more than maxSeconds ago.
+           @param maxSeconds The number of seconds the ports of a removed device are kept.
+           @param now The current time. If None then the time is read.
+           @return The number of devices forgotten."""
+        if now is None:
+            now = time()
+        with self._lock:
+            expiredIPList = [ipAddress for ipAddress, removedTime in self._removedTimeByIP.items() if now - removedTime > maxSeconds]
+            for ipAddress in expiredIPList:
+                self._remove(ipAddress)
+            return len(expiredIPList)
+
+class ReconnectBackoff(object):
+    """@brief Responsible for the delay before reconnecting to the ICONS. The delay
+              doubles after each failed attempt up to a maximum. A random part of the
+              delay is removed so that gateways that lose the ICONS at the same time
+              do not all reconnect at the same time."""
+
+    BACKOFF_FACTOR  = 2
+    JITTER_FRACTION = 0.5
+
+    def __init__(self, minDelay, maxDelay):
+        """@brief Constructor
+           @param minDelay The delay in seconds after a connection is lost.
+           @param maxDelay The maximum delay in seconds."""
+        self._minDelay = min(minDelay, maxDelay)
+        self._maxDelay = maxDelay
+        self.reset()
+
+    def reset(self):
+        """@brief Use the minimum delay for the next attempt."""
+        self._delay = self._minDelay
+
+    def getDelay(self):
+        """@return The number of seconds to wait before the next attempt."""
+        delay = self._delay*(1-ReconnectBackoff.JITTER_FRACTION*random.random())
+        self._delay = min(self._delay*ReconnectBackoff.BACKOFF_FACTOR, self._maxDelay)
+        return delay
+
+class IconsClient(object):
+
+    ICONS_RECONNECT_DELAY           = 5
+    DEFAULT_RECONNECT_MIN_DELAY     = 1
+    DEFAULT_RECONNECT_MAX_DELAY     = 60
+    MQTT_DEFAULT_KEEPALIVE_SECONDS  = 60
+    DEFAULT_HEARTBEAT_PERIOD        = 60
+
+    JSON_UNIT_NAME           = "UNIT_NAME"
+    JSON_GROUP_NAME          = "GROUP_NAME"
+    JSON_PRODUCT_ID          = "PRODUCT_ID"
+    JSON_IP_ADDRESS_KEY      = "IP_ADDRESS"
+    JSON_SERVICE_LIST        = 'SERVICE_LIST'
+    JSON_SERVER_SERVICE_LIST = 'SERVER_SERVICE_LIST'
+    JSON_LOCATION            = "LOCATION"
+    JSON_INTERFACE           = "INTERFACE"
+    JSON_OFFLINE             = "OFFLINE"
+
+    RPC_SERVER_ID            = 1
+    RPC_ID_DICT_KEY          = "RPC_ID"
+    RPC_ERROR_DICT_KEY       = "ERROR"
+    RPC_TIMEOUT_SECONDS      = 10
+
+    STAT_RPC_CALLS           = "rpc_calls"
+    STAT_RPC_TIMEOUTS        = "rpc_timeouts"
+    STAT_RPC_LATENCY         = "rpc_latency_seconds"
+    STAT_RECONNECTS          = "reconnects"
+    STAT_MQTT_CONNECTED      = "mqtt_connected"
+
+    UDP_SENDER               = None
+    UDP_SENDER_LOCK          = threading.Lock()
+
+    @staticmethod
+    def DictToJSON(aDict):
+        """@brief convert a python dictionary into JSON text
+           @param aDict The python dictionary to be converted
+           @return The JSON text representing aDict"""
+        return json.dumps(aDict)
+
+    @staticmethod
+    def JSONToDict(jsonText):
+        """@brief Convert from JSON text to a python dict. Throws a ValueError
+                  if the text is formatted incorrectly.
+           @param jsonText The JSON text to be converted to a dict
+           @return a python dict object"""
+        return json.loads(jsonText)
+
+    @staticmethod
+    def ReportException(uo, ex, debug):
+        """@brief Report an exception. If debug is set then a stack trasce is
+                  reported.
+           @param ex The exception to report"""
+        if debug:
+            lines = traceback.format_exc().splitlines()
+            for line in lines:
+                uo.error(line)
+        else:
+            uo.error( str(ex) )
+
+    @staticmethod
+    def SetNoDelay(sock):
+        """@brief Disable the Nagle algorithm on an MQTT client socket. Device state
+                  is published on the same connection that RPC requests are sent on so
+                  without this an RPC request that follows a publish is held back until
+                  the server acknowledges the publish.
+           @param sock The MQTT client socket."""
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (OSError, AttributeError):
+            pass
+
+    @staticmethod
+    def TX_UDP(theDict, addressPort):
+        """"@brief Send the service details to the remote host in a UDP packet.
+            @param theDict, The device dict
+            @param addressPort A tuple of the address and port number to send the data to."""
+        msg = IconsClient.DictToJSON(theDict)
+        IconsClient.GetUDPSender().send(msg.encode(), addressPort)
+
+    @staticmethod
+    def GetUDPSender():
+        """@return The UDPSender instance used to send all the UDP datagrams that are
+                   not sent from the device discovery sockets."""
+        with IconsClient.UDP_SENDER_LOCK:
+            if IconsClient.UDP_SENDER is None:
+                IconsClient.UDP_SENDER = UDPSender()
+            return IconsClient.UDP_SENDER
+
+    def __init__(self, uo, options):
+        """@brief Constructor
+           @param uop A UIO instance
+           @param options An options instance with the following attrs
+                  options.location = A string that describes the location of this destination client (may not start /)
+           """
+        self._uo = uo
+        self._options = options
+
+        self._deviceRegistry = DeviceRegistry()
+        self._ssh = None
+        self._sshTunnelManager = None
+        self._mqttClient = None
+        self._mqttClientConnected = False
+        self._stats = GWStats()
+        self._rpcLock = threading.Lock()
+        self._rpcSerialLock = threading.Lock()
+        self._rpcClientTopic = MQTTRPCClient.GetClientID(self._options.location)
+        self._rpcServerTopic = MQTTRPCClient.GetServerRPCTopic(idNumber=IconsClient.RPC_SERVER_ID)
+        self._nextRPCID = 1
+        self._rpcWaiterDict = {}
+        self._rpcSerialised = False
+        self._sessionConnected = False
+        self._disconnectTime = None
+
+        self._stats.setHistogram(IconsClient.STAT_RPC_LATENCY)
+        self._stats.setCallback(IconsClient.STAT_MQTT_CONNECTED, lambda: int(self._mqttClientConnected) )
+
+    def on_connect(self, client, userdata, flags, rc):
+        """@brief called on completion of the connection attempt."""
+        if rc == 0:
+            self._mqttClientConnected=True
+            self._uo.info("Connected to the MQTT server via local port %d" % (self._localMQTTPort) )
+            # RPC responses are received on the same connection that is used to publish.
+            client.subscribe(self._rpcClientTopic)
+        else:
+            self._mqttClientConnected = False
+            self._uo.error("Failed to connect to the MQTT server via local port %d (return code = %d)" % (self._localMQTTPort, rc) )
+
+        self._connectAttemptInProgress = False
+
+    def on_disconnect(self, client, userdata, rc):
+        self._uo.info("MQTT client dissconnected")
+        self._mqttClientConnected = False
+
+    def on_publish(self, client, userdata, mid):
+        """@brief called when the MQTT client has published a message."""
+        pass
+
+    def _waitForConnectSuccess(self, pollSeconds=0.5):
+        """@brief Wait for the connect attempt to succeed.
+           @param pollSeconds he poll time in seconds."""
+        while self._connectAttemptInProgress:
+            sleep(pollSeconds)
+            self._uo.info("Connecting to the MQTT server.")
+
+        if not self._mqttClientConnected:
+            raise IconsClientError("Failed to connect to MQTT server.")
+
+    def isConnected(self):
+        """@brief Get the connected status.
+           @return True if the MQTT client is connected."""
+        return self._mqttClientConnected
+
+    def _startMQTTForwarding(self):
+        """@brief Forward a local port through the ssh connection to the MQTT server."""
+        self._uo.info("Connecting to MQTT server on ssh server")
+        self._localMQTTPort = GetFreeTCPPort() #Get a free TCPIP port on the local machine
+        self._sshTunnelManager = SSHTunnelManager(self._uo, self._ssh, not self._options.no_comp )
+        self._sshTunnelManager.startFwdSSHTunnel(self._localMQTTPort, LOCALHOST, self._options.mqtt_port)
+        self._uo.info("Connecting local port %d to the %d port on the ssh server (%s:%d)" % (self._localMQTTPort, self._options.mqtt_port, self._options.server, self._options.server_port) )
+
+    def _connectToMQTTServer(self):
+        """@brief Connect to the MQTT server through an ssh tunnel. A single MQTT
+                  connection is used to publish device state and to call RPCs on the
+                  ICONS MQTT RPC provider."""
+
+        self._startMQTTForwarding()
+
+        self._uo.info("Connecting to MQTT server (port %d) on ssh server" % (self._options.mqtt_port) )
+        self._mqttClient = mqtt.Client()
+        self._mqttClient.on_connect = self.on_connect
+        self._mqttClient.on_disconnect = self.on_disconnect
+        self._mqttClient.on_message = self._onRPCMessage
+        self._mqttClient.on_publish = self.on_publish
+        self._mqttClient.on_socket_open = self._onMQTTSocketOpen
         self._connectAttemptInProgress = True
         self._mqttClient.connect(LOCALHOST, self._localMQTTPort, self._options.keepalive)
         _thread.start_new_thread( self._mqttClient.loop_forever, () )
         self._waitForConnectSuccess()
 
-        self._uo.info("Connecting to MQTT RPC server (port %d) on ssh server" % (self._localMQTTPort) )
-        options = RPCCallerOptions(LOCALHOST, self._localMQTTPort, IconsClient.RPC_SERVER_ID, self._options.location, self._options.keepalive)
-        self._mqttRPCCallerClient = MQTTRPCCallerClient(self._uo, options)
-        self._mqttRPCCallerClient.connect()
-        _thread.start_new_thread( self._mqttRPCCallerClient.loopForever, () )
-        # PJA Not sure this is needed
-        #self._mqttRPCCallerClient.waitForConnectSuccess() 
+    def _onMQTTSocketOpen(self, client, userdata, sock):
+        IconsClient.SetNoDelay(sock)
+
+    def _getRPCMsgDict(self, methodName, argList):
+        """@brief Get the message to send to the ICONS MQTT RPC provider to call an RPC.
+                  The provider returns the message with the response added so the
+                  RPC ID in the message identifies the RPC that a response belongs to.
+           @param methodName The name of the RPC.
+           @param argList The arguments for the RPC.
+           @return A tuple containing the RPC ID and the message dict."""
+        with self._rpcLock:
+            rpcID = self._nextRPCID
+            self._nextRPCID = self._nextRPCID + 1
+        msgDict = {MQTTRPCClient.CLIENT_ID_DICT_KEY: self._rpcClientTopic,
+                   MQTTRPCClient.METHOD_DICT_KEY:    methodName,
+                   MQTTRPCClient.ARGS_DICT_KEY:      argList,
+                   IconsClient.RPC_ID_DICT_KEY:      rpcID}
+        return (rpcID, msgDict)
+
+    def _onRPCMessage(self, client, userdata, msg):
+        """@brief Called when a message is received on the RPC client topic."""
+        try:
+            responseDict = IconsClient.JSONToDict( msg.payload.decode() )
+
+        except ValueError:
+            self._uo.error("Invalid RPC response received: %s" % (str(msg.payload)) )
+            return
+
+        if isinstance(responseDict, dict):
+            if IconsClient.RPC_ERROR_DICT_KEY in responseDict:
+                # The provider does not know the RPC or it failed.
+                response = IconsRPCError("%s RPC error: %s" % (responseDict.get(MQTTRPCClient.METHOD_DICT_KEY), responseDict[IconsClient.RPC_ERROR_DICT_KEY]) )
+
+            elif MQTTRPCClient.RESPONSE_DICT_KEY in responseDict:
+                response = responseDict[MQTTRPCClient.RESPONSE_DICT_KEY]
+
+            else:
+                return
+
+            rpcID = responseDict.get(IconsClient.RPC_ID_DICT_KEY)
+            if rpcID is None and not self._rpcSerialised:
+                # The provider does not return the RPC ID so only one RPC may be
+                # in progress at a time from now on.
+                self._uo.warn("The ICONS MQTT RPC provider does not return RPC IDs. RPCs will be serialised.")
+                self._rpcSerialised = True
+            self._rpcResponseReceived(rpcID, response)
+
+    def _rpcResponseReceived(self, rpcID, response):
+        """@brief Pass an RPC response to the thread waiting for it.
+           @param rpcID The ID of the RPC or None if the response did not include it.
+                  In this case the response is passed to the oldest RPC in progress.
+           @param response The RPC response or an IconsRPCError if the provider returned an error."""
+        with self._rpcLock:
+            if rpcID is None and self._rpcWaiterDict:
+                rpcID = min(self._rpcWaiterDict)
+            waiter = self._rpcWaiterDict.pop(rpcID, None)
+        if waiter:
+            waiter.setResponse(response)
+
+    def _callRPC(self, methodName, argList):
+        """@brief Call an RPC on the ICONS MQTT RPC provider and wait for the response.
+           @param methodName The name of the RPC.
+           @param argList The arguments for the RPC.
+           @return The response to the RPC or None if no response was received.
+           @raise IconsRPCError If the provider does not know the RPC or it failed."""
+        self._stats.incr(IconsClient.STAT_RPC_CALLS)
+        rpcID, msgDict = self._getRPCMsgDict(methodName, argList)
+        waiter = RPCResponseWaiter()
+        with self._rpcLock:
+            self._rpcWaiterDict[rpcID] = waiter
+        try:
+            startTime = time()
+            self._mqttClient.publish(self._rpcServerTopic, IconsClient.DictToJSON(msgDict))
+            response = waiter.wait(IconsClient.RPC_TIMEOUT_SECONDS)
+            self._rpcCalled(response, startTime)
+            if isinstance(response, IconsRPCError):
+                raise response
+            return response
+
+        finally:
+            with self._rpcLock:
+                self._rpcWaiterDict.pop(rpcID, None)
+
+    def _rpcCalled(self, response, startTime):
+        """@brief Record the time taken by an RPC.
+           @param response The response to the RPC or None if no response was received.
+           @param startTime The time the RPC request was sent."""
+        if response is None:
+            self._stats.incr(IconsClient.STAT_RPC_TIMEOUTS)
+        else:
+            self._stats.observe(IconsClient.STAT_RPC_LATENCY, time()-startTime)
+
+    def _rpcCall(self, methodName, argList):
+        """@brief Call an RPC on the ICONS MQTT RPC provider. RPCs may be called from
+                  multiple threads at the same time unless the provider does not return
+                  the RPC ID in which case they are serialised.
+           @param methodName The name of the RPC.
+           @param argList The arguments for the RPC.
+           @return The response to the RPC or None if no response was received.
+           @raise IconsRPCError If the provider does not know the RPC or it failed."""
+        if self._rpcSerialised:
+            with self._rpcSerialLock:
+                return self._callRPC(methodName, argList)
+        return self._callRPC(methodName, argList)
 
     def _startServerWithException(self):
         """@brief Called to connect to the ssh server running the ICONS MQTT server.
@@ -769,11 +2896,9 @@ class IconsClient(object):
             self._mqttClient.disconnect()
             self._mqttClient = None
 
-        if self._mqttRPCCallerClient:
-            self._mqttRPCCallerClient._client.disconnect()
-            self._mqttRPCCallerClient = None
-
-        self._knownDeviceList       = []
+        # The known devices are restored when the connection is restored.
+        if not self._options.fast_reconnect:
+            self._deviceRegistry.clear()
 
         if self._sshTunnelManager:
             self._sshTunnelManager.stopAllSSHTunnels()
@@ -810,7 +2935,9 @@ class IconsClient(object):
 
     def runClientConnection(self):
         """@brief Called to connect to the server and handle all responses from it."""
+        reconnectBackoff = ReconnectBackoff(self._options.reconnect_min_delay, self._options.reconnect_max_delay)
         while True:
+            self._sessionConnected = False
             try:
 
                 self._startServerWithException()
@@ -831,13 +2958,79 @@ class IconsClient(object):
                 else:
                     self._uo.error(ex)
 
-            self._uo.error("Waiting %d seconds before attempting to reconnect to ICON server." % (IconsClient.ICONS_RECONNECT_DELAY) )
-            sleep(IconsClient.ICONS_RECONNECT_DELAY)
+            # Retry quickly after losing a working connection.
+            if self._sessionConnected:
+                reconnectBackoff.reset()
+                self._disconnectTime = time()
+
+            self._stats.incr(IconsClient.STAT_RECONNECTS)
+            if self._options.fast_reconnect:
+                reconnectDelay = reconnectBackoff.getDelay()
+            else:
+                reconnectDelay = IconsClient.ICONS_RECONNECT_DELAY
+            self._uo.error("Waiting %.1f seconds before attempting to reconnect to ICON server." % (reconnectDelay) )
+            sleep(reconnectDelay)
 
 
 class IconsGW(IconsClient):
 
     UDP_RX_BUFFER_SIZE       = 2048
+    DEFAULT_RX_SOCKET_BUFFER = 1048576
+    PROC_NET_SNMP            = "/proc/net/snmp"
+    RX_SELECT_TIMEOUT        = 1
+
+    STAT_PUBLISH_SENT        = "publish_sent"
+    STAT_PUBLISH_SUPPRESSED  = "publish_suppressed"
+    STAT_TUNNELS_STARTED     = "tunnels_started"
+    STAT_TUNNEL_SETUP_ERRORS = "tunnel_setup_errors"
+    STAT_DEVICES_PENDING     = "devices_pending"
+    STAT_RX_DATAGRAMS        = "rx_datagrams"
+    STAT_RX_QUEUE_DEPTH      = "rx_queue_depth"
+    STAT_RX_QUEUE_DROPS      = "rx_queue_drops"
+    STAT_RX_QUEUE_COALESCED  = "rx_queue_coalesced"
+    STAT_RX_PROCESS_LATENCY  = "rx_process_latency_seconds"
+    STAT_AYT_POLL_PERIOD     = "ayt_poll_period_seconds"
+    STAT_AYT_POLLS           = "ayt_polls"
+    STAT_TUNNELS_ACTIVE      = "tunnels_active"
+    STAT_TUNNELS_RECLAIMED   = "tunnels_reclaimed"
+    STAT_PORTS_LEAKED        = "ports_leaked"
+    STAT_DEVICES_REAPED      = "devices_reaped"
+    STAT_PORT_LEASES_LOST    = "port_leases_lost"
+    STAT_PUBLISH_QUEUE_DEPTH = "publish_queue_depth"
+    STAT_PUBLISH_QUEUE_DROPS = "publish_queue_drops"
+    STAT_PUBLISH_COALESCED   = "publish_coalesced"
+    STAT_PUBLISH_IN_FLIGHT   = "publish_in_flight"
+    STAT_PUBLISH_LATENCY     = "publish_latency_seconds"
+    STAT_RECONNECT_SECONDS   = "reconnect_seconds"
+    STAT_DNS_LOOKUPS         = "dns_lookups"
+    STAT_DNS_LOOKUP_ERRORS   = "dns_lookup_errors"
+    STAT_UDP_TX_DATAGRAMS    = "udp_tx_datagrams"
+    STAT_UDP_TX_BYTES        = "udp_tx_bytes"
+    STAT_UDP_TX_SYSCALLS     = "udp_tx_syscalls"
+    STAT_UDP_TX_ERRORS       = "udp_tx_errors"
+    STAT_RX_SYSCALLS         = "rx_syscalls"
+    STAT_UDP_RX_BUFFER_ERRORS= "udp_rx_buffer_errors"
+    STAT_RX_AYT_ECHOES       = "rx_ayt_echoes"
+    STAT_RX_AYT              = "rx_ayt"
+    STAT_RX_JUNK             = "rx_junk"
+    STAT_RX_DEV_RESPONSES    = "rx_dev_responses"
+    STAT_AYT_SENT            = "ayt_sent"
+    STAT_DEVICES_KNOWN       = "devices_known"
+
+    # The types of the datagrams received on the device discovery sockets.
+    RX_AYT                   = 1
+    RX_JUNK                  = 2
+    RX_CANDIDATE             = 3
+    # A JSON object starts with { after any whitespace.
+    JSON_START_BYTES         = b"{ \t\r\n"
+
+    DEFAULT_TUNNEL_WORKERS   = 8
+    DEFAULT_RX_WORKERS       = 1
+    DEFAULT_DEV_MISSED_POLLS = 3
+
+    ENGINE_THREAD            = "thread"
+    ENGINE_ASYNCIO           = "asyncio"
+    ENGINE_LIST              = (ENGINE_THREAD, ENGINE_ASYNCIO)
 
     def __init__(self, uo, options):
         """@brief Constructor
@@ -848,7 +3041,61 @@ class IconsGW(IconsClient):
         IconsClient.__init__(self, uo, options)
 
         self._shutdownServer        = False
-        self._knownDeviceList       = []
+        self._deviceRegistry        = DeviceRegistry()
+        self._publishChangeFilter   = PublishChangeFilter(self._options.heartbeat_period)
+        self._serverPortAllocator   = None
+        self._tunnelExecutor        = None
+        self._tunnelLock            = threading.Lock()
+        self._deviceLock            = threading.Lock()
+        self._pendingDevIPSet       = set()
+        self._rxQueueList           = []
+        self._rxWorkerList          = []
+        self._discoveryNetworkList  = []
+        self._aytScheduler          = AYTScheduler(self._options.dev_poll_min_period, self._options.dev_poll_period)
+        self._reapLock              = threading.Lock()
+        portCacheFile = self._options.port_cache
+        if portCacheFile is None:
+            portCacheFile = IconsGWConfig.GetConfigFile(PortAssignmentCache.FILENAME)
+        self._portAssignmentCache   = PortAssignmentCache(portCacheFile, self._options.location)
+        retainText = self._options.publish_retain
+        if not self._options.no_retain:
+            # Device state (LOCATION/UNIT_NAME) is retained so that a new subscriber receives
+            # the state of every device at once. Other messages (E.G stats) are not.
+            retainText = "%s/+,%s" % (self._getValidTopic(self._options.location), retainText)
+        self._publishTopicOptions   = PublishTopicOptions(self._options.publish_qos, retainText, self._options.compact_topics)
+        self._publishQueue          = PublishQueue(self._options.publish_queue_size, self._options.publish_max_inflight, self._publishTopicOptions)
+        self._restoreIPSet          = set()
+        self._hostAddressCache      = HostAddressCache(self._options.dns_ttl)
+        self._servicesLock          = threading.Lock()
+        self._servicesMTime         = None
+        self._serviceConfigList     = []
+        self._servicesAddressList   = None
+        self._servicesPayloadList   = []
+        self._aytMsgBytes           = AreYouThereThread.GetAYTMsgBytes(self._options.ayt_msg)
+        self._localAddressSet       = frozenset( (LOCALHOST_IP,) )
+
+        self._stats.setCallback(IconsGW.STAT_RX_QUEUE_DEPTH, lambda: sum( [len(rxQueue) for rxQueue in self._rxQueueList] ) )
+        self._stats.setCallback(IconsGW.STAT_RX_QUEUE_DROPS, lambda: sum( [rxQueue.dropCount for rxQueue in self._rxQueueList] ), isCounter=True)
+        self._stats.setCallback(IconsGW.STAT_RX_QUEUE_COALESCED, lambda: sum( [rxQueue.coalesceCount for rxQueue in self._rxQueueList] ), isCounter=True)
+        self._stats.setCallback(IconsGW.STAT_AYT_POLL_PERIOD, lambda: self._aytScheduler.period)
+        self._stats.setCallback(IconsGW.STAT_AYT_POLLS, lambda: self._aytScheduler.pollCount, isCounter=True)
+        self._stats.setCallback(IconsGW.STAT_AYT_SENT, lambda: self._aytScheduler.sentCount, isCounter=True)
+        self._stats.setCallback(IconsGW.STAT_DEVICES_KNOWN, lambda: len(self._deviceRegistry) )
+        self._stats.setCallback(IconsGW.STAT_TUNNELS_ACTIVE, self._deviceRegistry.getServerPortCount)
+        self._stats.setCallback(IconsGW.STAT_PUBLISH_QUEUE_DEPTH, lambda: len(self._publishQueue) )
+        self._stats.setCallback(IconsGW.STAT_PUBLISH_QUEUE_DROPS, lambda: self._publishQueue.dropCount, isCounter=True)
+        self._stats.setCallback(IconsGW.STAT_PUBLISH_COALESCED, lambda: self._publishQueue.coalesceCount, isCounter=True)
+        self._stats.setCallback(IconsGW.STAT_PUBLISH_IN_FLIGHT, lambda: self._publishQueue.inFlightCount)
+        self._stats.setCallback(IconsGW.STAT_DNS_LOOKUPS, lambda: self._hostAddressCache.lookupCount, isCounter=True)
+        self._stats.setCallback(IconsGW.STAT_DNS_LOOKUP_ERRORS, lambda: self._hostAddressCache.lookupErrorCount, isCounter=True)
+        udpSender = IconsClient.GetUDPSender()
+        self._stats.setCallback(IconsGW.STAT_UDP_TX_DATAGRAMS, lambda: udpSender.datagramCount, isCounter=True)
+        self._stats.setCallback(IconsGW.STAT_UDP_TX_BYTES, lambda: udpSender.byteCount, isCounter=True)
+        self._stats.setCallback(IconsGW.STAT_UDP_TX_SYSCALLS, lambda: udpSender.syscallCount, isCounter=True)
+        self._stats.setCallback(IconsGW.STAT_UDP_TX_ERRORS, lambda: udpSender.errorCount, isCounter=True)
+        self._stats.setCallback(IconsGW.STAT_UDP_RX_BUFFER_ERRORS, IconsGW.GetUDPRxBufferErrors, isCounter=True)
+        self._stats.setHistogram(IconsGW.STAT_PUBLISH_LATENCY)
+        self._stats.setHistogram(IconsGW.STAT_RX_PROCESS_LATENCY)
 
         self._user = getpass.getuser()
 
@@ -867,7 +3114,19 @@ class IconsGW(IconsClient):
         if not self._options.private_key:
             raise IconsGWError("Please configure a private ssh key file and try again.")
 
-        self.runClientConnection()
+        self._loadPortAssignmentCache()
+
+        metricsServer = None
+        if self._options.metrics_port > 0:
+            metricsServer = MetricsServer(self._uo, self._stats, self._options.metrics_address, self._options.metrics_port)
+            metricsServer.start()
+
+        try:
+            self.runClientConnection()
+
+        finally:
+            if metricsServer:
+                metricsServer.shutDown()
 
     def _handleConnection(self):
         """@brief Discover devices on the local LAN.
@@ -878,31 +3137,314 @@ class IconsGW(IconsClient):
                     - Send a command to remove it from the list that the ICON server is aware of
                     - shutdown the associated ssh port forwarding connection"""
         sock                = None
+        sockDict            = {}
         areYouThereThread   = None
+        statsReporter       = None
         try:
-            #Open UDP socket to be used for discovering devices
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            sock.bind(('', AreYouThereThread.UDP_DEV_DISCOVERY_PORT))
+            if self._options.stats_period > 0:
+                statsReporter = StatsReporter(self._uo, self._stats, self._options.stats_period, self._publishStats if self._options.stats_topic else None)
+                statsReporter.start()
+
+            self._serverPortAllocator = ServerPortAllocator(self._rpcCall, self._options.port_batch_size, self._options.location)
+            self._startTunnelWorkers()
+            self._aytScheduler.reset()
+            self._claimCachedPorts()
+            self._restoreDevices()
+
+            self._discoveryNetworkList = self._getDiscoveryNetworkList()
+            self._updateLocalAddressSet()
+            sock = self._openDevDiscoverySocket()
+            sockDict = self._openInterfaceSockets(self._discoveryNetworkList)
 
             #Start the thread that sends AYT messages to elicit device responses
-            areYouThereThread = AreYouThereThread(self._uo, sock, self._options)
+            areYouThereThread = AreYouThereThread(self._uo, sock, self._options, sockDict, self._discoveryNetworksChanged, self._aytScheduler, self._devicesPolled)
             areYouThereThread.start()
 
-            self._listenForDevResponses(sock)
+            self._listenForDevResponses(sock, sockDict)
 
         finally:
 
+            self._stopTunnelWorkers()
+            self._savePortAssignmentCache()
+
+            if statsReporter:
+                statsReporter.shutDown()
+                statsReporter = None
+
             if areYouThereThread:
                 areYouThereThread.shutDown()
                 areYouThereThread = None
 
+            for ifSock in sockDict.values():
+                ifSock.close()
+
             if sock:
                 sock.close()
                 sock=None
                 self._uo.info("Closed UDP device discovery socket.")
 
+    def _loadPortAssignmentCache(self):
+        """@brief Load the ICONS ports used by devices before the icons_gw was restarted."""
+        try:
+            portCount = self._portAssignmentCache.load()
+            if portCount > 0:
+                self._uo.info("Loaded %d ICONS port assignments." % (portCount) )
+
+        except (OSError, ValueError) as ex:
+            self._uo.warn("Failed to load the ICONS port assignments: %s" % (str(ex)) )
+
+    def _savePortAssignmentCache(self):
+        """@brief Save the ICONS ports used by devices if they have changed."""
+        try:
+            self._portAssignmentCache.save()
+
+        except OSError as ex:
+            self._uo.warn("Failed to save the ICONS port assignments: %s" % (str(ex)) )
+
+    def _claimCachedPorts(self):
+        """@brief Lease the ICONS ports that devices used before the icons_gw reconnected
+                  or restarted so that the devices keep the same ports."""
+        portSet = set( self._portAssignmentCache.getPortList() )
+        for devDict in self._deviceRegistry.getDevList():
+            portSet.update( DeviceRegistry.GetServerPortList(devDict) )
+        if portSet:
+            claimedList = self._serverPortAllocator.claimPorts( list(portSet) )
+            self._uo.info("Claimed %d of %d previously used ICONS ports." % (len(claimedList), len(portSet)) )
+
+    def _restoreDevices(self):
+        """@brief Called when the connection to the ICONS is made. Messages that could not
+                  be published are sent and, if --fast_reconnect is set, the devices known
+                  before the connection was lost are added again without waiting for them
+                  to respond. Their reverse ssh tunnels are setup on the tunnel workers."""
+        self._sessionConnected = True
+        self._flushPendingPublishes()
+
+        devList = self._deviceRegistry.getDevList()
+        with self._deviceLock:
+            self._restoreIPSet = set( [devDict[IconsGW.JSON_IP_ADDRESS_KEY] for devDict in devList] )
+            for devDict in devList:
+                self._deviceRegistry.remove(devDict[IconsGW.JSON_IP_ADDRESS_KEY])
+                self._pendingDevIPSet.add(devDict[IconsGW.JSON_IP_ADDRESS_KEY])
+            self._stats.set(IconsGW.STAT_DEVICES_PENDING, len(self._pendingDevIPSet))
+
+        if not devList:
+            self._fullServiceRestored()
+            return
+
+        self._uo.info("Restoring the reverse ssh tunnels of %d devices." % (len(devList)) )
+        for devDict in devList:
+            devDict = dict(devDict)
+            # The ports used before are preferred when the tunnels are setup.
+            devDict.pop(IconsGW.JSON_SERVER_SERVICE_LIST, None)
+            self._startAddDevice(devDict)
+
+    def _fullServiceRestored(self):
+        """@brief Called when all the devices known before the connection to the ICONS
+                  was lost have been restored."""
+        if self._disconnectTime is not None:
+            reconnectSeconds = time()-self._disconnectTime
+            self._stats.observe(IconsGW.STAT_RECONNECT_SECONDS, reconnectSeconds)
+            self._uo.info("Full service restored %.1f seconds after the ICONS connection was lost." % (reconnectSeconds) )
+            self._disconnectTime = None
+
+    def _publish(self, topic, payload):
+        """@brief Queue a message to be published to the ICONS MQTT server. If the
+                  message cannot be sent it is held and sent when the connection is
+                  restored. Only the last message for each topic is held.
+           @param topic The MQTT topic.
+           @param payload The message text.
+           @return True if the message was queued, False if the queue was full."""
+        if not self._publishQueue.put(topic, payload):
+            return False
+
+        self._publishQueued()
+        return True
+
+    def _publishQueued(self):
+        """@brief Hand the queued messages to the MQTT client."""
+        mqttClient = self._mqttClient
+        if mqttClient is not None and self._mqttClientConnected:
+            self._publishQueue.publish(mqttClient, self._publishLatency)
+
+    def _publishStats(self, statsText):
+        """@brief Publish the icons_gw stats.
+           @param statsText The JSON text of the stats."""
+        self._publish(self._options.stats_topic, statsText)
+
+    def _publishLatency(self, latency):
+        """@brief Record the time from a message being queued to being published.
+           @param latency The latency in seconds."""
+        self._stats.observe(IconsGW.STAT_PUBLISH_LATENCY, latency)
+
+    def on_publish(self, client, userdata, mid):
+        """@brief Called when the MQTT client has sent a message (QOS 0) or it has been
+                  acknowledged (QOS 1 and 2). Queued messages are then handed to the
+                  MQTT client in its place."""
+        latency = self._publishQueue.published(mid)
+        if latency is not None:
+            self._publishLatency(latency)
+            self._publishQueued()
+
+    def _flushPendingPublishes(self):
+        """@brief Send the messages that could not be published while the connection
+                  to the ICONS was down."""
+        self._publishQueue.resetInFlight()
+        if len(self._publishQueue) > 0:
+            self._uo.info("Publishing %d held messages." % (len(self._publishQueue)) )
+        self._publishQueued()
+
+    def _getDiscoveryNetworkList(self):
+        """@return The DiscoveryNetwork instances for the local networks on which devices are discovered."""
+        if self._options.no_lan:
+            return []
+        return AreYouThereThread.GetDiscoveryNetworkList(self._options.net_if)
+
+    def _discoveryNetworksChanged(self, networkList):
+        """@brief Called when the local networks on which devices are discovered change.
+           @param networkList The DiscoveryNetwork instances."""
+        self._discoveryNetworkList = networkList
+        self._updateLocalAddressSet()
+
+    def _updateLocalAddressSet(self):
+        """@brief Read the addresses of all the local network interfaces. The AYT
+                  messages we send are received back from these addresses."""
+        addressSet = set( (LOCALHOST_IP,) )
+        try:
+            for ipList in NetIF().getIFDict(readNow=True).values():
+                for elem in ipList:
+                    addressSet.add( elem.split("/")[0] )
+
+        except Exception as ex:
+            self._uo.warn("Unable to read the local interface addresses: %s" % (str(ex)) )
+
+        self._localAddressSet = frozenset(addressSet)
+
+    def _getDatagramType(self, rxData):
+        """@brief Classify a datagram received on a device discovery socket without parsing it.
+                  Our own AYT messages are received back as the device discovery socket is
+                  bound to the port they are broadcast on. These and anything that cannot be
+                  a JSON object are identified from the bytes so that only candidate device
+                  responses are parsed.
+           @param rxData The datagram bytes (a bytes or memoryview instance).
+           @return IconsGW.RX_AYT, IconsGW.RX_JUNK or IconsGW.RX_CANDIDATE."""
+        if rxData == self._aytMsgBytes:
+            return IconsGW.RX_AYT
+        if len(rxData) == 0 or rxData[0] not in IconsGW.JSON_START_BYTES:
+            return IconsGW.RX_JUNK
+        return IconsGW.RX_CANDIDATE
+
+    def _openInterfaceSockets(self, networkList):
+        """@brief Open a UDP socket bound to the local interface address on each of the
+                  configured discovery networks. AYT messages for a network are sent
+                  from its socket so that device responses are received on it. If
+                  devices are discovered on all interfaces then no sockets are opened.
+           @param networkList The DiscoveryNetwork instances.
+           @return A dict of sockets indexed by local interface address."""
+        sockDict = {}
+        if self._options.no_lan or AreYouThereThread.IsAllInterfaces(self._options.net_if):
+            return sockDict
+
+        for network in networkList:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                IconsGW.SetRxSocketBuffer(sock, self._options.rx_socket_buffer)
+                sock.bind((network.ipAddress, AreYouThereThread.UDP_DEV_DISCOVERY_PORT))
+                sockDict[network.ipAddress] = sock
+                self._uo.info("Discovering devices on %s" % (str(network)) )
+
+            except OSError as ex:
+                sock.close()
+                self._uo.warn("Unable to open a UDP socket on %s: %s" % (str(network), str(ex)) )
+
+        return sockDict
+
+    def _getDevIFName(self, ipAddress, rxIFName=None):
+        """@brief Get the name of the local interface that a device was discovered on.
+           @param ipAddress The source address of the device message.
+           @param rxIFName The name of the interface the device message was received on if known.
+           @return The interface name or None if not known."""
+        if rxIFName:
+            return rxIFName
+
+        for network in self._discoveryNetworkList:
+            if network.contains(ipAddress):
+                return network.ifName
+
+        return None
+
+    def _getIFNameByAddress(self, ipAddress):
+        """@param ipAddress A local interface address.
+           @return The name of the interface with the address or None if not found."""
+        for network in self._discoveryNetworkList:
+            if network.ipAddress == ipAddress:
+                return network.ifName
+        return None
+
+    def _openDevDiscoverySocket(self):
+        """@brief Open the UDP socket to be used for discovering devices.
+           @return The socket instance."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        IconsGW.SetRxSocketBuffer(sock, self._options.rx_socket_buffer)
+        sock.bind(('', AreYouThereThread.UDP_DEV_DISCOVERY_PORT))
+        return sock
+
+    @staticmethod
+    def SetRxSocketBuffer(sock, bufferSize):
+        """@brief Set the size of the receive buffer of a socket. This holds the device
+                  responses that arrive in a burst until they are read. The OS may limit
+                  the size (E.G net.core.rmem_max on Linux).
+           @param sock The socket.
+           @param bufferSize The buffer size in bytes. If 0 the OS default is used."""
+        if bufferSize > 0:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, bufferSize)
+
+    @staticmethod
+    def GetUDPRxBufferErrors():
+        """@return The number of UDP datagrams that the kernel dropped because a socket
+                   receive buffer was full (for all sockets on this machine) or 0 if not
+                   known (Linux only)."""
+        try:
+            with open(IconsGW.PROC_NET_SNMP, "r") as fd:
+                udpLineList = [line.split() for line in fd if line.startswith("Udp:")]
+
+            if len(udpLineList) >= 2:
+                return int( udpLineList[1][ udpLineList[0].index("RcvbufErrors") ] )
+
+        except (OSError, ValueError):
+            pass
+
+        return 0
+
+    def _shutDown(self):
+        """@brief shutdown all connection used by the client."""
+        IconsClient._shutDown(self)
+        with self._deviceLock:
+            self._pendingDevIPSet = set()
+            self._restoreIPSet = set()
+
+        # Restored devices are only published again if they have changed.
+        if not self._options.fast_reconnect:
+            # All devices must be published again on the next connection.
+            self._publishChangeFilter.clear()
+            self._publishQueue.clear()
+
+    def _startTunnelWorkers(self):
+        """@brief Start the threads that setup the reverse ssh tunnels for new devices.
+                  If --tunnel_workers is 0 then tunnels are setup on the thread that
+                  processes the device responses."""
+        if self._options.tunnel_workers > 0:
+            self._tunnelExecutor = ThreadPoolExecutor(max_workers=self._options.tunnel_workers, thread_name_prefix="tunnel")
+
+    def _stopTunnelWorkers(self):
+        """@brief Stop the tunnel setup threads. Tunnel setups not yet started are abandoned."""
+        if self._tunnelExecutor:
+            self._tunnelExecutor.shutdown(wait=False, cancel_futures=True)
+            self._tunnelExecutor = None
+
     def _isValidDevice(self, devDict):
         """@brief Determine if the device is valid.
            @param devDict The dictionary of the devices parameters."""
@@ -911,24 +3453,17 @@ class IconsGW(IconsClient):
         return False
 
     def _getKnownDevDict(self, localIPAddress):
-        """@brief Get a known device dict from the know dev dict or return None
+        """@brief Get a known device dict from the device registry or return None
                   if unknown.
            @param localIPAddress The local IP address"""
-        for knownDev in self._knownDeviceList:
-            if knownDev[IconsGW.JSON_IP_ADDRESS_KEY] == localIPAddress:
-                return knownDev
-        return None
+        return self._deviceRegistry.get(localIPAddress)
 
     def _isKnownDevice(self, devDict):
         """@brief Determine if we know about this device
            @param devDict The dictionary of the devices parameters
            @return True if the ssh TCP reverse forwarding server has been setup
                    for this device, False if not."""
-        isKnownDev = False
-        if self._getKnownDevDict(devDict[IconsGW.JSON_IP_ADDRESS_KEY]):
-            isKnownDev = True
-
-        return isKnownDev
+        return devDict[IconsGW.JSON_IP_ADDRESS_KEY] in self._deviceRegistry
 
     def _serverServiceListCountChanged(self, devDict):
         """@brief Determine if this the number of services provided by this dest client has changed.
@@ -966,10 +3501,16 @@ class IconsGW(IconsClient):
             serviceStr = "%s,%s:%d" % (serviceStr, serviceName, servicePort)
             rxDict[keyName]=serviceStr
 
-    def _getFreeServerPort(self):
-        """@brief Get a free server TCP port
-           @return The free TCP port number"""
-        return self._mqttRPCCallerClient.rpcCall("getFreeTCPPort", "")
+    def _startRevSSHTunnel(self, serverPort, destHost, destPort):
+        """@brief Start a reverse ssh tunnel. The ssh transport only allows one port
+                  forwarding request to be in progress at a time so requests from the
+                  tunnel workers are serialised.
+           @param serverPort The TCP port on the ICONS.
+           @param destHost The address of the device.
+           @param destPort The TCP port of the service on the device."""
+        with self._tunnelLock:
+            self._sshTunnelManager.startRevSSHTunnel(serverPort, destHost, destPort)
+        self._stats.incr(IconsGW.STAT_TUNNELS_STARTED)
 
     def _setupDeviceReverseForwarding(self, devDict):
         """@brief Setup an ssh reverse port forwarding connection.
@@ -977,31 +3518,88 @@ class IconsGW(IconsClient):
 
         #The device dict must have a service list
         if IconsGW.JSON_SERVICE_LIST in devDict:
+            serviceTupleList = []
             serviceList = devDict[IconsGW.JSON_SERVICE_LIST].split(',')
             for service in serviceList:
                 elems = service.split(':')
                 #If incorrectly formatted service ignore it.
                 if len(elems) != 2:
                     continue
-                serviceName = elems[0]
-                servicePortStr = elems[1]
                 try:
-                    servicePort = int(servicePortStr)
+                    serviceTupleList.append( (elems[0], int(elems[1])) )
 
-                    #Obtain a free port on the ICONS server`
-                    freeServerTCPPort = self._getFreeServerPort()
-                    if not freeServerTCPPort:
-                        raise IconsGWError("Failed to get an available TCPIP port. Check MQTT RPC server is running.")
+                except ValueError:
+                    pass
 
-                    #Use it for a TCP server on the SSH server (reverse forwarded to the local network)
-                    self._sshTunnelManager.startRevSSHTunnel(freeServerTCPPort, devDict[IconsGW.JSON_IP_ADDRESS_KEY], servicePort)
+            if serviceTupleList:
+                #Obtain the free ports on the ICONS server for all the services in one go.
+                #Use the ports the device had before the icons_gw reconnected if possible.
+                ipAddress = devDict[IconsGW.JSON_IP_ADDRESS_KEY]
+                preferredPortList = [self._portAssignmentCache.get(ipAddress, serviceName) for serviceName, _ in serviceTupleList]
+                freeServerTCPPortList = self._serverPortAllocator.getPorts( len(serviceTupleList), preferredPortList )
 
-                    self._updateServiceList(devDict, serviceName, freeServerTCPPort, server=True)
+                startedPortList = []
+                tunnelFailed = False
+                try:
+                    for (serviceName, servicePort), freeServerTCPPort in zip(serviceTupleList, freeServerTCPPortList):
+                        #Use it for a TCP server on the SSH server (reverse forwarded to the local network)
+                        tunnelFailed = True
+                        self._startRevSSHTunnel(freeServerTCPPort, devDict[IconsGW.JSON_IP_ADDRESS_KEY], servicePort)
+                        tunnelFailed = False
+                        startedPortList.append(freeServerTCPPort)
+
+                        self._updateServiceList(devDict, serviceName, freeServerTCPPort, server=True)
+                        self._portAssignmentCache.set(ipAddress, serviceName, freeServerTCPPort)
+
+                except:
+                    # Don't leak the ports if all the tunnels could not be setup. The port a
+                    # tunnel failed on is probably in use on the ICONS so it is not reused.
+                    self._releaseServerPorts(startedPortList)
+                    unusedPortIndex = len(startedPortList)+1 if tunnelFailed else len(startedPortList)
+                    self._serverPortAllocator.releasePorts(freeServerTCPPortList[unusedPortIndex:])
+                    raise
+
+        self._deviceRegistry.add(devDict)
+        self._deviceRegistry.touch(devDict[IconsGW.JSON_IP_ADDRESS_KEY])
+
+    def _addDevice(self, devDict):
+        """@brief Setup the reverse ssh tunnels for a new device and publish its state.
+                  This is called on a tunnel worker thread if tunnel workers are enabled.
+           @param devDict The dictionary of the devices parameters."""
+        try:
+            self._setupDeviceReverseForwarding(devDict)
+            self._publishDevDict(devDict)
 
-                except ValueError:
-                    pass
+        except Exception as ex:
+            self._stats.incr(IconsGW.STAT_TUNNEL_SETUP_ERRORS)
+            IconsClient.ReportException(self._uo, ex, self._options.debug)
 
-        self._knownDeviceList.append(devDict)
+        finally:
+            self._removePendingDevice(devDict)
+
+    def _removePendingDevice(self, devDict):
+        """@brief Called when we have finished adding a device.
+           @param devDict The dictionary of the devices parameters."""
+        ipAddress = devDict[IconsGW.JSON_IP_ADDRESS_KEY]
+        restored = False
+        with self._deviceLock:
+            self._pendingDevIPSet.discard(ipAddress)
+            self._stats.set(IconsGW.STAT_DEVICES_PENDING, len(self._pendingDevIPSet))
+            if ipAddress in self._restoreIPSet:
+                self._restoreIPSet.discard(ipAddress)
+                restored = not self._restoreIPSet
+
+        if restored:
+            self._fullServiceRestored()
+
+    def _startAddDevice(self, devDict):
+        """@brief Start adding a new device. If tunnel workers are enabled the device
+                  is added on a tunnel worker thread, else it is added before returning.
+           @param devDict The dictionary of the devices parameters."""
+        if self._tunnelExecutor:
+            self._tunnelExecutor.submit(self._addDevice, devDict)
+        else:
+            self._addDevice(devDict)
 
     def _updateServerPorts(self, devDict):
         """@brief Update the server port in the devDict as server port/s should
@@ -1015,41 +3613,160 @@ class IconsGW(IconsClient):
             if IconsGW.JSON_SERVER_SERVICE_LIST in knownDevDict:
                 devDict[IconsGW.JSON_SERVER_SERVICE_LIST] = knownDevDict[IconsGW.JSON_SERVER_SERVICE_LIST]
 
+    def _stopRevSSHTunnel(self, serverPort):
+        """@brief Stop a reverse ssh tunnel and ask the ssh server to stop listening
+                  on its port. paramiko's cancel_port_forward() is not used as it
+                  removes the handler for all the other reverse tunnels.
+           @param serverPort The TCP port on the ICONS.
+           @return True if the ssh server stopped listening on the port."""
+        with self._tunnelLock:
+            self._sshTunnelManager.stopRevSSHTunnel(serverPort)
+            transport = self._ssh.getTransport() if self._ssh else None
+            if transport is None or not transport.is_active():
+                return False
+            return transport.global_request("cancel-tcpip-forward", ("", serverPort), wait=True) is not None
+
+    def _releaseServerPorts(self, serverPortList):
+        """@brief Stop the reverse ssh tunnels on ICONS server ports and return the
+                  ports to the port allocator.
+           @param serverPortList A list of TCP ports on the ICONS."""
+        releasedPortList = []
+        for serverPort in serverPortList:
+            try:
+                released = self._stopRevSSHTunnel(serverPort)
+
+            except Exception as ex:
+                IconsClient.ReportException(self._uo, ex, self._options.debug)
+                released = False
+
+            if released:
+                releasedPortList.append(serverPort)
+                self._stats.incr(IconsGW.STAT_TUNNELS_RECLAIMED)
+            else:
+                self._uo.warn("Failed to release ICONS port %d." % (serverPort) )
+                self._stats.incr(IconsGW.STAT_PORTS_LEAKED)
+
+        if releasedPortList and self._serverPortAllocator:
+            self._serverPortAllocator.releasePorts(releasedPortList)
+
     def _shutdownRevSSHTunnel(self, devDict):
         """@brief shutdown the reverse SSH tunnel
            @param devDict The dictionary of the devices parameters."""
+        self._releaseServerPorts( DeviceRegistry.GetServerPortList(devDict) )
+
+    def _startShutdownRevSSHTunnel(self, devDict):
+        """@brief Start stopping the reverse ssh tunnels of a device. If tunnel workers
+                  are enabled this is done on a tunnel worker thread.
+           @param devDict The known device dict holding the ICONS ports of the device."""
+        if self._tunnelExecutor:
+            self._tunnelExecutor.submit(self._shutdownRevSSHTunnel, devDict)
+        else:
+            self._shutdownRevSSHTunnel(devDict)
+
+    def _devicesPolled(self):
+        """@brief Called after each AYT message is sent. Devices that have stopped
+                  responding are removed and the ICONS port leases are renewed when due."""
+        if self._options.dev_missed_polls > 0 and self._deviceRegistry.getMissingDevList(self._getMissingDevSeconds()):
+            self._startReapMissingDevices()
+
+        if self._serverPortAllocator and self._serverPortAllocator.isRenewDue():
+            self._startRenewPortLeases()
+
+        self._portAssignmentCache.expire(self._options.port_cache_expiry)
+        self._savePortAssignmentCache()
+
+    def _getMissingDevSeconds(self):
+        """@return The number of seconds a device may not respond for before it is removed.
+                   This is based on the maximum poll period so that devices are not removed
+                   sooner while the poll period is short because the devices are changing."""
+        return self._options.dev_missed_polls*self._options.dev_poll_period
+
+    def _startRenewPortLeases(self):
+        """@brief Start renewing the ICONS port leases. If tunnel workers are enabled
+                  this is done on a tunnel worker thread."""
+        if self._tunnelExecutor:
+            self._tunnelExecutor.submit(self._renewPortLeases)
+        else:
+            self._renewPortLeases()
 
-        #The device dict must have a service list
-        if IconsGW.JSON_SERVER_SERVICE_LIST in devDict:
-            serviceList = devDict[IconsGW.JSON_SERVER_SERVICE_LIST].split(',')
-            for service in serviceList:
-                serviceName, serverServicePortStr = service.split(':')
-                try:
-                    serverServicePort = int(serverServicePortStr)
-                    self._sshTunnelManager.stopRevSSHTunnel(serverServicePort)
+    def _renewPortLeases(self):
+        """@brief Renew the ICONS port leases."""
+        try:
+            lostPortList = self._serverPortAllocator.renewLeases()
+            self._stats.incr(IconsGW.STAT_PORT_LEASES_LOST, len(lostPortList))
+            for serverPort in lostPortList:
+                self._uo.warn("Lost the lease of ICONS port %d." % (serverPort) )
+
+        except Exception as ex:
+            IconsClient.ReportException(self._uo, ex, self._options.debug)
+
+    def _startReapMissingDevices(self):
+        """@brief Start removing the devices that have stopped responding. If tunnel
+                  workers are enabled this is done on a tunnel worker thread."""
+        if self._tunnelExecutor:
+            self._tunnelExecutor.submit(self._removeMissingDevices)
+        else:
+            self._removeMissingDevices()
 
-                except ValueError:
-                    pass
+    def _removeMissingDevices(self):
+        """@brief Remove the devices that have stopped responding and publish an
+                  offline message for each."""
+        try:
+            for devDict in self._reapMissingDevices():
+                self._publishOfflineDevDict(devDict)
+
+        except Exception as ex:
+            IconsClient.ReportException(self._uo, ex, self._options.debug)
+
+    def _reapMissingDevices(self):
+        """@brief Remove the devices that have not responded for --dev_missed_polls
+                  maximum poll periods. Their reverse ssh tunnels are stopped and the
+                  ICONS ports are released. The ports are kept in the port cache until
+                  it expires so that a device that restarts gets the same ports if
+                  they are still free.
+           @return A list of the device dicts removed."""
+        reapedDevList = []
+        # Only one thread reaps at a time, others have nothing to do.
+        if not self._reapLock.acquire(blocking=False):
+            return reapedDevList
+        try:
+            missingSeconds = self._getMissingDevSeconds()
+            for devDict in self._deviceRegistry.getMissingDevList(missingSeconds):
+                ipAddress = devDict[IconsGW.JSON_IP_ADDRESS_KEY]
+                with self._deviceLock:
+                    # The device may have responded since the list was read.
+                    if not self._deviceRegistry.isMissing(ipAddress, missingSeconds):
+                        continue
+                    lastSeen = self._deviceRegistry.getLastSeen(ipAddress)
+                    self._deviceRegistry.remove(ipAddress)
+
+                self._uo.info("%s (%s) not seen for %.1f seconds, removing it." % (devDict.get(IconsGW.JSON_UNIT_NAME, ""), ipAddress, time()-lastSeen) )
+                self._shutdownRevSSHTunnel(devDict)
+                self._portAssignmentCache.setRemoved(ipAddress)
+                self._publishChangeFilter.forget(ipAddress)
+                self._stats.incr(IconsGW.STAT_DEVICES_REAPED)
+                reapedDevList.append(devDict)
 
-    def _removeKnownDev(self, devDict):
-        """@brief Remove a device from the known devices list if present.
-           @param devDict A dict of device data sent by the device to the
-                  icons gateway."""
-        indexToDelete = -1
-        index = 0
+        finally:
+            self._reapLock.release()
 
-        if self._isValidDevice(devDict):
-            devIPAddress = devDict[IconsClient.JSON_IP_ADDRESS_KEY]
-            for knownDev in self._knownDeviceList:
-                if IconsClient.JSON_IP_ADDRESS_KEY in knownDev:
-                    if devIPAddress == knownDev[IconsClient.JSON_IP_ADDRESS_KEY]:
-                        indexToDelete=index
-                        break
-                index=index+1
+        return reapedDevList
 
-            if indexToDelete >= 0:
-                self._uo.debug("Removing from known device list: %s" % (devDict))
-                del self._knownDeviceList[indexToDelete]
+    def _publishOfflineDevDict(self, devDict):
+        """@brief Publish that a device is no longer available. Only the unit name,
+                  location and OFFLINE are published. The ICONS ports of the device
+                  have been released so they are not included.
+           @param devDict The dictionary of the devices parameters."""
+        unitName = devDict.get(IconsGW.JSON_UNIT_NAME, "")
+        offlineDevDict = {IconsGW.JSON_UNIT_NAME:      unitName,
+                          IconsClient.JSON_LOCATION:   self._options.location,
+                          IconsGW.JSON_OFFLINE:        True}
+        mqttTopic = self._getValidTopic( "%s/%s" % (self._options.location, unitName) )
+        self._publish(mqttTopic, self._getDevStatePayload(mqttTopic, offlineDevDict))
+        if not self._options.no_retain:
+            # Subscribers that connect later are not sent the state of the device.
+            self._publishQueue.clearRetained(mqttTopic)
+            self._publishQueued()
 
     def _getValidTopic(self, topic):
         """@brief Check the topic is valid and remove invalid characters.
@@ -1081,28 +3798,84 @@ class IconsGW(IconsClient):
                     if productID == "WyTerm" and devDict[IconsGW.JSON_SERVICE_LIST].find("WYTERM_SERIAL_PORT") == -1:
                         devDict[IconsGW.JSON_SERVICE_LIST]=devDict[IconsGW.JSON_SERVICE_LIST]+",WYTERM_SERIAL_PORT:23"
 
-            if not self._isKnownDevice(devDict):
+            with self._deviceLock:
+                ipAddress = devDict[IconsGW.JSON_IP_ADDRESS_KEY]
+                self._aytScheduler.deviceSeen(ipAddress)
 
-                self._setupDeviceReverseForwarding(devDict)
+                #If the tunnels for this device are being setup it will be published once they are.
+                if ipAddress in self._pendingDevIPSet:
+                    return
 
-            elif self._serverServiceListCountChanged(devDict):
+                if not self._isKnownDevice(devDict):
 
-                self._shutdownRevSSHTunnel(devDict)
-                self._removeKnownDev(devDict)
+                    self._pendingDevIPSet.add(ipAddress)
+                    self._stats.set(IconsGW.STAT_DEVICES_PENDING, len(self._pendingDevIPSet))
+                    addDevice = True
+
+                else:
+                    addDevice = False
+
+            if addDevice:
+                self._aytScheduler.changed()
+                self._startAddDevice(devDict)
+                return
+
+            self._deviceRegistry.touch(ipAddress)
+
+            if self._serverServiceListCountChanged(devDict):
+
+                self._aytScheduler.changed()
+                # The ICONS ports are held in the known device dict, not in the device response.
+                with self._deviceLock:
+                    knownDevDict = self._deviceRegistry.remove(ipAddress)
+                if knownDevDict:
+                    self._uo.debug("Removing from known device list: %s" % (knownDevDict))
+                    self._portAssignmentCache.remove(ipAddress)
+                    self._publishChangeFilter.forget(ipAddress)
+                    self._startShutdownRevSSHTunnel(knownDevDict)
 
             self._updateServerPorts(devDict)
 
-            unitName=""
-            if "UNIT_NAME" in devDict:
-                unitName=devDict["UNIT_NAME"]
-            mqttTopic = "%s/%s" % (self._options.location, unitName)
+            self._publishDevDict(devDict)
+
+    def _publishDevDict(self, devDict):
+        """@brief Publish the state of a device to the ICONS MQTT server.
+           @param devDict A dict of device data sent by the device to the
+                  icons gateway."""
+        unitName=""
+        if "UNIT_NAME" in devDict:
+            unitName=devDict["UNIT_NAME"]
+        mqttTopic = "%s/%s" % (self._options.location, unitName)
 
-            devDict[IconsClient.JSON_LOCATION]= self._options.location
-            json = IconsClient.DictToJSON(devDict)
+        devDict[IconsClient.JSON_LOCATION]= self._options.location
+        json = IconsClient.DictToJSON(devDict)
 
+        # Only publish if the device state has changed or the heartbeat period has elapsed.
+        if self._publishChangeFilter.isPublishRequired(devDict[IconsGW.JSON_IP_ADDRESS_KEY], json):
             mqttTopic = self._getValidTopic(mqttTopic)
 
-            self._mqttClient.publish(mqttTopic, json)
+            if self._publish(mqttTopic, self._getDevStatePayload(mqttTopic, devDict, json)):
+                self._stats.incr(IconsGW.STAT_PUBLISH_SENT)
+            else:
+                # Publish the state from the next response.
+                self._publishChangeFilter.forget(devDict[IconsGW.JSON_IP_ADDRESS_KEY])
+
+        else:
+            self._stats.incr(IconsGW.STAT_PUBLISH_SUPPRESSED)
+
+    def _getDevStatePayload(self, mqttTopic, devDict, jsonText=None):
+        """@brief Get the message that carries the state of a device in the encoding
+                  configured for the topic.
+           @param mqttTopic The MQTT topic the state is published on.
+           @param devDict The device dict.
+           @param jsonText The device dict as JSON text if already encoded.
+           @return The message text (JSON) or bytes (compact encoding)."""
+        if self._publishTopicOptions.isCompact(mqttTopic):
+            return DevStateCodec.EncodeCompact(devDict)
+
+        if jsonText is None:
+            jsonText = IconsClient.DictToJSON(devDict)
+        return jsonText
 
     def _getServiceDevDict(self, serviceDeviceList, ipAddress):
         """@brief Get the deviceDict object that has the given IP address
@@ -1129,7 +3902,8 @@ class IconsGW(IconsClient):
             if groupName == IconsGWConfig.DEFAULT_GROUP_NAME:
                 groupName=""
 
-            serviceDevDict = self._getServiceDevDict(serviceDeviceList, socket.gethostbyname(service.host))
+            ipAddress = self._hostAddressCache.get(service.host)
+            serviceDevDict = self._getServiceDevDict(serviceDeviceList, ipAddress)
 
             if not serviceDevDict:
 
@@ -1137,7 +3911,7 @@ class IconsGW(IconsClient):
                 serviceDevDict[IconsGW.JSON_UNIT_NAME] = service.host
                 serviceDevDict[IconsGW.JSON_GROUP_NAME] = groupName
                 serviceDevDict[IconsGW.JSON_PRODUCT_ID] = service.deviceType
-                serviceDevDict[IconsGW.JSON_IP_ADDRESS_KEY] = socket.gethostbyname(service.host)
+                serviceDevDict[IconsGW.JSON_IP_ADDRESS_KEY] = ipAddress
                 self._updateServiceList(serviceDevDict, service.serviceName, service.port)
                 serviceDeviceList.append(serviceDevDict)
 
@@ -1151,50 +3925,172 @@ class IconsGW(IconsClient):
                   This message details the locally configured services. These are typically
                   fixed address servers on this machine or the local network broadcast domain.
            @param addressPort A tuple of the IP address and port from which the AYT message was recieved."""
-        self._serviceConfigList = ServiceConfigurator.GetServiceList()
-        if len(self._serviceConfigList) > 0:
-            serviceDeviceList = self._getServiceDeviceList(self._serviceConfigList)
-            for serviceDevice in serviceDeviceList:
-                IconsGW.TX_UDP(serviceDevice, addressPort)
+        payloadList = self._getServicesPayloadList()
+        if len(payloadList) > 0:
+            IconsClient.GetUDPSender().sendBatch(payloadList, addressPort)
+
+    def _getServicesPayloadList(self):
+        """@brief Get the services response messages. The service config file is only
+                  read again when its modified time changes and the messages are only
+                  built again when the config or the address of a service host changes.
+           @return A list of the message bytes."""
+        try:
+            mTime = os.stat( ServiceConfigurator.GetConfigFile() ).st_mtime
+
+        except OSError:
+            mTime = None
+
+        with self._servicesLock:
+            if mTime != self._servicesMTime:
+                self._serviceConfigList = ServiceConfigurator.GetServiceList()
+                self._servicesMTime = mTime
+                self._servicesAddressList = None
+
+            addressList = [self._hostAddressCache.get(service.host) for service in self._serviceConfigList]
+            if addressList != self._servicesAddressList:
+                serviceDeviceList = self._getServiceDeviceList(self._serviceConfigList)
+                self._servicesPayloadList = [IconsClient.DictToJSON(serviceDevice).encode() for serviceDevice in serviceDeviceList]
+                self._servicesAddressList = addressList
+
+            return self._servicesPayloadList
+
+    def _startDevResponseWorkers(self):
+        """@brief Start the threads that process the datagrams received from devices.
+                  Each worker has its own queue and datagrams are allocated to a queue
+                  by source address so that the datagrams from a device are processed
+                  in the order they were received."""
+        workerCount = max(self._options.rx_workers, 1)
+        queueSize = max(self._options.rx_queue_size//workerCount, 1)
+        self._rxQueueList = [DeviceResponseQueue(queueSize) for _ in range(0, workerCount)]
+        self._rxWorkerList = []
+        for rxQueue in self._rxQueueList:
+            rxWorker = threading.Thread(target=self._processDevResponses, args=(rxQueue,))
+            rxWorker.setDaemon(True)
+            rxWorker.start()
+            self._rxWorkerList.append(rxWorker)
+
+    def _stopDevResponseWorkers(self):
+        """@brief Stop the threads that process the datagrams received from devices."""
+        for rxQueue in self._rxQueueList:
+            rxQueue.close()
+        for rxWorker in self._rxWorkerList:
+            rxWorker.join()
+        self._rxWorkerList = []
+
+    def _processDevResponses(self, rxQueue):
+        """@brief Process the datagrams received from devices until the queue is closed.
+           @param rxQueue The DeviceResponseQueue instance to read datagrams from."""
+        while True:
+            entry = rxQueue.get()
+            if entry is None:
+                break
 
-    def _listenForDevResponses(self, sock):
-        """@brief Listen for the UDP JSON messages sent by devices in response
-                  to the discovery messages and add these responses to a queue.
-           @param sock The socket to listen for UDP device response messages."""
+            rxData, addressPort, rxTime, ifName = entry
+            try:
+                self._handleDevResponse(rxData, addressPort, ifName)
 
-        self._uo.info("Listening on UDP port %d" % (AreYouThereThread.UDP_DEV_DISCOVERY_PORT) )
-        try:
-            while self.isConnected():
+            except Exception as ex:
+                IconsClient.ReportException(self._uo, ex, self._options.debug)
 
-                rxData, addressPort = sock.recvfrom(IconsGW.UDP_RX_BUFFER_SIZE)
+            self._stats.observe(IconsGW.STAT_RX_PROCESS_LATENCY, time()-rxTime)
 
+    def _handleDevResponse(self, rxData, addressPort, ifName=None):
+        """@brief Handle a datagram received on the device discovery socket.
+           @param rxData The datagram bytes.
+           @param addressPort The source address and port of the datagram.
+           @param ifName The name of the interface the datagram was received on if known."""
+
+        if self._options.debug:
+            self._uo.debug("%s: DEVICE RX DATA: %s" % (str(addressPort), rxData.decode("utf-8", "replace")))
+
+        rxType = self._getDatagramType(rxData)
+        # If weve received an AYT message then send response. Our own AYT messages are
+        # answered as this is how the configured services are added to our registry.
+        if rxType == IconsGW.RX_AYT:
+            if addressPort[0] in self._localAddressSet:
+                self._stats.incr(IconsGW.STAT_RX_AYT_ECHOES)
+            else:
+                self._stats.incr(IconsGW.STAT_RX_AYT)
+            self._sendServicesResponse(addressPort)
+
+        elif rxType == IconsGW.RX_JUNK:
+            self._stats.incr(IconsGW.STAT_RX_JUNK)
+
+        else:
+            rxDict = None
+            #Try/except so that non json data can't crash the server
+            try:
                 #Convert bytes received to a string instance
                 rxData = rxData.decode("utf-8")
+                rxDict = IconsGW.JSONToDict(rxData)
 
-                if self._options.debug:
-                    self._uo.debug("%s: DEVICE RX DATA: %s" % (str(addressPort), rxData))
+            except ValueError:
+                self._uo.error("Non JSON data received from %s: %s" % (str(addressPort), str(rxData) ) )
+
+            if not isinstance(rxDict, dict):
+                self._stats.incr(IconsGW.STAT_RX_JUNK)
 
-                # If weve received an AYT message then send response.
-                if AreYouThereThread.IsAYTMsg(rxData, self._options.ayt_msg):
+            # An AYT message that is not formatted as we format them (E.G from another gateway).
+            elif "AYT" in rxDict:
+                if rxDict["AYT"] == self._options.ayt_msg:
+                    self._stats.incr(IconsGW.STAT_RX_AYT)
                     self._sendServicesResponse(addressPort)
 
-                else:
-                    rxDict = None
-                    #Try/except so that non json data can't crash the server
-                    try:
-                        rxDict = IconsGW.JSONToDict(rxData)
-                        self._uo.info("Valid JSON data received from %s: %s" % (str(addressPort), str(rxData) ) )
+            else:
+                self._stats.incr(IconsGW.STAT_RX_DEV_RESPONSES)
+                self._uo.info("Valid JSON data received from %s: %s" % (str(addressPort), str(rxData) ) )
+                # Tag the device with the local interface it was discovered on.
+                devIFName = self._getDevIFName(addressPort[0], ifName)
+                if devIFName:
+                    rxDict[IconsGW.JSON_INTERFACE] = devIFName
 
-                    except ValueError:
-                        self._uo.error("Non JSON data received from %s: %s" % (str(addressPort), str(rxData) ) )
+                self._processDevDict(rxDict)
 
-                    if rxDict:
-                        self._processDevDict(rxDict)
+    def _listenForDevResponses(self, sock, sockDict=None):
+        """@brief Listen for the UDP JSON messages sent by devices in response
+                  to the discovery messages and add these responses to a queue.
+                  The responses are processed by the device response workers so that
+                  slow processing does not stop datagrams being read from the socket.
+           @param sock The socket to listen for UDP device response messages.
+           @param sockDict A dict of the sockets bound to local interface addresses
+                  (indexed by address) to also listen on."""
+
+        self._uo.info("Listening on UDP port %d" % (AreYouThereThread.UDP_DEV_DISCOVERY_PORT) )
+        selector = selectors.DefaultSelector()
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, None)
+        if sockDict:
+            for ipAddress, ifSock in sockDict.items():
+                ifSock.setblocking(False)
+                selector.register(ifSock, selectors.EVENT_READ, self._getIFNameByAddress(ipAddress))
+
+        receiver = DatagramReceiver(IconsGW.UDP_RX_BUFFER_SIZE, self._options.rx_batch_size)
+        self._startDevResponseWorkers()
+        try:
+            while self.isConnected():
+
+                for key, _ in selector.select(IconsGW.RX_SELECT_TIMEOUT):
+                    datagramList = receiver.read(key.fileobj)
+                    rxTime = time()
+                    self._stats.incr(IconsGW.STAT_RX_DATAGRAMS, len(datagramList))
+                    self._stats.incr(IconsGW.STAT_RX_SYSCALLS)
+
+                    for rxData, addressPort in datagramList:
+                        # Junk is dropped here so that it is not copied and queued.
+                        if self._getDatagramType(rxData) == IconsGW.RX_JUNK:
+                            self._stats.incr(IconsGW.STAT_RX_JUNK)
+                            continue
+                        rxQueue = self._rxQueueList[ hash(addressPort[0]) % len(self._rxQueueList) ]
+                        rxQueue.put(rxData.tobytes(), addressPort, rxTime, key.data)
 
         except:
             self._uo.info("Shutdown device listener (MQTT client connected = %d)" % (self.isConnected()) )
             self._uo.errorException()
 
+        finally:
+            selector.close()
+            self._stopDevResponseWorkers()
+
         self._uo.info("Stopped listening for device responses.")
 
     def enableAutoStart(self, user):
@@ -1227,28 +4123,524 @@ class IconsGW(IconsClient):
                 self._uo.info(line)
         
 
+class AsyncMQTTClientLoop(object):
+    """@brief Services the network traffic of a paho MQTT client from an asyncio event
+              loop rather than from a thread running the clients loop_forever() method."""
+
+    MISC_PERIOD_SECONDS = 1
+
+    def __init__(self, loop, client):
+        """@brief Constructor. This must be called before the client connects.
+           @param loop The asyncio event loop.
+           @param client The paho MQTT client instance."""
+        self._loop = loop
+        self._client = client
+        self._sock = None
+        self._miscTask = None
+        self._closedEvent = asyncio.Event()
+        client.on_socket_open = self._onSocketOpen
+        client.on_socket_close = self._onSocketClose
+        client.on_socket_register_write = self._onSocketRegisterWrite
+        client.on_socket_unregister_write = self._onSocketUnregisterWrite
+
+    def _onSocketOpen(self, client, userdata, sock):
+        IconsClient.SetNoDelay(sock)
+        self._sock = sock
+        self._closedEvent.clear()
+        self._loop.add_reader(sock, client.loop_read)
+        self._miscTask = self._loop.create_task(self._miscLoop())
+
+    def _onSocketClose(self, client, userdata, sock):
+        self._removeSocket()
+        self._closedEvent.set()
+
+    def _onSocketRegisterWrite(self, client, userdata, sock):
+        self._loop.add_writer(sock, client.loop_write)
+
+    def _onSocketUnregisterWrite(self, client, userdata, sock):
+        self._loop.remove_writer(sock)
+
+    async def _miscLoop(self):
+        """@brief Handle the MQTT keepalive and retries."""
+        while self._client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(AsyncMQTTClientLoop.MISC_PERIOD_SECONDS)
+
+    def _removeSocket(self):
+        """@brief Stop servicing the clients socket."""
+        if self._sock:
+            self._loop.remove_reader(self._sock)
+            self._loop.remove_writer(self._sock)
+            self._sock = None
+
+        if self._miscTask:
+            self._miscTask.cancel()
+            self._miscTask = None
+
+    async def waitClosed(self, timeout):
+        """@brief Wait for the clients socket to close.
+           @param timeout The maximum time to wait in seconds."""
+        if self._sock:
+            try:
+                await asyncio.wait_for(self._closedEvent.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def detach(self):
+        """@brief Stop servicing the client. This must be called before the event loop is closed."""
+        self._removeSocket()
+        self._client.on_socket_open = None
+        self._client.on_socket_close = None
+        self._client.on_socket_register_write = None
+        self._client.on_socket_unregister_write = None
+
+class DevResponseProtocol(asyncio.DatagramProtocol):
+    """@brief Passes the datagrams received on the device discovery socket to an AsyncIconsGW."""
+
+    def __init__(self, iconsGW, ifName=None):
+        """@brief Constructor
+           @param iconsGW The AsyncIconsGW instance.
+           @param ifName The name of the interface the socket is bound to or None if bound to all interfaces."""
+        self._iconsGW = iconsGW
+        self._ifName = ifName
+
+    def datagram_received(self, data, addr):
+        self._iconsGW._datagramReceived(data, addr, self._ifName)
+
+    def error_received(self, exc):
+        self._iconsGW._uo.error("Device discovery socket error: %s" % (str(exc)) )
+
+class AsyncIconsGW(IconsGW):
+    """@brief An icons_gw that services the MQTT connection, the device discovery socket
+              and the AYT messages from a single asyncio event loop rather than from a
+              thread each. Device messages are processed as they are received. Work that
+              blocks (reverse ssh tunnel setup, service host lookups) is run on executor
+              threads."""
+
+    CONNECT_TIMEOUT_SECONDS  = 10
+    CLOSE_TIMEOUT_SECONDS    = 1
+
+    def __init__(self, uo, options):
+        """@brief Constructor
+           @param uop A UIO instance
+           @param options An options instance with the following attrs
+                  options.location = A string that describes the location of this destination client (may not start /)
+           """
+        IconsGW.__init__(self, uo, options)
+
+        self._loop                  = None
+        self._disconnectedEvent     = None
+        self._rpcAsyncLock          = None
+        self._rpcFutureDict         = {}
+        self._connectFutureDict     = {}
+        self._mqttClientLoop        = None
+        self._taskSet               = set()
+
+    def _connectToMQTTServer(self):
+        """@brief Forward a local port to the MQTT server and create the MQTT client
+                  that is used to publish device state and to call RPCs. The client
+                  connects once the event loop is running."""
+        self._startMQTTForwarding()
+
+        self._mqttClient = mqtt.Client()
+        self._mqttClient.on_connect = self.on_connect
+        self._mqttClient.on_disconnect = self.on_disconnect
+        self._mqttClient.on_message = self._onRPCMessage
+        self._mqttClient.on_publish = self.on_publish
+
+    def on_connect(self, client, userdata, flags, rc):
+        """@brief called on completion of the connection attempt."""
+        IconsGW.on_connect(self, client, userdata, flags, rc)
+
+        connectFuture = self._connectFutureDict.pop(client, None)
+        if connectFuture and not connectFuture.done():
+            connectFuture.set_result(rc)
+
+    def on_disconnect(self, client, userdata, rc):
+        IconsGW.on_disconnect(self, client, userdata, rc)
+        if self._disconnectedEvent:
+            self._disconnectedEvent.set()
+
+    async def _connectMQTTClient(self, client):
+        """@brief Connect an MQTT client to the MQTT server.
+           @param client The paho MQTT client instance."""
+        connectFuture = self._loop.create_future()
+        self._connectFutureDict[client] = connectFuture
+        client.connect(LOCALHOST, self._localMQTTPort, self._options.keepalive)
+        try:
+            rc = await asyncio.wait_for(connectFuture, AsyncIconsGW.CONNECT_TIMEOUT_SECONDS)
+
+        except asyncio.TimeoutError:
+            raise IconsClientError("Timeout connecting to MQTT server.")
+
+        if rc != 0:
+            raise IconsClientError("Failed to connect to MQTT server.")
+
+    def _rpcResponseReceived(self, rpcID, response):
+        """@brief Pass an RPC response to the task waiting for it. This is called
+                  from the event loop.
+           @param rpcID The ID of the RPC or None if the response did not include it.
+                  In this case the response is passed to the oldest RPC in progress.
+           @param response The RPC response or an IconsRPCError if the provider returned an error."""
+        if rpcID is None and self._rpcFutureDict:
+            rpcID = min(self._rpcFutureDict)
+        rpcResponseFuture = self._rpcFutureDict.pop(rpcID, None)
+        if rpcResponseFuture and not rpcResponseFuture.done():
+            rpcResponseFuture.set_result(response)
+
+    async def _callRPCAsync(self, methodName, argList):
+        """@brief Call an RPC on the ICONS MQTT RPC provider and wait for the response.
+           @param methodName The name of the RPC.
+           @param argList The arguments for the RPC.
+           @return The response to the RPC or None if no response was received.
+           @raise IconsRPCError If the provider does not know the RPC or it failed."""
+        self._stats.incr(IconsClient.STAT_RPC_CALLS)
+        rpcID, msgDict = self._getRPCMsgDict(methodName, argList)
+        rpcResponseFuture = self._loop.create_future()
+        self._rpcFutureDict[rpcID] = rpcResponseFuture
+        startTime = time()
+        try:
+            self._mqttClient.publish(self._rpcServerTopic, IconsClient.DictToJSON(msgDict))
+            response = await asyncio.wait_for(rpcResponseFuture, IconsClient.RPC_TIMEOUT_SECONDS)
+
+        except asyncio.TimeoutError:
+            response = None
+
+        finally:
+            self._rpcFutureDict.pop(rpcID, None)
+
+        self._rpcCalled(response, startTime)
+        if isinstance(response, IconsRPCError):
+            raise response
+        return response
+
+    async def _rpcCallAsync(self, methodName, argList):
+        """@brief Call an RPC on the ICONS MQTT RPC provider. Many RPCs may be in
+                  progress at a time unless the provider does not return the RPC ID
+                  in which case they are serialised.
+           @param methodName The name of the RPC.
+           @param argList The arguments for the RPC.
+           @return The response to the RPC or None if no response was received.
+           @raise IconsRPCError If the provider does not know the RPC or it failed."""
+        if self._rpcSerialised:
+            async with self._rpcAsyncLock:
+                return await self._callRPCAsync(methodName, argList)
+        return await self._callRPCAsync(methodName, argList)
+
+    def _publishStats(self, statsText):
+        """@brief Publish the icons_gw stats from the event loop. The stats are not
+                  published while no session is running.
+           @param statsText The JSON text of the stats."""
+        loop = self._loop
+        if loop is not None and loop.is_running():
+            loop.call_soon_threadsafe(IconsGW._publishStats, self, statsText)
+
+    def _rpcCall(self, methodName, argList):
+        """@brief Call an RPC from an executor thread.
+           @param methodName The name of the RPC.
+           @param argList The arguments for the RPC.
+           @return The response to the RPC or None if no response was received.
+           @raise IconsRPCError If the provider does not know the RPC or it failed."""
+        future = asyncio.run_coroutine_threadsafe(self._rpcCallAsync(methodName, argList), self._loop)
+        return future.result(IconsClient.RPC_TIMEOUT_SECONDS*2)
+
+    def _startTask(self, coro):
+        """@brief Run a coroutine as a task that is cancelled when the session ends.
+           @param coro The coroutine."""
+        task = self._loop.create_task(coro)
+        self._taskSet.add(task)
+        task.add_done_callback(self._taskSet.discard)
+        return task
+
+    async def _cancelTasks(self):
+        """@brief Cancel all the tasks started by _startTask()."""
+        taskList = list(self._taskSet)
+        for task in taskList:
+            task.cancel()
+        await asyncio.gather(*taskList, return_exceptions=True)
+
+    def _startAddDevice(self, devDict):
+        """@brief Start adding a new device. The reverse ssh tunnels are setup on
+                  an executor thread.
+           @param devDict The dictionary of the devices parameters."""
+        self._startTask( self._addDeviceAsync(devDict) )
+
+    async def _addDeviceAsync(self, devDict):
+        """@brief Setup the reverse ssh tunnels for a new device and publish its state.
+           @param devDict The dictionary of the devices parameters."""
+        try:
+            await self._loop.run_in_executor(self._tunnelExecutor, self._setupDeviceReverseForwarding, devDict)
+            self._publishDevDict(devDict)
+
+        except Exception as ex:
+            self._stats.incr(IconsGW.STAT_TUNNEL_SETUP_ERRORS)
+            IconsClient.ReportException(self._uo, ex, self._options.debug)
+
+        finally:
+            self._removePendingDevice(devDict)
+
+    def _startReapMissingDevices(self):
+        """@brief Start removing the devices that have stopped responding. The reverse
+                  ssh tunnels are stopped on an executor thread."""
+        self._startTask( self._removeMissingDevicesAsync() )
+
+    async def _removeMissingDevicesAsync(self):
+        """@brief Remove the devices that have stopped responding and publish an
+                  offline message for each."""
+        try:
+            reapedDevList = await self._loop.run_in_executor(self._tunnelExecutor, self._reapMissingDevices)
+            for devDict in reapedDevList:
+                self._publishOfflineDevDict(devDict)
+
+        except Exception as ex:
+            IconsClient.ReportException(self._uo, ex, self._options.debug)
+
+    def _startShutdownRevSSHTunnel(self, devDict):
+        """@brief Start stopping the reverse ssh tunnels of a device on an executor thread.
+           @param devDict The known device dict holding the ICONS ports of the device."""
+        self._startTask( self._shutdownRevSSHTunnelAsync(devDict) )
+
+    async def _shutdownRevSSHTunnelAsync(self, devDict):
+        """@brief Stop the reverse ssh tunnels of a device.
+           @param devDict The known device dict holding the ICONS ports of the device."""
+        await self._loop.run_in_executor(self._tunnelExecutor, self._shutdownRevSSHTunnel, devDict)
+
+    def _startRenewPortLeases(self):
+        """@brief Start renewing the ICONS port leases on an executor thread."""
+        self._startTask( self._renewPortLeasesAsync() )
+
+    async def _renewPortLeasesAsync(self):
+        """@brief Renew the ICONS port leases."""
+        await self._loop.run_in_executor(self._tunnelExecutor, self._renewPortLeases)
+
+    def _sendServicesResponse(self, addressPort):
+        """@brief Send a services response message from an executor thread as
+                  the service hosts may need to be looked up.
+           @param addressPort A tuple of the IP address and port from which the AYT message was recieved."""
+        self._startTask( self._sendServicesResponseAsync(addressPort) )
+
+    async def _sendServicesResponseAsync(self, addressPort):
+        try:
+            await self._loop.run_in_executor(None, IconsGW._sendServicesResponse, self, addressPort)
+
+        except Exception as ex:
+            IconsClient.ReportException(self._uo, ex, self._options.debug)
+
+    def _datagramReceived(self, rxData, addressPort, ifName=None):
+        """@brief Called on the event loop when a datagram is received on a device discovery socket.
+           @param rxData The datagram bytes.
+           @param addressPort The source address and port of the datagram.
+           @param ifName The name of the interface the datagram was received on if known."""
+        self._stats.incr(IconsGW.STAT_RX_DATAGRAMS)
+        try:
+            self._handleDevResponse(rxData, addressPort, ifName)
+
+        except Exception as ex:
+            IconsClient.ReportException(self._uo, ex, self._options.debug)
+
+    async def _sendAYTMessages(self, transport, transportDict):
+        """@brief Periodically send AYT messages to elicit device responses. The
+                  destination addresses are updated and an AYT message is sent
+                  immediately if the local network interfaces change.
+           @param transport The device discovery socket transport.
+           @param transportDict The transports of the sockets bound to local interface
+                  addresses indexed by address."""
+        self._uo.info("Started sending AYT messages")
+        aytMsgBytes = self._aytMsgBytes
+        destList = AreYouThereThread.GetDestList(self._options, self._discoveryNetworkList)
+        wakeEvent = asyncio.Event()
+        interfaceWatcher = None
+        # Changes may be detected on the tunnel setup threads.
+        self._aytScheduler.setWakeCallback(lambda: self._loop.call_soon_threadsafe(wakeEvent.set))
+
+        def interfacesChanged():
+            networkList = AreYouThereThread.GetDiscoveryNetworkList(self._options.net_if)
+            # Read on this thread as this runs a command.
+            self._updateLocalAddressSet()
+            self._loop.call_soon_threadsafe(networksChanged, networkList)
+
+        def networksChanged(networkList):
+            nonlocal destList
+            self._discoveryNetworkList = networkList
+            destList = AreYouThereThread.GetDestList(self._options, networkList)
+            self._aytScheduler.changed(pollNow=True)
+
+        if not self._options.no_lan:
+            interfaceWatcher = InterfaceWatcher(self._uo, interfacesChanged)
+            interfaceWatcher.start()
+
+        try:
+            while True:
+                wakeEvent.clear()
+                waitSeconds = self._aytScheduler.getWaitSeconds()
+                if waitSeconds > 0:
+                    try:
+                        await asyncio.wait_for(wakeEvent.wait(), waitSeconds)
+
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                sentCount = 0
+                for destAddress, srcAddress in destList:
+                    try:
+                        transportDict.get(srcAddress, transport).sendto(aytMsgBytes, (destAddress, AreYouThereThread.UDP_DEV_DISCOVERY_PORT) )
+                        sentCount = sentCount + 1
+
+                    except Exception:
+                        self._uo.error("Failed to send AYT message to %s." % (destAddress) )
+                        self._uo.errorException()
+
+                self._aytScheduler.polled(sentCount=sentCount)
+                self._devicesPolled()
+
+        finally:
+            self._aytScheduler.setWakeCallback(None)
+            if interfaceWatcher:
+                interfaceWatcher.shutDown()
+
+    def _initEventLoop(self):
+        """@brief Create the objects that belong to the running event loop."""
+        self._loop = asyncio.get_running_loop()
+        self._disconnectedEvent = asyncio.Event()
+        self._rpcAsyncLock = asyncio.Lock()
+        self._rpcFutureDict = {}
+        self._taskSet = set()
+
+    async def _serveDevices(self, sock, sockDict=None, sendAYT=True):
+        """@brief Process the messages received from devices until the MQTT connection is lost.
+           @param sock The device discovery socket. This is closed on exit.
+           @param sockDict A dict of the sockets bound to local interface addresses (indexed
+                  by address) to also listen on. These are closed on exit.
+           @param sendAYT If True send AYT messages to elicit device responses."""
+        transport, _ = await self._loop.create_datagram_endpoint(lambda: DevResponseProtocol(self), sock=sock)
+        transportDict = {}
+        try:
+            if sockDict:
+                for ipAddress, ifSock in sockDict.items():
+                    ifName = self._getIFNameByAddress(ipAddress)
+                    transportDict[ipAddress], _ = await self._loop.create_datagram_endpoint(lambda: DevResponseProtocol(self, ifName), sock=ifSock)
+
+            waitTaskList = [self._loop.create_task( self._disconnectedEvent.wait() )]
+            if sendAYT:
+                waitTaskList.append( self._loop.create_task( self._sendAYTMessages(transport, transportDict) ) )
+            self._uo.info("Listening on UDP port %d" % (sock.getsockname()[1]) )
+            try:
+                doneSet, _ = await asyncio.wait(waitTaskList, return_when=asyncio.FIRST_COMPLETED)
+                for task in doneSet:
+                    task.result()
+
+            finally:
+                for task in waitTaskList:
+                    task.cancel()
+
+        finally:
+            for ifTransport in transportDict.values():
+                ifTransport.close()
+            transport.close()
+
+        self._uo.info("Stopped listening for device responses.")
+
+    async def _runSession(self):
+        """@brief Connect the MQTT clients and process device messages until disconnected."""
+        self._initEventLoop()
+        self._mqttClientLoop = AsyncMQTTClientLoop(self._loop, self._mqttClient)
+        try:
+            self._uo.info("Connecting to MQTT server (port %d) on ssh server" % (self._options.mqtt_port) )
+            await self._connectMQTTClient(self._mqttClient)
+
+            self._aytScheduler.reset()
+            await self._loop.run_in_executor(None, self._claimCachedPorts)
+            self._restoreDevices()
+            self._discoveryNetworkList = await self._loop.run_in_executor(None, self._getDiscoveryNetworkList)
+            await self._loop.run_in_executor(None, self._updateLocalAddressSet)
+            sock = self._openDevDiscoverySocket()
+            sockDict = self._openInterfaceSockets(self._discoveryNetworkList)
+            await self._serveDevices(sock, sockDict)
+
+        finally:
+            await self._cancelTasks()
+            self._mqttClient.disconnect()
+            await self._mqttClientLoop.waitClosed(AsyncIconsGW.CLOSE_TIMEOUT_SECONDS)
+            self._mqttClientLoop.detach()
+            self._mqttClientLoop = None
+
+    def _handleConnection(self):
+        """@brief Discover devices on the local LAN and keep the ICON server
+                  informed of them. See IconsGW._handleConnection()."""
+        statsReporter = None
+        try:
+            if self._options.stats_period > 0:
+                statsReporter = StatsReporter(self._uo, self._stats, self._options.stats_period, self._publishStats if self._options.stats_topic else None)
+                statsReporter.start()
+
+            self._serverPortAllocator = ServerPortAllocator(self._rpcCall, self._options.port_batch_size, self._options.location)
+            self._startTunnelWorkers()
+
+            asyncio.run( self._runSession() )
+
+        finally:
+
+            self._stopTunnelWorkers()
+            self._savePortAssignmentCache()
+
+            if statsReporter:
+                statsReporter.shutDown()
+                statsReporter = None
+
+def getOptionParser():
+    """@brief Get the command line option parser for the icons_gw program.
+       @return An OptionParser instance."""
+    opts=OptionParser(usage='Connects (via ssh) to an ICONS (internet connection server) and provides a gateway from the local network.')
+    opts.add_option("--debug",              help="Enable debugging. If enabled then all RX device will be displayed on stdout.", action="store_true", default=False)
+    opts.add_option("--config",             help="Configure the ICONS destination client.", action="store_true", default=False)
+    opts.add_option("--mqtt_port",          help="The MQTT server TCPIP port on the ssh server port (default=%d)" % (IconsGWConfig.MQTT_SERVER_PORT) , type="int", default=IconsGWConfig.MQTT_SERVER_PORT)
+    opts.add_option("--log_file",           help="A log file to save all output to (default=None)" , default=None)
+    opts.add_option("--dev_poll_period",    help="The maximum device poll period in seconds. The poll period doubles after each poll up to this value while no device changes are seen (default=%d)" % (IconsGWConfig.DEFAULT_DEV_POLL_PERIOD) , type="float", default=IconsGWConfig.DEFAULT_DEV_POLL_PERIOD)
+    opts.add_option("--dev_poll_min_period",help="The device poll period in seconds after startup or after a device change is seen. If not less than --dev_poll_period the poll period is fixed (default=%d)" % (IconsGWConfig.DEFAULT_DEV_POLL_MIN_PERIOD) , type="float", default=IconsGWConfig.DEFAULT_DEV_POLL_MIN_PERIOD)
+    opts.add_option("--no_comp",            help="Disable SSH data compression. By default compression is used.", action="store_true", default=False)
+    opts.add_option("--services",           help="Configure services to be provided by machines. These can be any network device that runs a TCP server (E.G SSH, VNC etc).", action="store_true", default=False)
+    opts.add_option("--no_lan",             help="Do not attempt to discover devices on the LAN.", action="store_true", default=False)
+    opts.add_option("--enable_syslog",      help="Enable syslog on this instance of icons_gw. By default syslog is disabled.", action="store_true", default=False)
+    opts.add_option("--keepalive",          help="The number of seconds between each MQTT keepalive message (default=%d)." % (IconsClient.MQTT_DEFAULT_KEEPALIVE_SECONDS) , type="int", default=IconsClient.MQTT_DEFAULT_KEEPALIVE_SECONDS)
+    opts.add_option("--enable_auto_start",  help="Auto start when this computer starts.", action="store_true", default=False)
+    opts.add_option("--disable_auto_start", help="Disable auto starting when this computer starts.", action="store_true", default=False)
+    opts.add_option("--check_auto_start",   help="Check the status of an auto started icons_gw instance.", action="store_true", default=False)
+    opts.add_option("--user",               help="Set the user for auto start.")
+    opts.add_option("--heartbeat_period",   help="Device state is only published when it changes or when this number of seconds has elapsed since it was last published. If 0 then every device response is published (default=%d)." % (IconsClient.DEFAULT_HEARTBEAT_PERIOD) , type="float", default=IconsClient.DEFAULT_HEARTBEAT_PERIOD)
+    opts.add_option("--tunnel_workers",     help="The number of threads used to setup the reverse ssh tunnels for newly discovered devices. If 0 then tunnels are setup on the device listener thread (default=%d)." % (IconsGW.DEFAULT_TUNNEL_WORKERS) , type="int", default=IconsGW.DEFAULT_TUNNEL_WORKERS)
+    opts.add_option("--port_batch_size",    help="The minimum number of free ICONS TCP ports to request in each RPC (default=%d)." % (ServerPortAllocator.DEFAULT_BATCH_SIZE) , type="int", default=ServerPortAllocator.DEFAULT_BATCH_SIZE)
+    opts.add_option("--dev_missed_polls",   help="A device that has not responded for this number of maximum poll periods (--dev_poll_period) has its reverse ssh tunnels removed and is published as offline. If 0 then devices are not removed (default=%d)." % (IconsGW.DEFAULT_DEV_MISSED_POLLS) , type="int", default=IconsGW.DEFAULT_DEV_MISSED_POLLS)
+    opts.add_option("--port_cache",         help="The file that the ICONS port used by each device service is saved in so that devices keep the same ports when the icons_gw reconnects or restarts. If empty the ports are not saved (default=~/.%s)." % (PortAssignmentCache.FILENAME) , default=None)
+    opts.add_option("--port_cache_expiry",  help="The number of seconds the ICONS ports of a removed device are kept in the --port_cache file so that the device gets the same ports if it returns (default=%d)." % (PortAssignmentCache.DEFAULT_EXPIRY_SECONDS) , type="float", default=PortAssignmentCache.DEFAULT_EXPIRY_SECONDS)
+    opts.add_option("--rx_workers",         help="The number of threads that process the messages received from devices (default=%d)." % (IconsGW.DEFAULT_RX_WORKERS) , type="int", default=IconsGW.DEFAULT_RX_WORKERS)
+    opts.add_option("--rx_batch_size",      help="The maximum number of device messages read from a socket in one system call (recvmmsg on Linux) by the thread engine (default=%d)." % (DatagramReceiver.DEFAULT_BATCH_SIZE) , type="int", default=DatagramReceiver.DEFAULT_BATCH_SIZE)
+    opts.add_option("--rx_socket_buffer",   help="The size in bytes of the receive buffer of the device discovery sockets. This holds the device messages that arrive in a burst until they are read. The OS may limit the size (E.G net.core.rmem_max on Linux). If 0 the OS default is used (default=%d)." % (IconsGW.DEFAULT_RX_SOCKET_BUFFER) , type="int", default=IconsGW.DEFAULT_RX_SOCKET_BUFFER)
+    opts.add_option("--rx_queue_size",      help="The maximum number of device messages waiting to be processed. When full, messages from devices that already have a message waiting replace it and others are dropped (default=%d)." % (DeviceResponseQueue.DEFAULT_SIZE) , type="int", default=DeviceResponseQueue.DEFAULT_SIZE)
+    opts.add_option("--no_retain",          help="Do not publish device state as retained messages. By default the ICONS MQTT server retains the latest state of each device so that new subscribers receive the state of every device when they subscribe.", action="store_true", default=False)
+    opts.add_option("--publish_queue_size", help="The maximum number of messages waiting to be published to the ICONS. When full, messages for topics that already have a message waiting replace it and others are dropped (default=%d)." % (PublishQueue.DEFAULT_SIZE) , type="int", default=PublishQueue.DEFAULT_SIZE)
+    opts.add_option("--publish_max_inflight",help="The maximum number of messages handed to the MQTT client that it has not yet sent or had acknowledged. If 0 there is no limit (default=%d)." % (PublishQueue.DEFAULT_MAX_IN_FLIGHT) , type="int", default=PublishQueue.DEFAULT_MAX_IN_FLIGHT)
+    opts.add_option("--publish_qos",        help="A comma separated list of TOPIC:QOS entries that set the MQTT QOS used to publish on each topic. MQTT wildcards (+ and #) may be used in the topic. Topics that match no entry are published with QOS 0.", default="")
+    opts.add_option("--publish_retain",     help="A comma separated list of other topics (MQTT wildcards may be used) on which messages are published with the retain flag set. The device state topics (LOCATION/UNIT_NAME) are always retained unless --no_retain is used, in which case only these topics are retained.", default="")
+    opts.add_option("--compact_topics",     help="A comma separated list of topics (MQTT wildcards may be used) on which device state is published in the compact (MessagePack) encoding rather than JSON. Only ydev2db and mqtt_subscribe decode the compact encoding. The yView GUIs (desktop and android) only decode JSON so do not use it on topics that a GUI subscribes to. Requires the msgpack python module.", default="")
+    opts.add_option("--engine",             help="The engine used to handle the network connections. 'thread' uses a thread for each connection, 'asyncio' uses a single asyncio event loop (default=thread).", type="choice", choices=IconsGW.ENGINE_LIST, default=IconsGW.ENGINE_THREAD)
+    opts.add_option("--fast_reconnect",     help="Keep the known devices when the connection to the ICONS is lost. Their reverse ssh tunnels are restored as soon as the connection is restored rather than when they next respond.", action="store_true", default=False)
+    opts.add_option("--reconnect_min_delay",help="With --fast_reconnect, the number of seconds to wait before reconnecting after the connection to the ICONS is lost. The delay doubles after each failed attempt (default=%d). Without --fast_reconnect the delay is always %d seconds." % (IconsClient.DEFAULT_RECONNECT_MIN_DELAY, IconsClient.ICONS_RECONNECT_DELAY) , type="float", default=IconsClient.DEFAULT_RECONNECT_MIN_DELAY)
+    opts.add_option("--reconnect_max_delay",help="With --fast_reconnect, the maximum number of seconds to wait before reconnecting to the ICONS (default=%d)." % (IconsClient.DEFAULT_RECONNECT_MAX_DELAY) , type="float", default=IconsClient.DEFAULT_RECONNECT_MAX_DELAY)
+    opts.add_option("--dns_ttl",            help="The number of seconds the address of a host in the configured services is used before it is looked up again. The previous address is used while it is looked up (default=%d)." % (HostAddressCache.DEFAULT_TTL_SECONDS) , type="float", default=HostAddressCache.DEFAULT_TTL_SECONDS)
+    opts.add_option("--stats_period",       help="The number of seconds between each report of the icons_gw stats. If 0 then stats are not reported (default=0).", type="float", default=0)
+    opts.add_option("--stats_topic",        help="The MQTT topic on which the icons_gw stats are published as JSON at each --stats_period report (default=None).", default=None)
+    opts.add_option("--metrics_port",       help="The TCP port on which the icons_gw stats are served over HTTP in the Prometheus text format at %s. If 0 then they are not served (default=0)." % (MetricsServer.PATH) , type="int", default=0)
+    opts.add_option("--metrics_address",    help="The local address on which the --metrics_port server listens (default=%s)." % (MetricsServer.DEFAULT_ADDRESS) , default=MetricsServer.DEFAULT_ADDRESS)
+
+    return opts
+
 def main():
     uo = UO()
     debug = False
 
     try:
 
-        opts=OptionParser(usage='Connects (via ssh) to an ICONS (internet connection server) and provides a gateway from the local network.')
-        opts.add_option("--debug",              help="Enable debugging. If enabled then all RX device will be displayed on stdout.", action="store_true", default=False)
-        opts.add_option("--config",             help="Configure the ICONS destination client.", action="store_true", default=False)
-        opts.add_option("--mqtt_port",          help="The MQTT server TCPIP port on the ssh server port (default=%d)" % (IconsGWConfig.MQTT_SERVER_PORT) , type="int", default=IconsGWConfig.MQTT_SERVER_PORT)
-        opts.add_option("--log_file",           help="A log file to save all output to (default=None)" , default=None)
-        opts.add_option("--dev_poll_period",    help="The device poll period in seconds (default=%d)" % (IconsGWConfig.DEFAULT_DEV_POLL_PERIOD) , type="float", default=IconsGWConfig.DEFAULT_DEV_POLL_PERIOD)
-        opts.add_option("--no_comp",            help="Disable SSH data compression. By default compression is used.", action="store_true", default=False)
-        opts.add_option("--services",           help="Configure services to be provided by machines. These can be any network device that runs a TCP server (E.G SSH, VNC etc).", action="store_true", default=False)
-        opts.add_option("--no_lan",             help="Do not attempt to discover devices on the LAN.", action="store_true", default=False)
-        opts.add_option("--enable_syslog",      help="Enable syslog on this instance of icons_gw. By default syslog is disabled.", action="store_true", default=False)
-        opts.add_option("--keepalive",          help="The number of seconds between each MQTT keepalive message (default=%d)." % (IconsClient.MQTT_DEFAULT_KEEPALIVE_SECONDS) , type="int", default=IconsClient.MQTT_DEFAULT_KEEPALIVE_SECONDS)
-        opts.add_option("--enable_auto_start",  help="Auto start when this computer starts.", action="store_true", default=False)
-        opts.add_option("--disable_auto_start", help="Disable auto starting when this computer starts.", action="store_true", default=False)
-        opts.add_option("--check_auto_start",   help="Check the status of an auto started icons_gw instance.", action="store_true", default=False)
-        opts.add_option("--user",               help="Set the user for auto start.")
-
+        opts=getOptionParser()
         (options, args) = opts.parse_args()
 
         debug = options.debug
@@ -1279,7 +4671,10 @@ def main():
 
             iconsGWConfig.updateOptions(options)
 
-            iconsGW = IconsGW(uo, options)
+            if options.engine == IconsGW.ENGINE_ASYNCIO:
+                iconsGW = AsyncIconsGW(uo, options)
+            else:
+                iconsGW = IconsGW(uo, options)
 
             if options.enable_auto_start:
                 iconsGW.enableAutoStart(options.user)
@@ -0,0 +1,672 @@
+#!/usr/bin/env python3
+
+import  os
+import  json
+import  random
+import  socket
+import  asyncio
+import  threading
+import  multiprocessing
+from    time import perf_counter, process_time, sleep, time
+from    optparse import OptionParser
+import  paho.mqtt.client as mqtt
+
+from    p3lib.uio import UIO as UO
+
+from    icons_gw.icons_gw import IconsClient, IconsGW, AsyncIconsGW, IconsGWConfig, IconsRPCError, ServerPortAllocator, AreYouThereThread, DatagramReceiver, getOptionParser
+from    icons_gw.device_fleet import QuietUIO, DeviceFleetProcess, SimulatedDeviceFleet
+from    icons_gw.dev_state_codec import DevStateCodec
+
+class NullSSHTunnelManager(object):
+    """@brief Stands in for an SSHTunnelManager so that the gateway can be driven
+              without an ssh connection to an ICON server."""
+
+    def __init__(self, latency=0):
+        """@brief Constructor
+           @param latency The number of seconds each reverse tunnel request takes."""
+        self._latency = latency
+        self.revTunnelCount = 0
+
+    def startRevSSHTunnel(self, serverPort, destHost, destPort, serverBindAddress=''):
+        if self._latency > 0:
+            sleep(self._latency)
+        self.revTunnelCount = self.revTunnelCount + 1
+
+    def stopRevSSHTunnel(self, serverPort):
+        self.revTunnelCount = self.revTunnelCount - 1
+
+    def stopAllSSHTunnels(self):
+        self.revTunnelCount = 0
+
+class LocalPortRPCCaller(object):
+    """@brief Stands in for the MQTT RPC caller by handing out server ports locally."""
+
+    FIRST_PORT = 10000
+
+    def __init__(self, latency=0):
+        """@brief Constructor
+           @param latency The number of seconds each RPC takes."""
+        self._latency = latency
+        self._nextPort = LocalPortRPCCaller.FIRST_PORT
+        self.callCount = 0
+
+    def _getPort(self):
+        port = self._nextPort
+        self._nextPort = self._nextPort + 1
+        return port
+
+    def rpcCall(self, methodName, argList):
+        """@brief Handle an RPC as the ICONS RPC provider would.
+           @param methodName The name of the RPC.
+           @param argList The RPC arguments.
+           @return The RPC response.
+           @raise IconsRPCError If the RPC is not known."""
+        if self._latency > 0:
+            sleep(self._latency)
+        self.callCount = self.callCount + 1
+        if methodName == "getFreeTCPPort":
+            return self._getPort()
+        elif methodName == "getFreeTCPPortList":
+            return [self._getPort() for _ in range( int(argList[0]) )]
+        raise IconsRPCError("Unable to find a provider of the %s method." % (methodName) )
+
+class NullMQTTClient(object):
+    """@brief Stands in for the paho MQTT client and counts the messages published.
+              Messages are reported as published as soon as they are published."""
+
+    def __init__(self):
+        self.publishCount = 0
+        self.on_publish = None
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.publishCount = self.publishCount + 1
+        if self.on_publish:
+            self.on_publish(self, None, self.publishCount)
+        return mqtt.MQTTMessageInfo(self.publishCount)
+
+class BenchIconsGW(IconsGW):
+    """@brief An IconsGW instance connected to local stand ins rather than an ICON server."""
+
+    def __init__(self, uo, options, rpcLatency=0, tunnelLatency=0):
+        """@brief Constructor
+           @param uo A UIO instance.
+           @param options The icons_gw options.
+           @param rpcLatency The number of seconds each RPC to the ICONS takes.
+           @param tunnelLatency The number of seconds each reverse tunnel request takes."""
+        IconsGW.__init__(self, uo, options)
+        self._sshTunnelManager = NullSSHTunnelManager(tunnelLatency)
+        self._localRPCCaller = LocalPortRPCCaller(rpcLatency)
+        self._mqttClient = NullMQTTClient()
+        self._mqttClient.on_publish = self.on_publish
+        self._mqttClientConnected = True
+        self._serverPortAllocator = ServerPortAllocator(self._rpcCall, options.port_batch_size)
+
+    def _rpcCall(self, methodName, argList):
+        self._stats.incr(IconsClient.STAT_RPC_CALLS)
+        return self._localRPCCaller.rpcCall(methodName, argList)
+
+class BenchAsyncIconsGW(AsyncIconsGW):
+    """@brief An AsyncIconsGW instance connected to local stand ins rather than an ICON server."""
+
+    def __init__(self, uo, options, rpcLatency=0, tunnelLatency=0):
+        """@brief Constructor
+           @param uo A UIO instance.
+           @param options The icons_gw options.
+           @param rpcLatency The number of seconds each RPC to the ICONS takes.
+           @param tunnelLatency The number of seconds each reverse tunnel request takes."""
+        AsyncIconsGW.__init__(self, uo, options)
+        self._rpcLatency = rpcLatency
+        self._sshTunnelManager = NullSSHTunnelManager(tunnelLatency)
+        self._localRPCCaller = LocalPortRPCCaller()
+        self._mqttClient = NullMQTTClient()
+        self._mqttClient.on_publish = self.on_publish
+        self._mqttClientConnected = True
+        self._serverPortAllocator = ServerPortAllocator(self._rpcCall, options.port_batch_size)
+
+    async def _rpcCallAsync(self, methodName, argList):
+        self._stats.incr(IconsClient.STAT_RPC_CALLS)
+        if self._rpcLatency > 0:
+            await asyncio.sleep(self._rpcLatency)
+        return self._localRPCCaller.rpcCall(methodName, argList)
+
+    async def _runBenchSession(self, sock):
+        """@brief Process the messages received from devices until stop() is called.
+           @param sock The socket that device messages are sent to."""
+        self._initEventLoop()
+        try:
+            await self._serveDevices(sock, sendAYT=False)
+        finally:
+            await self._cancelTasks()
+
+    def stop(self):
+        """@brief Stop the bench session. This may be called from any thread."""
+        self._loop.call_soon_threadsafe(self._disconnectedEvent.set)
+
+class FleetGWMixin(object):
+    """@brief Connects an icons_gw to the MQTT broker of a DeviceFleetProcess rather
+              than to an ICON server over ssh. Reverse ssh tunnels are not setup. The
+              device discovery socket is bound to FLEET_GW_ADDRESS so that AYT messages
+              sent to localhost (--no_lan) are received by the simulated devices and
+              their responses are received by the icons_gw."""
+
+    FLEET_GW_ADDRESS = "127.0.0.3"
+
+    def _startMQTTForwarding(self):
+        self._localMQTTPort = self._brokerPort
+        self._sshTunnelManager = NullSSHTunnelManager()
+
+    def _openDevDiscoverySocket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind( (FleetGWMixin.FLEET_GW_ADDRESS, AreYouThereThread.UDP_DEV_DISCOVERY_PORT) )
+        return sock
+
+class FleetIconsGW(FleetGWMixin, IconsGW):
+    """@brief An IconsGW instance connected to a DeviceFleetProcess."""
+
+    def __init__(self, uo, options, brokerPort):
+        """@brief Constructor
+           @param uo A UIO instance.
+           @param options The icons_gw options.
+           @param brokerPort The TCP port of the MQTT broker stand in."""
+        IconsGW.__init__(self, uo, options)
+        self._brokerPort = brokerPort
+
+    def stop(self):
+        """@brief Stop handling the connection. This may be called from any thread."""
+        self._mqttClient.disconnect()
+        # Wake the listener so that it sees it is no longer connected.
+        wakeSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        wakeSock.sendto(b"{}", (FleetGWMixin.FLEET_GW_ADDRESS, AreYouThereThread.UDP_DEV_DISCOVERY_PORT) )
+        wakeSock.close()
+
+class FleetAsyncIconsGW(FleetGWMixin, AsyncIconsGW):
+    """@brief An AsyncIconsGW instance connected to a DeviceFleetProcess."""
+
+    def __init__(self, uo, options, brokerPort):
+        """@brief Constructor
+           @param uo A UIO instance.
+           @param options The icons_gw options.
+           @param brokerPort The TCP port of the MQTT broker stand in."""
+        AsyncIconsGW.__init__(self, uo, options)
+        self._brokerPort = brokerPort
+
+    def stop(self):
+        """@brief Stop handling the connection. This may be called from any thread."""
+        self._loop.call_soon_threadsafe(self._disconnectedEvent.set)
+
+class DeviceMessageSender(multiprocessing.Process):
+    """@brief Sends device messages to the icons_gw at a fixed rate from a separate
+              process so that the CPU used to send them is not attributed to the icons_gw."""
+
+    BURST_PERIOD_SECONDS = 0.001
+
+    def __init__(self, address, payloadList, messageCount, rate):
+        """@brief Constructor
+           @param address The address (host, port) to send the messages to.
+           @param payloadList The device messages. These are sent in turn.
+           @param messageCount The number of messages to send.
+           @param rate The number of messages to send per second."""
+        multiprocessing.Process.__init__(self, daemon=True)
+        self._address = address
+        self._payloadList = payloadList
+        self._messageCount = messageCount
+        self._rate = rate
+        self.startEvent = multiprocessing.Event()
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.startEvent.wait()
+        startTime = perf_counter()
+        for index in range(0, self._messageCount):
+            sock.sendto(self._payloadList[index % len(self._payloadList)], self._address)
+            # Send in bursts to hold the required message rate.
+            if index % max(int(self._rate*DeviceMessageSender.BURST_PERIOD_SECONDS), 1) == 0:
+                dueSeconds = startTime+index/self._rate-perf_counter()
+                if dueSeconds > 0:
+                    sleep(dueSeconds)
+        sock.close()
+
+class IconsGWBench(object):
+    """@brief Responsible for measuring the cost of processing device responses in the icons_gw."""
+
+    DEVICE_COUNT_LIST       = (10, 100, 1000, 10000)
+    LOCATION                = "BENCH"
+    LOCALHOST               = "127.0.0.1"
+    DEFAULT_RESPONSE_COUNT  = 100000
+    DEFAULT_DEVICE_COUNT    = 200
+    DEFAULT_RPC_LATENCY     = 0.1
+    DEFAULT_TUNNEL_LATENCY  = 0.02
+    DEFAULT_MESSAGE_RATE    = 20000
+    DRAIN_SECONDS           = 0.5
+    DEFAULT_FLEET_DURATION  = 10
+    DEFAULT_FLEET_POLL      = 2
+    DEFAULT_FLEET_JITTER    = 0.5
+    PERCENTILE_LIST         = (0.5, 0.9, 0.99)
+    BURST_COUNT             = 5
+    BURST_PAUSE_SECONDS     = 0.5
+    # Sending at this rate sends each burst as fast as possible.
+    BURST_RATE              = 1E9
+
+    @staticmethod
+    def GetDevIPAddress(index):
+        """@brief Get a unique device IP address.
+           @param index The device index.
+           @return The IP address string."""
+        return "10.%d.%d.%d" % ( (index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff)
+
+    @staticmethod
+    def GetDevDict(index):
+        """@brief Get the dict that a device would send in response to an AYT message.
+           @param index The device index.
+           @return The device dict."""
+        return {IconsGW.JSON_IP_ADDRESS_KEY: IconsGWBench.GetDevIPAddress(index),
+                IconsGW.JSON_UNIT_NAME:      "DEV%d" % (index),
+                IconsGW.JSON_PRODUCT_ID:     "BENCH",
+                IconsGW.JSON_GROUP_NAME:     "",
+                IconsGW.JSON_SERVICE_LIST:   "WEB:80,SSH:22"}
+
+    @staticmethod
+    def GetGWOptions():
+        """@return The default icons_gw options for a benchmark gateway instance."""
+        options, _ = getOptionParser().parse_args([])
+        options.location = IconsGWBench.LOCATION
+        options.ayt_msg  = IconsGWConfig.DEFAULT_AYT_MSG
+        options.net_if   = None
+        # Don't overwrite the ICONS port assignments of a real icons_gw.
+        options.port_cache = ""
+        return options
+
+    def __init__(self, uo, options):
+        """@brief Constructor
+           @param uo A UIO instance.
+           @param options The command line options instance."""
+        self._uo = uo
+        self._options = options
+
+    def _showResult(self, devCount, responseCount, elapsedSeconds):
+        """@brief Show the result of a single benchmark run."""
+        usPerResponse = (elapsedSeconds*1E6)/responseCount
+        self._uo.info("%6d devices: %8d responses in %7.3f seconds, %8.2f us/response" % (devCount, responseCount, elapsedSeconds, usPerResponse) )
+
+    def benchRegistry(self):
+        """@brief Measure the per response cost of IconsGW._processDevDict() as the
+                  number of known devices grows. The gateway is first populated
+                  with all the devices and then responses from random known devices
+                  are processed as they would be on every AYT poll."""
+        self._uo.info("IconsGW._processDevDict() cost for known devices.")
+        for devCount in IconsGWBench.DEVICE_COUNT_LIST:
+            iconsGW = BenchIconsGW(self._uo, IconsGWBench.GetGWOptions())
+            for index in range(0, devCount):
+                iconsGW._processDevDict( IconsGWBench.GetDevDict(index) )
+
+            devDictList = [IconsGWBench.GetDevDict( random.randrange(devCount) ) for _ in range(self._options.responses)]
+            startTime = perf_counter()
+            for devDict in devDictList:
+                iconsGW._processDevDict(devDict)
+            self._showResult(devCount, len(devDictList), perf_counter()-startTime)
+
+    def _setupTunnels(self, tunnelWorkers, portBatchSize):
+        """@brief Measure the time taken for the icons_gw to setup tunnels for devices
+                  that all respond at the same time.
+           @param tunnelWorkers The number of tunnel worker threads.
+           @param portBatchSize The minimum number of ports requested in each RPC."""
+        gwOptions = IconsGWBench.GetGWOptions()
+        gwOptions.tunnel_workers = tunnelWorkers
+        gwOptions.port_batch_size = portBatchSize
+        iconsGW = BenchIconsGW(self._uo, gwOptions, rpcLatency=self._options.rpc_latency, tunnelLatency=self._options.tunnel_latency)
+        iconsGW._startTunnelWorkers()
+        try:
+            startTime = perf_counter()
+            for index in range(0, self._options.devices):
+                iconsGW._processDevDict( IconsGWBench.GetDevDict(index) )
+            rxSeconds = perf_counter()-startTime
+
+            while iconsGW._mqttClient.publishCount < self._options.devices:
+                sleep(0.001)
+            allSeconds = perf_counter()-startTime
+
+        finally:
+            iconsGW._stopTunnelWorkers()
+
+        self._uo.info("workers=%-3d port batch size=%-3d: listener blocked for %7.3f seconds, all devices published after %7.3f seconds (%d RPCs)" % (tunnelWorkers, portBatchSize, rxSeconds, allSeconds, iconsGW._localRPCCaller.callCount) )
+
+    def benchTunnels(self):
+        """@brief Measure the time taken to setup the reverse ssh tunnels when many
+                  devices respond at once (E.G when the icons_gw starts)."""
+        self._uo.info("Tunnel setup for %d devices (RPC latency=%.3f seconds, tunnel request latency=%.3f seconds)." % (self._options.devices, self._options.rpc_latency, self._options.tunnel_latency) )
+        # Tunnels setup on the listener thread with an RPC for every device.
+        self._setupTunnels(0, 1)
+        self._setupTunnels(IconsGW.DEFAULT_TUNNEL_WORKERS, ServerPortAllocator.DEFAULT_BATCH_SIZE)
+
+    def _startEngine(self, engine, gwOptions, sock):
+        """@brief Start an icons_gw engine processing the messages received on a socket.
+           @param engine The icons_gw engine (IconsGW.ENGINE_THREAD or IconsGW.ENGINE_ASYNCIO).
+           @param gwOptions The icons_gw options.
+           @param sock The socket that device messages are sent to.
+           @return A tuple containing the icons_gw instance and a function that stops it."""
+        if engine == IconsGW.ENGINE_ASYNCIO:
+            iconsGW = BenchAsyncIconsGW(QuietUIO(), gwOptions)
+            iconsGW._startTunnelWorkers()
+            engineThread = threading.Thread(target=asyncio.run, args=(iconsGW._runBenchSession(sock),) )
+            engineThread.start()
+            while not iconsGW._disconnectedEvent:
+                sleep(0.001)
+
+            def stop():
+                iconsGW.stop()
+                engineThread.join()
+                iconsGW._stopTunnelWorkers()
+
+        else:
+            iconsGW = BenchIconsGW(QuietUIO(), gwOptions)
+            iconsGW._startTunnelWorkers()
+            engineThread = threading.Thread(target=iconsGW._listenForDevResponses, args=(sock,) )
+            engineThread.start()
+
+            def stop():
+                iconsGW._mqttClientConnected = False
+                # Wake the listener so that it sees it is no longer connected.
+                wakeSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                wakeSock.sendto(b"{}", sock.getsockname())
+                wakeSock.close()
+                engineThread.join()
+                sock.close()
+                iconsGW._stopTunnelWorkers()
+
+        return (iconsGW, stop)
+
+    def _waitForPublish(self, iconsGW, publishCount):
+        """@brief Wait for the icons_gw to publish messages.
+           @param iconsGW The icons_gw instance.
+           @param publishCount The number of messages to wait for. If the icons_gw stops
+                  publishing before this number is reached we stop waiting.
+           @return The perf_counter() time at which the last message was published."""
+        lastCount = iconsGW._mqttClient.publishCount
+        lastTime = perf_counter()
+        while lastCount < publishCount and perf_counter()-lastTime < IconsGWBench.DRAIN_SECONDS:
+            sleep(0.001)
+            if iconsGW._mqttClient.publishCount != lastCount:
+                lastCount = iconsGW._mqttClient.publishCount
+                lastTime = perf_counter()
+        return lastTime
+
+    def _benchEngine(self, engine):
+        """@brief Measure the CPU used by an icons_gw engine to process device messages.
+           @param engine The icons_gw engine (IconsGW.ENGINE_THREAD or IconsGW.ENGINE_ASYNCIO)."""
+        gwOptions = IconsGWBench.GetGWOptions()
+        # Publish every message so that every message processed can be counted.
+        gwOptions.heartbeat_period = 0
+        gwOptions.engine = engine
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind( (IconsGWBench.LOCALHOST, 0) )
+        payloadList = [IconsClient.DictToJSON( IconsGWBench.GetDevDict(index) ).encode() for index in range(0, self._options.devices)]
+        sender = DeviceMessageSender(sock.getsockname(), payloadList, self._options.responses, self._options.rate)
+        sender.start()
+
+        iconsGW, stop = self._startEngine(engine, gwOptions, sock)
+        try:
+            # Add all the devices before measuring the processing of messages from known devices.
+            txSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            for payload in payloadList:
+                txSock.sendto(payload, sock.getsockname())
+                sleep(0.0001)
+            txSock.close()
+            self._waitForPublish(iconsGW, len(payloadList))
+            firstPublishCount = iconsGW._mqttClient.publishCount
+
+            startCPUSeconds = process_time()
+            startTime = perf_counter()
+            sender.startEvent.set()
+            sender.join()
+            elapsedSeconds = self._waitForPublish(iconsGW, firstPublishCount+self._options.responses)-startTime
+            cpuSeconds = process_time()-startCPUSeconds
+
+        finally:
+            stop()
+
+        processedCount = iconsGW._mqttClient.publishCount-firstPublishCount
+        self._uo.info("%-7s engine: %7d/%-7d messages processed, %9.1f messages/second, %6.2f us CPU/message" % (engine, processedCount, self._options.responses, processedCount/elapsedSeconds, (cpuSeconds*1E6)/max(processedCount, 1) ) )
+
+    def benchEngines(self):
+        """@brief Compare the CPU used by the icons_gw engines to process messages from
+                  a fleet of devices."""
+        self._uo.info("Processing %d messages from %d devices sent at %d messages/second." % (self._options.responses, self._options.devices, self._options.rate) )
+        for engine in IconsGW.ENGINE_LIST:
+            self._benchEngine(engine)
+
+    @staticmethod
+    def GetThreadCount():
+        """@brief Get the number of threads in this process. This includes threads
+                  started with _thread.start_new_thread() (E.G the MQTT client loop)
+                  which the threading module does not know about.
+           @return The number of threads."""
+        try:
+            return len( os.listdir("/proc/self/task") )
+        except OSError:
+            return threading.active_count()
+
+    @staticmethod
+    def GetPercentile(sortedList, fraction):
+        """@brief Get a percentile of a sorted list of values.
+           @param sortedList The values in ascending order.
+           @param fraction The percentile as a fraction (E.G 0.99).
+           @return The value or 0 if the list is empty."""
+        if not sortedList:
+            return 0
+        return sortedList[ min( int( fraction*len(sortedList) ), len(sortedList)-1) ]
+
+    def _runFleet(self, deviceCount):
+        """@brief Run an icons_gw against a simulated fleet of devices and report the
+                  time from a device first responding to its state being published,
+                  the rate messages were received/published and the CPU used.
+           @param deviceCount The number of devices in the fleet."""
+        fleetProcess = DeviceFleetProcess(deviceCount, self._options.services, self._options.jitter)
+        fleetProcess.start()
+
+        gwOptions = IconsGWBench.GetGWOptions()
+        gwOptions.no_lan = True
+        gwOptions.dev_poll_period = self._options.poll_period
+        gwOptions.engine = self._options.engine
+        if self._options.engine == IconsGW.ENGINE_ASYNCIO:
+            iconsGW = FleetAsyncIconsGW(QuietUIO(), gwOptions, fleetProcess.brokerPort)
+        else:
+            iconsGW = FleetIconsGW(QuietUIO(), gwOptions, fleetProcess.brokerPort)
+
+        try:
+            iconsGW._connectToMQTTServer()
+            gwThread = threading.Thread(target=iconsGW._handleConnection)
+            startCPUSeconds = process_time()
+            startTime = time()
+            gwThread.start()
+            sleep(self._options.duration)
+            cpuSeconds = process_time()-startCPUSeconds
+            elapsedSeconds = time()-startTime
+            # The threads of this process are the icons_gw threads plus the main thread.
+            threadCount = IconsGWBench.GetThreadCount()-1
+            iconsGW.stop()
+            gwThread.join()
+
+        finally:
+            iconsGW._shutDown()
+            resultDict = fleetProcess.shutDown()
+
+        latencyList = []
+        firstPublishTimeDict = resultDict["firstPublishTimeDict"]
+        for unitName, responseTime in resultDict["firstResponseTimeDict"].items():
+            topic = "%s/%s" % (gwOptions.location, unitName)
+            if topic in firstPublishTimeDict:
+                latencyList.append( firstPublishTimeDict[topic]-responseTime )
+        latencyList.sort()
+
+        percentileList = ["p%g=%.1f" % (fraction*100, IconsGWBench.GetPercentile(latencyList, fraction)*1000) for fraction in IconsGWBench.PERCENTILE_LIST]
+        # The RPC provider stand in also connects to the broker.
+        gwConnectCount = resultDict["connectCount"]-1
+        self._uo.info("%5d devices: %5d published, latency (ms) %s max=%.1f, %8.1f rx msg/s, %7.1f publish/s, %7.2f us CPU/s/device, %d MQTT connection(s), %d threads" % (deviceCount,
+                                                                                                                                 len(latencyList),
+                                                                                                                                 " ".join(percentileList),
+                                                                                                                                 latencyList[-1]*1000 if latencyList else 0,
+                                                                                                                                 iconsGW._stats.get(IconsGW.STAT_RX_DATAGRAMS)/elapsedSeconds,
+                                                                                                                                 iconsGW._stats.get(IconsGW.STAT_PUBLISH_SENT)/elapsedSeconds,
+                                                                                                                                 (cpuSeconds*1E6)/elapsedSeconds/deviceCount,
+                                                                                                                                 gwConnectCount,
+                                                                                                                                 threadCount) )
+
+    def benchFleet(self):
+        """@brief Run the icons_gw against simulated fleets of 10 to 10000 devices."""
+        self._uo.info("%s engine, %d second runs, poll period %.1f seconds, response jitter %.2f seconds, services %s." % (self._options.engine, self._options.duration, self._options.poll_period, self._options.jitter, self._options.services) )
+        for deviceCount in IconsGWBench.DEVICE_COUNT_LIST:
+            self._runFleet(deviceCount)
+
+    @staticmethod
+    def GetPublishedDevDict(index):
+        """@brief Get the dict that the icons_gw publishes for a device.
+           @param index The device index.
+           @return The device dict."""
+        devDict = IconsGWBench.GetDevDict(index)
+        devDict["OS"] = "Linux"
+        devDict[IconsGW.JSON_SERVER_SERVICE_LIST] = "WEB:%d,SSH:%d" % (10000+index*2, 10001+index*2)
+        devDict[IconsGW.JSON_INTERFACE] = "eth0"
+        devDict[IconsGW.JSON_LOCATION] = IconsGWBench.LOCATION
+        return devDict
+
+    def _benchCodec(self, name, encodeMethod, devDictList):
+        """@brief Measure the size of the messages produced by a device state encoding
+                  and the time taken to encode and decode them.
+           @param name The name of the encoding.
+           @param encodeMethod The method that encodes a device dict.
+           @param devDictList The device dicts to encode."""
+        startTime = perf_counter()
+        payloadList = [encodeMethod(devDict) for devDict in devDictList]
+        encodeSeconds = perf_counter()-startTime
+
+        payloadList = [payload.encode() if isinstance(payload, str) else payload for payload in payloadList]
+        startTime = perf_counter()
+        for payload in payloadList:
+            DevStateCodec.Decode(payload)
+        decodeSeconds = perf_counter()-startTime
+
+        msgCount = len(payloadList)
+        byteCount = sum( [len(payload) for payload in payloadList] )
+        self._uo.info("%-18s %7.1f bytes/message, encode %6.2f us/message, decode %6.2f us/message" % (name, byteCount/msgCount, (encodeSeconds*1E6)/msgCount, (decodeSeconds*1E6)/msgCount) )
+
+    def benchCodec(self):
+        """@brief Compare the size and encode/decode cost of the JSON and compact device
+                  state encodings."""
+        if not DevStateCodec.IsCompactAvailable():
+            raise Exception("The msgpack python module is required for this benchmark.")
+
+        devDictList = [IconsGWBench.GetPublishedDevDict(index) for index in range(self._options.responses)]
+        self._uo.info("Device state encoding of %d messages." % (len(devDictList)) )
+        self._benchCodec("JSON (indent=4)", lambda devDict: json.dumps(devDict, sort_keys=True, indent=4, separators=(',', ': ')), devDictList)
+        self._benchCodec("JSON", DevStateCodec.EncodeJSON, devDictList)
+        self._benchCodec("compact", DevStateCodec.EncodeCompact, devDictList)
+
+    def _runBursts(self, batchSize, socketBufferSize):
+        """@brief Measure the device messages lost when all the devices respond to an
+                  AYT message at once.
+           @param batchSize The maximum number of messages read in one system call.
+           @param socketBufferSize The socket receive buffer size (0 = OS default)."""
+        gwOptions = IconsGWBench.GetGWOptions()
+        gwOptions.rx_batch_size = batchSize
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        IconsGW.SetRxSocketBuffer(sock, socketBufferSize)
+        sock.bind( (IconsGWBench.LOCALHOST, 0) )
+        # The OS may limit the size (and Linux doubles the size requested).
+        socketBufferSize = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        payloadList = [IconsClient.DictToJSON( IconsGWBench.GetDevDict(index) ).encode() for index in range(0, self._options.devices)]
+
+        iconsGW, stop = self._startEngine(IconsGW.ENGINE_THREAD, gwOptions, sock)
+        try:
+            startErrorCount = IconsGW.GetUDPRxBufferErrors()
+            for _ in range(0, IconsGWBench.BURST_COUNT):
+                sender = DeviceMessageSender(sock.getsockname(), payloadList, len(payloadList), IconsGWBench.BURST_RATE)
+                sender.start()
+                sender.startEvent.set()
+                sender.join()
+                sleep(IconsGWBench.BURST_PAUSE_SECONDS)
+            kernelDropCount = IconsGW.GetUDPRxBufferErrors()-startErrorCount
+
+        finally:
+            stop()
+
+        sentCount = len(payloadList)*IconsGWBench.BURST_COUNT
+        # Don't count the message sent to stop the engine.
+        rxCount = iconsGW._stats.get(IconsGW.STAT_RX_DATAGRAMS)-1
+        syscallCount = max(iconsGW._stats.get(IconsGW.STAT_RX_SYSCALLS)-1, 1)
+        self._uo.info("batch size %3d, socket buffer %8d bytes: %6d/%-6d messages received, %6d dropped by the kernel, %6d dropped from the queue, %5.1f messages/system call" % (batchSize, socketBufferSize, rxCount, sentCount, kernelDropCount, iconsGW._stats.get(IconsGW.STAT_RX_QUEUE_DROPS), rxCount/syscallCount) )
+
+    def benchBurst(self):
+        """@brief Measure how well the icons_gw absorbs the burst of device messages
+                  that follows an AYT message, reading one message per system call with
+                  the OS default socket buffer and then in batches with a larger buffer."""
+        self._uo.info("%d bursts of %d device messages (thread engine)." % (IconsGWBench.BURST_COUNT, self._options.devices) )
+        self._runBursts(1, 0)
+        self._runBursts(DatagramReceiver.DEFAULT_BATCH_SIZE, 0)
+        self._runBursts(DatagramReceiver.DEFAULT_BATCH_SIZE, IconsGW.DEFAULT_RX_SOCKET_BUFFER)
+
+def main():
+    uo = UO()
+
+    opts=OptionParser(usage='Benchmarks for the icons_gw that do not require an ICON server.')
+    opts.add_option("--debug",      help="Enable debugging.", action="store_true", default=False)
+    opts.add_option("--registry",   help="Measure the per response cost of known device lookups for 10 to 10000 devices.", action="store_true", default=False)
+    opts.add_option("--tunnels",    help="Measure the time taken to setup the reverse ssh tunnels for many devices that respond at once.", action="store_true", default=False)
+    opts.add_option("--engines",    help="Compare the CPU used by the thread and asyncio icons_gw engines to process device messages.", action="store_true", default=False)
+    opts.add_option("--fleet",      help="Run the icons_gw against simulated fleets of 10 to 10000 devices and report the time from discovery to publish, the message rates and the CPU used.", action="store_true", default=False)
+    opts.add_option("--burst",      help="Measure the device messages lost when --devices devices respond to an AYT message at once.", action="store_true", default=False)
+    opts.add_option("--codec",      help="Compare the message size and encode/decode cost of the JSON and compact device state encodings.", action="store_true", default=False)
+    opts.add_option("--engine",     help="The icons_gw engine used by the --fleet benchmark (thread or asyncio, default=thread).", type="choice", choices=IconsGW.ENGINE_LIST, default=IconsGW.ENGINE_THREAD)
+    opts.add_option("--duration",   help="The number of seconds each --fleet run lasts (default=%d)." % (IconsGWBench.DEFAULT_FLEET_DURATION) , type="float", default=IconsGWBench.DEFAULT_FLEET_DURATION)
+    opts.add_option("--poll_period",help="The icons_gw AYT poll period in seconds used by the --fleet benchmark (default=%.1f)." % (IconsGWBench.DEFAULT_FLEET_POLL) , type="float", default=IconsGWBench.DEFAULT_FLEET_POLL)
+    opts.add_option("--jitter",     help="The maximum delay in seconds before a simulated device responds to an AYT message (default=%.2f)." % (IconsGWBench.DEFAULT_FLEET_JITTER) , type="float", default=IconsGWBench.DEFAULT_FLEET_JITTER)
+    opts.add_option("--services",   help="The service list of each simulated device (default=%s)." % (SimulatedDeviceFleet.DEFAULT_SERVICE_LIST) , default=SimulatedDeviceFleet.DEFAULT_SERVICE_LIST)
+    opts.add_option("--devices",    help="The number of devices used by the --tunnels, --engines and --burst benchmarks (default=%d)." % (IconsGWBench.DEFAULT_DEVICE_COUNT) , type="int", default=IconsGWBench.DEFAULT_DEVICE_COUNT)
+    opts.add_option("--rpc_latency",    help="The simulated ICONS RPC latency in seconds (default=%.3f)." % (IconsGWBench.DEFAULT_RPC_LATENCY) , type="float", default=IconsGWBench.DEFAULT_RPC_LATENCY)
+    opts.add_option("--tunnel_latency", help="The simulated reverse ssh tunnel request latency in seconds (default=%.3f)." % (IconsGWBench.DEFAULT_TUNNEL_LATENCY) , type="float", default=IconsGWBench.DEFAULT_TUNNEL_LATENCY)
+    opts.add_option("--rate",       help="The number of device messages sent per second by the --engines benchmark (default=%d)." % (IconsGWBench.DEFAULT_MESSAGE_RATE) , type="int", default=IconsGWBench.DEFAULT_MESSAGE_RATE)
+    opts.add_option("--responses",  help="The number of device responses to process in each measurement (default=%d)." % (IconsGWBench.DEFAULT_RESPONSE_COUNT) , type="int", default=IconsGWBench.DEFAULT_RESPONSE_COUNT)
+
+    try:
+        (options, args) = opts.parse_args()
+
+        iconsGWBench = IconsGWBench(uo, options)
+
+        if options.registry:
+            iconsGWBench.benchRegistry()
+
+        elif options.tunnels:
+            iconsGWBench.benchTunnels()
+
+        elif options.engines:
+            iconsGWBench.benchEngines()
+
+        elif options.fleet:
+            iconsGWBench.benchFleet()
+
+        elif options.codec:
+            iconsGWBench.benchCodec()
+
+        elif options.burst:
+            iconsGWBench.benchBurst()
+
+        else:
+            raise Exception("No benchmark selected on the command line.")
+
+    #If the program throws a system exit exception
+    except SystemExit:
+      pass
+    #Don't print error information if CTRL C pressed
+    except KeyboardInterrupt:
+      pass
+    except Exception as ex:
+     if options.debug:
+       raise
+
+     else:
+       uo.error( str(ex) )
+
+if __name__== '__main__':
+    main()
@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 
+import  json
 from    optparse import OptionParser
 from    p3lib.uio import UIO as UO
 import  paho.mqtt.client as mqtt
 
+from    icons_gw.dev_state_codec import DevStateCodec, DevStateCodecError
+
 DEFAULT_HOST = "localhost"
 DEFAULT_PORT = 1883
 DEFAULT_KEEPALIVE_SECONDS = 60
@@ -16,8 +19,19 @@ def onConnect(client, userdata, flags, rc):
     uo.info("Connected to MQTT server")
 
 def onMessage(client, userdata, msg):
-    rxStr = msg.payload.decode()
-    uo.info( "RX: %s" % (rxStr) )
+    if DevStateCodec.IsCompact(msg.payload):
+        # Show compact device state messages as JSON.
+        try:
+            rxStr = json.dumps( DevStateCodec.Decode(msg.payload) )
+        except DevStateCodecError as ex:
+            uo.error( "RX: %s" % (str(ex)) )
+            return
+    else:
+        rxStr = msg.payload.decode()
+    if msg.retain:
+        uo.info( "RX (retained): %s" % (rxStr) )
+    else:
+        uo.info( "RX: %s" % (rxStr) )
 
 def main():
 
@@ -19,5 +19,5 @@ setup(
     install_requires=[
         ['p3lib>=1.1.34','paho-mqtt','paramiko','texttable'],                         # A python list of required module dependencies (optionally including versions)
     ],
-    scripts=['scripts/icons_gw','scripts/icons_json_check','scripts/mqtt_subscribe'], # A list of command line startup scripts to be installed.
+    scripts=['scripts/icons_gw','scripts/icons_json_check','scripts/mqtt_subscribe','scripts/icons_gw_bench'], # A list of command line startup scripts to be installed.
 )
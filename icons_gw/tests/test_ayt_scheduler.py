@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import  unittest
+
+from    icons_gw.icons_gw import AYTScheduler
+
+class AYTSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._scheduler = AYTScheduler(5, 60)
+
+    def test_first_poll_now(self):
+        self.assertEqual(self._scheduler.getWaitSeconds(now=100), 0)
+        self.assertEqual(self._scheduler.period, 5)
+
+    def test_min_period_limited(self):
+        scheduler = AYTScheduler(120, 60)
+        self.assertEqual(scheduler.period, 60)
+
+    def test_backoff(self):
+        # The poll after startup is a change so the period stays at the minimum.
+        self._scheduler.polled(now=100)
+        self.assertEqual(self._scheduler.period, 5)
+        self.assertEqual(self._scheduler.getWaitSeconds(now=102), 3)
+
+        periodList = []
+        for now in range(105, 200, 5):
+            self._scheduler.polled(now=now)
+            periodList.append(self._scheduler.period)
+        self.assertEqual(periodList[:5], [10, 20, 40, 60, 60])
+
+    def test_wait_not_negative(self):
+        self._scheduler.polled(now=100)
+        self.assertEqual(self._scheduler.getWaitSeconds(now=200), 0)
+
+    def test_changed(self):
+        self._scheduler.polled(now=100)
+        self._scheduler.polled(now=105)
+        self._scheduler.polled(now=115)
+        self.assertEqual(self._scheduler.period, 20)
+
+        wakeList = []
+        self._scheduler.setWakeCallback( lambda: wakeList.append(True) )
+        self._scheduler.changed()
+        self.assertEqual(wakeList, [True])
+        self.assertEqual(self._scheduler.period, 5)
+        self.assertEqual(self._scheduler.getWaitSeconds(now=116), 4)
+
+        # The poll after a change stays at the minimum period.
+        self._scheduler.polled(now=120)
+        self.assertEqual(self._scheduler.period, 5)
+
+    def test_changed_poll_now(self):
+        self._scheduler.polled(now=100)
+        self._scheduler.changed(pollNow=True)
+        self.assertEqual(self._scheduler.getWaitSeconds(now=101), 0)
+        self._scheduler.polled(now=101)
+        self.assertEqual(self._scheduler.getWaitSeconds(now=102), 4)
+
+    def test_missing_device(self):
+        self._scheduler.polled(now=100)
+        self._scheduler.deviceSeen("192.168.1.1")
+        self._scheduler.deviceSeen("192.168.1.2")
+        self._scheduler.polled(now=105)
+        self._scheduler.deviceSeen("192.168.1.1")
+        self._scheduler.deviceSeen("192.168.1.2")
+        self._scheduler.polled(now=115)
+        self.assertEqual(self._scheduler.period, 20)
+
+        # A device that stops responding restarts polling at the minimum period.
+        self._scheduler.deviceSeen("192.168.1.1")
+        self._scheduler.polled(now=135)
+        self.assertEqual(self._scheduler.period, 5)
+
+    def test_new_device_no_change(self):
+        # A new device is reported to the scheduler by changed(), not by deviceSeen().
+        self._scheduler.polled(now=100)
+        self._scheduler.polled(now=105)
+        self._scheduler.deviceSeen("192.168.1.1")
+        self._scheduler.polled(now=115)
+        self.assertEqual(self._scheduler.period, 20)
+
+    def test_reset(self):
+        self._scheduler.polled(now=100)
+        self._scheduler.polled(now=105)
+        self._scheduler.reset()
+        self.assertEqual(self._scheduler.period, 5)
+        self.assertEqual(self._scheduler.getWaitSeconds(now=106), 0)
+
+    def test_counts(self):
+        self._scheduler.polled(now=100, sentCount=3)
+        self._scheduler.polled(now=105, sentCount=2)
+        self.assertEqual(self._scheduler.pollCount, 2)
+        self.assertEqual(self._scheduler.sentCount, 5)
+
+if __name__ == '__main__':
+    unittest.main()
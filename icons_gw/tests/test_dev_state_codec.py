@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import  json
+import  unittest
+
+from    icons_gw.dev_state_codec import DevStateCodec, DevStateCodecError
+
+DEV_DICT = {"IP_ADDRESS":          "192.168.1.1",
+            "UNIT_NAME":           "DEV1",
+            "PRODUCT_ID":          "YDEV",
+            "SERVICE_LIST":        "WEB:80,SSH:22",
+            "SERVER_SERVICE_LIST": "WEB:40001,SSH:40002",
+            "LOCATION":            "HOME",
+            "OFFLINE":             False,
+            "CUSTOM":              {"TEMP": 21.5, "TAGS": ["A", "B"]}}
+
+@unittest.skipUnless(DevStateCodec.IsCompactAvailable(), "msgpack is not installed.")
+class DevStateCodecCompactTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        payload = DevStateCodec.EncodeCompact(DEV_DICT)
+        self.assertTrue(DevStateCodec.IsCompact(payload))
+        self.assertEqual(DevStateCodec.Decode(payload), DEV_DICT)
+
+    def test_smaller_than_json(self):
+        payload = DevStateCodec.EncodeCompact(DEV_DICT)
+        self.assertLess(len(payload), len(DevStateCodec.EncodeJSON(DEV_DICT)))
+
+    def test_unknown_keys_kept(self):
+        devDict = {"NEW_KEY": 1, "IP_ADDRESS": "192.168.1.1"}
+        self.assertEqual(DevStateCodec.Decode(DevStateCodec.EncodeCompact(devDict)), devDict)
+
+    def test_int_keys_outside_key_list(self):
+        # Only int keys that index the key list are mapped to key names.
+        import msgpack
+        payload = bytes( (DevStateCodec.FORMAT_COMPACT_V1,) ) + msgpack.packb({0: "192.168.1.1", -1: "A", 1000: "B"})
+        self.assertEqual(DevStateCodec.Decode(payload), {"IP_ADDRESS": "192.168.1.1", -1: "A", 1000: "B"})
+
+    def test_invalid(self):
+        payload = bytes( (DevStateCodec.FORMAT_COMPACT_V1,) ) + b"\xc1"
+        self.assertRaises(DevStateCodecError, DevStateCodec.Decode, payload)
+
+    def test_not_a_map(self):
+        import msgpack
+        payload = bytes( (DevStateCodec.FORMAT_COMPACT_V1,) ) + msgpack.packb([1, 2])
+        self.assertRaises(DevStateCodecError, DevStateCodec.Decode, payload)
+
+class DevStateCodecJSONTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        payload = DevStateCodec.EncodeJSON(DEV_DICT).encode()
+        self.assertFalse(DevStateCodec.IsCompact(payload))
+        self.assertEqual(DevStateCodec.Decode(payload), DEV_DICT)
+
+    def test_indented(self):
+        # ydev sends indented JSON.
+        payload = json.dumps(DEV_DICT, indent=4).encode()
+        self.assertEqual(DevStateCodec.Decode(payload), DEV_DICT)
+
+    def test_empty(self):
+        self.assertFalse(DevStateCodec.IsCompact(b""))
+        self.assertIsNone(DevStateCodec.Decode(b""))
+
+    def test_key_list_unique(self):
+        self.assertEqual(len(DevStateCodec.KEY_LIST_V1), len(DevStateCodec.KEY_CODE_DICT_V1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import  json
+import  unittest
+
+from    icons_gw.icons_gw import IconsGW, DeviceRegistry
+from    icons_gw.icons_gw_bench import IconsGWBench, BenchIconsGW, NullMQTTClient
+from    icons_gw.device_fleet import QuietUIO
+
+class RecordingMQTTClient(NullMQTTClient):
+    """@brief Records the messages published."""
+
+    def __init__(self):
+        NullMQTTClient.__init__(self)
+        self.publishList = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.publishList.append( (topic, payload, retain) )
+        return NullMQTTClient.publish(self, topic, payload, qos, retain)
+
+class ReaperIconsGW(BenchIconsGW):
+    """@brief A gateway whose reverse ssh tunnels are always stopped."""
+
+    def __init__(self, uo, options):
+        BenchIconsGW.__init__(self, uo, options)
+        self._mqttClient = RecordingMQTTClient()
+        self._mqttClient.on_publish = self.on_publish
+        self.stoppedPortList = []
+
+    def _stopRevSSHTunnel(self, serverPort):
+        self.stoppedPortList.append(serverPort)
+        return True
+
+class DeviceReaperTest(unittest.TestCase):
+
+    def setUp(self):
+        options = IconsGWBench.GetGWOptions()
+        options.tunnel_workers = 0
+        self._gw = ReaperIconsGW(QuietUIO(), options)
+        self._devDict = IconsGWBench.GetDevDict(1)
+        self._ipAddress = self._devDict[IconsGW.JSON_IP_ADDRESS_KEY]
+        self._gw._processDevDict( dict(self._devDict) )
+        self._serverPortList = [self._gw._portAssignmentCache.get(self._ipAddress, "WEB"),
+                                self._gw._portAssignmentCache.get(self._ipAddress, "SSH")]
+        self._gw._mqttClient.publishList = []
+
+    def _setLastSeen(self, secondsAgo):
+        lastSeen = self._gw._deviceRegistry.getLastSeen(self._ipAddress)
+        self._gw._deviceRegistry.touch(self._ipAddress, now=lastSeen-secondsAgo)
+
+    def test_not_missing(self):
+        self._setLastSeen(self._gw._getMissingDevSeconds()-5)
+        self._gw._removeMissingDevices()
+        self.assertIn(self._ipAddress, self._gw._deviceRegistry)
+        self.assertEqual(self._gw._mqttClient.publishList, [])
+
+    def test_reap(self):
+        self._setLastSeen(self._gw._getMissingDevSeconds()+1)
+        self._gw._removeMissingDevices()
+        self.assertNotIn(self._ipAddress, self._gw._deviceRegistry)
+
+        # The tunnels are stopped and the ports are returned to the allocator.
+        self.assertEqual(sorted(self._gw.stoppedPortList), sorted(self._serverPortList))
+        self.assertEqual(self._gw._serverPortAllocator.getPorts(2, self._serverPortList), self._serverPortList)
+
+        # The ports are kept in the port cache until it expires.
+        self.assertEqual(self._gw._portAssignmentCache.get(self._ipAddress, "WEB"), self._serverPortList[0])
+
+        topic, payload, retain = self._gw._mqttClient.publishList[0]
+        self.assertEqual(topic, "%s/DEV1" % (IconsGWBench.LOCATION) )
+        self.assertEqual(json.loads(payload), {IconsGW.JSON_UNIT_NAME: "DEV1",
+                                               IconsGW.JSON_LOCATION:  IconsGWBench.LOCATION,
+                                               IconsGW.JSON_OFFLINE:   True})
+        # The retained state of the device is then cleared.
+        self.assertEqual(self._gw._mqttClient.publishList[1], (topic, None, True))
+
+    def test_reap_no_retain(self):
+        self._gw._options.no_retain = True
+        self._setLastSeen(self._gw._getMissingDevSeconds()+1)
+        self._gw._removeMissingDevices()
+        self.assertEqual(len(self._gw._mqttClient.publishList), 1)
+
+    def test_respond_after_reap(self):
+        self._setLastSeen(self._gw._getMissingDevSeconds()+1)
+        self._gw._removeMissingDevices()
+        self._gw._processDevDict( dict(self._devDict) )
+        self.assertIn(self._ipAddress, self._gw._deviceRegistry)
+        # The device gets the same ports back.
+        self.assertEqual(DeviceRegistry.GetServerPortList( self._gw._deviceRegistry.get(self._ipAddress) ), self._serverPortList)
+
+if __name__ == '__main__':
+    unittest.main()
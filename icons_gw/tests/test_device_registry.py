@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+import  unittest
+
+from    icons_gw.icons_gw import DeviceRegistry, IconsClient
+
+def getDevDict(ipAddress, unitName, serverServiceList=None):
+    """@brief Get a device dict as received from a device.
+       @param ipAddress The IP address of the device.
+       @param unitName The UNIT_NAME of the device.
+       @param serverServiceList The SERVER_SERVICE_LIST of the device or None.
+       @return The device dict."""
+    devDict = {IconsClient.JSON_IP_ADDRESS_KEY: ipAddress,
+               IconsClient.JSON_UNIT_NAME:      unitName}
+    if serverServiceList is not None:
+        devDict[IconsClient.JSON_SERVER_SERVICE_LIST] = serverServiceList
+    return devDict
+
+class DeviceRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self._registry = DeviceRegistry()
+
+    def test_GetServerPortList(self):
+        devDict = getDevDict("192.168.1.1", "DEV1", "WEB:40001,SSH:40002,BAD,HTTP:x")
+        self.assertEqual(DeviceRegistry.GetServerPortList(devDict), [40001, 40002])
+        self.assertEqual(DeviceRegistry.GetServerPortList(getDevDict("192.168.1.1", "DEV1")), [])
+
+    def test_add(self):
+        devDict = getDevDict("192.168.1.1", "DEV1", "WEB:40001,SSH:40002")
+        self._registry.add(devDict)
+        self.assertEqual(len(self._registry), 1)
+        self.assertIn("192.168.1.1", self._registry)
+        self.assertIs(self._registry.get("192.168.1.1"), devDict)
+        self.assertEqual(self._registry.getByUnitName("DEV1"), [devDict])
+        self.assertIs(self._registry.getByServerPort(40002), devDict)
+        self.assertEqual(self._registry.getServerPortCount(), 2)
+        self.assertEqual(self._registry.getDevList(), [devDict])
+
+    def test_unknown(self):
+        self.assertNotIn("192.168.1.1", self._registry)
+        self.assertIsNone(self._registry.get("192.168.1.1"))
+        self.assertEqual(self._registry.getByUnitName("DEV1"), [])
+        self.assertIsNone(self._registry.getByServerPort(40001))
+        self.assertIsNone(self._registry.remove("192.168.1.1"))
+
+    def test_getByUnitName_shared(self):
+        devDict1 = getDevDict("192.168.1.1", "DEV")
+        devDict2 = getDevDict("192.168.1.2", "DEV")
+        self._registry.add(devDict1)
+        self._registry.add(devDict2)
+        devList = self._registry.getByUnitName("DEV")
+        self.assertEqual(len(devList), 2)
+        self.assertIn(devDict1, devList)
+        self.assertIn(devDict2, devList)
+
+    def test_add_replaces(self):
+        self._registry.add( getDevDict("192.168.1.1", "DEV1", "WEB:40001") )
+        devDict = getDevDict("192.168.1.1", "DEV2", "WEB:40003")
+        self._registry.add(devDict)
+        self.assertEqual(len(self._registry), 1)
+        self.assertEqual(self._registry.getByUnitName("DEV1"), [])
+        self.assertEqual(self._registry.getByUnitName("DEV2"), [devDict])
+        self.assertIsNone(self._registry.getByServerPort(40001))
+        self.assertIs(self._registry.getByServerPort(40003), devDict)
+        self.assertEqual(self._registry.getServerPortCount(), 1)
+
+    def test_remove(self):
+        devDict = getDevDict("192.168.1.1", "DEV1", "WEB:40001")
+        self._registry.add(devDict)
+        self._registry.touch("192.168.1.1", now=100)
+        self.assertIs(self._registry.remove("192.168.1.1"), devDict)
+        self.assertEqual(len(self._registry), 0)
+        self.assertEqual(self._registry.getByUnitName("DEV1"), [])
+        self.assertIsNone(self._registry.getByServerPort(40001))
+        self.assertIsNone(self._registry.getLastSeen("192.168.1.1"))
+
+    def test_remove_keeps_reassigned_port(self):
+        # A server port reallocated to another device must stay indexed to that device.
+        self._registry.add( getDevDict("192.168.1.1", "DEV1", "WEB:40001") )
+        devDict = getDevDict("192.168.1.2", "DEV2", "WEB:40001")
+        self._registry.add(devDict)
+        self._registry.remove("192.168.1.1")
+        self.assertIs(self._registry.getByServerPort(40001), devDict)
+
+    def test_clear(self):
+        self._registry.add( getDevDict("192.168.1.1", "DEV1", "WEB:40001") )
+        self._registry.touch("192.168.1.1", now=100)
+        self._registry.clear()
+        self.assertEqual(len(self._registry), 0)
+        self.assertEqual(self._registry.getServerPortCount(), 0)
+        self.assertEqual(self._registry.getMissingDevList(10, now=1000), [])
+
+    def test_touch_unknown(self):
+        self._registry.touch("192.168.1.1", now=100)
+        self.assertIsNone(self._registry.getLastSeen("192.168.1.1"))
+        self.assertFalse(self._registry.isMissing("192.168.1.1", 10, now=1000))
+
+    def test_missing(self):
+        devDict1 = getDevDict("192.168.1.1", "DEV1")
+        devDict2 = getDevDict("192.168.1.2", "DEV2")
+        self._registry.add(devDict1)
+        self._registry.add(devDict2)
+        self._registry.touch("192.168.1.1", now=100)
+        self._registry.touch("192.168.1.2", now=105)
+        self.assertEqual(self._registry.getLastSeen("192.168.1.1"), 100)
+
+        self.assertFalse(self._registry.isMissing("192.168.1.1", 30, now=130))
+        self.assertTrue(self._registry.isMissing("192.168.1.1", 30, now=131))
+        self.assertEqual(self._registry.getMissingDevList(30, now=131), [devDict1])
+
+        self._registry.touch("192.168.1.1", now=131)
+        self.assertEqual(self._registry.getMissingDevList(30, now=136), [devDict2])
+
+if __name__ == '__main__':
+    unittest.main()
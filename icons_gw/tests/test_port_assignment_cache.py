@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import  os
+import  json
+import  shutil
+import  tempfile
+import  unittest
+
+from    icons_gw.icons_gw import PortAssignmentCache
+
+class PortAssignmentCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpFolder = tempfile.mkdtemp()
+        self._filename = os.path.join(self._tmpFolder, PortAssignmentCache.FILENAME)
+        self._cache = PortAssignmentCache(self._filename, "LOC1")
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpFolder)
+
+    def _getLoadedCache(self, location="LOC1"):
+        """@brief Save the cache and load it into a new instance.
+           @param location The location of the new instance."""
+        self._cache.save()
+        cache = PortAssignmentCache(self._filename, location)
+        cache.load()
+        return cache
+
+    def test_set(self):
+        self._cache.set("192.168.1.1", "WEB", 10000)
+        self._cache.set("192.168.1.1", "SSH", 10001)
+        self.assertEqual(self._cache.get("192.168.1.1", "WEB"), 10000)
+        self.assertEqual(self._cache.get("192.168.1.1", "SSH"), 10001)
+        self.assertIsNone(self._cache.get("192.168.1.1", "FTP"))
+        self.assertIsNone(self._cache.get("192.168.1.2", "WEB"))
+        self.assertEqual(sorted(self._cache.getPortList()), [10000, 10001])
+
+    def test_set_new_port(self):
+        self._cache.set("192.168.1.1", "WEB", 10000)
+        self._cache.set("192.168.1.1", "WEB", 10001)
+        self.assertEqual(self._cache.get("192.168.1.1", "WEB"), 10001)
+        self.assertEqual(self._cache.getPortList(), [10001])
+
+    def test_reassign_port_other_device(self):
+        # The ICONS gave a port used before by another device to a new device.
+        self._cache.set("192.168.1.1", "WEB", 10000)
+        self._cache.set("192.168.1.1", "SSH", 10001)
+        self._cache.set("192.168.1.2", "WEB", 10000)
+        self.assertIsNone(self._cache.get("192.168.1.1", "WEB"))
+        self.assertEqual(self._cache.get("192.168.1.1", "SSH"), 10001)
+        self.assertEqual(self._cache.get("192.168.1.2", "WEB"), 10000)
+        self.assertEqual(len(self._cache), 2)
+
+    def test_reassign_port_same_device(self):
+        self._cache.set("192.168.1.1", "WEB", 10000)
+        self._cache.set("192.168.1.1", "SSH", 10000)
+        self.assertIsNone(self._cache.get("192.168.1.1", "WEB"))
+        self.assertEqual(self._cache.get("192.168.1.1", "SSH"), 10000)
+        self.assertEqual(len(self._cache), 1)
+
+    def test_reassign_last_port(self):
+        self._cache.set("192.168.1.1", "WEB", 10000)
+        self._cache.setRemoved("192.168.1.1", now=100)
+        self._cache.set("192.168.1.2", "WEB", 10000)
+        # The removed device has no ports left so it is forgotten.
+        self.assertEqual(self._cache.expire(10, now=1000), 0)
+        self.assertEqual(self._cache.getPortList(), [10000])
+
+    def test_remove(self):
+        self._cache.set("192.168.1.1", "WEB", 10000)
+        self._cache.set("192.168.1.2", "WEB", 10001)
+        self._cache.remove("192.168.1.1")
+        self.assertIsNone(self._cache.get("192.168.1.1", "WEB"))
+        self.assertEqual(self._cache.getPortList(), [10001])
+        self._cache.remove("192.168.1.3")
+
+    def test_save_load(self):
+        self._cache.set("192.168.1.1", "WEB", 10000)
+        self._cache.set("192.168.1.2", "SSH", 10001)
+        self._cache.setRemoved("192.168.1.2", now=100)
+        cache = self._getLoadedCache()
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("192.168.1.1", "WEB"), 10000)
+        self.assertEqual(cache.get("192.168.1.2", "SSH"), 10001)
+        # The removed time is kept.
+        self.assertEqual(cache.expire(50, now=149), 0)
+        self.assertEqual(cache.expire(50, now=151), 1)
+
+    def test_load_other_location(self):
+        self._cache.set("192.168.1.1", "WEB", 10000)
+        cache = self._getLoadedCache("LOC2")
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get("192.168.1.1", "WEB"))
+
+    def test_load_replaces(self):
+        self._cache.set("192.168.1.1", "WEB", 10000)
+        self._cache.save()
+        self._cache.set("192.168.1.2", "WEB", 10001)
+        self.assertEqual(self._cache.load(), 1)
+        self.assertIsNone(self._cache.get("192.168.1.2", "WEB"))
+
+    def test_load_no_file(self):
+        self.assertEqual(self._cache.load(), 0)
+        cache = PortAssignmentCache("", "LOC1")
+        self.assertEqual(cache.load(), 0)
+        cache.set("192.168.1.1", "WEB", 10000)
+        cache.save()
+
+    def test_save_unchanged(self):
+        self._cache.set("192.168.1.1", "WEB", 10000)
+        self._cache.save()
+        os.remove(self._filename)
+        self._cache.set("192.168.1.1", "WEB", 10000)
+        self._cache.save()
+        self.assertFalse(os.path.isfile(self._filename))
+
+    def test_save_failed(self):
+        self._cache.set("192.168.1.1", "WEB", 10000)
+        os.mkdir(self._filename)
+        self.assertRaises(OSError, self._cache.save)
+        os.rmdir(self._filename)
+        # The assignments are saved on the next attempt.
+        self._cache.save()
+        with open(self._filename) as fd:
+            cacheDict = json.load(fd)
+        self.assertEqual(cacheDict[PortAssignmentCache.PORTS_KEY], {"192.168.1.1": {"WEB": 10000}})
+
+    def test_set_removed_expire(self):
+        self._cache.set("192.168.1.1", "WEB", 10000)
+        self._cache.set("192.168.1.2", "WEB", 10001)
+        self._cache.setRemoved("192.168.1.1", now=100)
+        # A device that is not known is ignored.
+        self._cache.setRemoved("192.168.1.3", now=100)
+        self.assertEqual(self._cache.expire(60, now=160), 0)
+        self.assertEqual(self._cache.get("192.168.1.1", "WEB"), 10000)
+        self.assertEqual(self._cache.expire(60, now=161), 1)
+        self.assertIsNone(self._cache.get("192.168.1.1", "WEB"))
+        self.assertEqual(self._cache.getPortList(), [10001])
+
+    def test_set_clears_removed(self):
+        self._cache.set("192.168.1.1", "WEB", 10000)
+        self._cache.setRemoved("192.168.1.1", now=100)
+        # The device is back before its ports expire.
+        self._cache.set("192.168.1.1", "WEB", 10000)
+        self.assertEqual(self._cache.expire(60, now=1000), 0)
+        self.assertEqual(self._cache.get("192.168.1.1", "WEB"), 10000)
+
+if __name__ == '__main__':
+    unittest.main()
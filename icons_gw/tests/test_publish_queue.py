@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import  unittest
+import  paho.mqtt.client as mqtt
+
+from    icons_gw.icons_gw import PublishQueue, PublishTopicOptions
+
+class FakeMQTTClient(object):
+    """@brief Stands in for the paho MQTT client and records the messages published."""
+
+    def __init__(self):
+        self.publishList = []
+        self.rc = mqtt.MQTT_ERR_SUCCESS
+        # If set this is called with the message ID before publish() returns.
+        self.publishedCallback = None
+        self._nextMID = 1
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        msgInfo = mqtt.MQTTMessageInfo(self._nextMID)
+        msgInfo.rc = self.rc
+        if self.rc == mqtt.MQTT_ERR_SUCCESS:
+            self.publishList.append( (topic, payload, qos, retain) )
+            self._nextMID = self._nextMID + 1
+            if self.publishedCallback:
+                self.publishedCallback(msgInfo.mid)
+        return msgInfo
+
+class PublishQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self._topicOptions = PublishTopicOptions("LOC/QOS1:1", "LOC/#")
+        self._mqttClient = FakeMQTTClient()
+
+    def _getTopicList(self):
+        return [entry[0] for entry in self._mqttClient.publishList]
+
+    def test_publish(self):
+        publishQueue = PublishQueue(10, 0, self._topicOptions)
+        self.assertTrue(publishQueue.put("LOC/DEV1", "1"))
+        self.assertTrue(publishQueue.put("LOC/QOS1", "2"))
+        self.assertTrue(publishQueue.put("OTHER", "3"))
+        self.assertEqual(publishQueue.publish(self._mqttClient), 3)
+        self.assertEqual(len(publishQueue), 0)
+        self.assertEqual(self._mqttClient.publishList, [("LOC/DEV1", "1", 0, True),
+                                                        ("LOC/QOS1", "2", 1, True),
+                                                        ("OTHER",    "3", 0, False)])
+
+    def test_coalesce_keeps_position(self):
+        publishQueue = PublishQueue(10, 0, self._topicOptions)
+        publishQueue.put("LOC/DEV1", "1")
+        publishQueue.put("LOC/DEV2", "2")
+        publishQueue.put("LOC/DEV1", "3")
+        self.assertEqual(len(publishQueue), 2)
+        self.assertEqual(publishQueue.coalesceCount, 1)
+        publishQueue.publish(self._mqttClient)
+        self.assertEqual(self._mqttClient.publishList, [("LOC/DEV1", "3", 0, True),
+                                                        ("LOC/DEV2", "2", 0, True)])
+
+    def test_full(self):
+        publishQueue = PublishQueue(2, 0, self._topicOptions)
+        publishQueue.put("LOC/DEV1", "1")
+        publishQueue.put("LOC/DEV2", "2")
+        self.assertFalse(publishQueue.put("LOC/DEV3", "3"))
+        # A message for a topic already queued replaces it when the queue is full.
+        self.assertTrue(publishQueue.put("LOC/DEV1", "4"))
+        self.assertEqual(publishQueue.dropCount, 1)
+        self.assertEqual(len(publishQueue), 2)
+
+    def test_clear_retained_after_message(self):
+        publishQueue = PublishQueue(10, 0, self._topicOptions)
+        publishQueue.put("LOC/DEV1", "1")
+        publishQueue.put("LOC/DEV2", "2")
+        publishQueue.clearRetained("LOC/DEV1")
+        # Coalescing the message does not move it after the clear request.
+        publishQueue.put("LOC/DEV2", "3")
+        publishQueue.clearRetained("LOC/DEV2")
+        publishQueue.publish(self._mqttClient)
+        self.assertEqual(self._mqttClient.publishList, [("LOC/DEV1", "1",  0, True),
+                                                        ("LOC/DEV2", "3",  0, True),
+                                                        ("LOC/DEV1", None, 0, True),
+                                                        ("LOC/DEV2", None, 0, True)])
+
+    def test_clear_retained_discarded(self):
+        publishQueue = PublishQueue(10, 0, self._topicOptions)
+        publishQueue.clearRetained("LOC/DEV1")
+        # The device came back before the clear request was sent.
+        publishQueue.put("LOC/DEV1", "1")
+        publishQueue.publish(self._mqttClient)
+        self.assertEqual(self._mqttClient.publishList, [("LOC/DEV1", "1", 0, True)])
+
+    def test_clear_retained_not_limited(self):
+        publishQueue = PublishQueue(1, 0, self._topicOptions)
+        publishQueue.put("LOC/DEV1", "1")
+        publishQueue.clearRetained("LOC/DEV1")
+        publishQueue.clearRetained("LOC/DEV2")
+        self.assertEqual(publishQueue.publish(self._mqttClient), 3)
+
+    def test_in_flight_limit(self):
+        publishQueue = PublishQueue(10, 2, self._topicOptions)
+        for index in range(0, 4):
+            publishQueue.put("LOC/DEV%d" % (index), str(index))
+        self.assertEqual(publishQueue.publish(self._mqttClient), 2)
+        self.assertEqual(publishQueue.inFlightCount, 2)
+        self.assertEqual(len(publishQueue), 2)
+
+        latency = publishQueue.published(1)
+        self.assertGreaterEqual(latency, 0)
+        self.assertEqual(publishQueue.inFlightCount, 1)
+        self.assertEqual(publishQueue.publish(self._mqttClient), 1)
+        self.assertEqual(self._getTopicList(), ["LOC/DEV0", "LOC/DEV1", "LOC/DEV2"])
+
+        # Other messages (E.G RPC requests) do not change the in flight count.
+        self.assertIsNone(publishQueue.published(100))
+        self.assertEqual(publishQueue.inFlightCount, 2)
+
+    def test_published_before_publish_returns(self):
+        publishQueue = PublishQueue(10, 1, self._topicOptions)
+        self._mqttClient.publishedCallback = publishQueue.published
+        latencyList = []
+        for index in range(0, 3):
+            publishQueue.put("LOC/DEV%d" % (index), str(index))
+        self.assertEqual(publishQueue.publish(self._mqttClient, latencyList.append), 3)
+        self.assertEqual(publishQueue.inFlightCount, 0)
+        self.assertEqual(len(latencyList), 3)
+
+    def test_requeue_on_error(self):
+        publishQueue = PublishQueue(10, 0, self._topicOptions)
+        publishQueue.put("LOC/DEV1", "1")
+        publishQueue.put("LOC/DEV2", "2")
+        self._mqttClient.rc = mqtt.MQTT_ERR_NO_CONN
+        self.assertEqual(publishQueue.publish(self._mqttClient), 0)
+        self.assertEqual(len(publishQueue), 2)
+        self.assertEqual(publishQueue.inFlightCount, 0)
+
+        self._mqttClient.rc = mqtt.MQTT_ERR_SUCCESS
+        self.assertEqual(publishQueue.publish(self._mqttClient), 2)
+        self.assertEqual(self._getTopicList(), ["LOC/DEV1", "LOC/DEV2"])
+
+    def test_requeue_clear_retained(self):
+        publishQueue = PublishQueue(10, 0, self._topicOptions)
+        publishQueue.clearRetained("LOC/DEV1")
+        self._mqttClient.rc = mqtt.MQTT_ERR_NO_CONN
+        publishQueue.publish(self._mqttClient)
+        self._mqttClient.rc = mqtt.MQTT_ERR_SUCCESS
+        publishQueue.publish(self._mqttClient)
+        self.assertEqual(self._mqttClient.publishList, [("LOC/DEV1", None, 0, True)])
+
+    def test_reset_in_flight(self):
+        publishQueue = PublishQueue(10, 2, self._topicOptions)
+        for index in range(0, 3):
+            publishQueue.put("LOC/DEV%d" % (index), str(index))
+        publishQueue.publish(self._mqttClient)
+        self.assertEqual(publishQueue.inFlightCount, 2)
+
+        # The messages handed to the previous MQTT client are never reported as published.
+        publishQueue.resetInFlight()
+        self.assertEqual(publishQueue.inFlightCount, 0)
+        self.assertIsNone(publishQueue.published(1))
+        self.assertEqual(publishQueue.publish(self._mqttClient), 1)
+
+    def test_clear(self):
+        publishQueue = PublishQueue(10, 0, self._topicOptions)
+        publishQueue.put("LOC/DEV1", "1")
+        publishQueue.clearRetained("LOC/DEV1")
+        publishQueue.clear()
+        self.assertEqual(len(publishQueue), 0)
+        self.assertEqual(publishQueue.publish(self._mqttClient), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import  json
+import  asyncio
+import  threading
+import  unittest
+import  paho.mqtt.client as mqtt
+
+from    p3lib.mqtt_rpc import MQTTRPCClient
+
+from    icons_gw.icons_gw import IconsClient, IconsGW, AsyncIconsGW, IconsRPCError
+from    icons_gw.icons_gw_bench import IconsGWBench
+from    icons_gw.device_fleet import QuietUIO
+
+class RPCMessage(object):
+    """@brief Stands in for a paho MQTTMessage."""
+
+    def __init__(self, msgDict):
+        self.payload = json.dumps(msgDict).encode()
+
+class RequestRecorder(object):
+    """@brief Stands in for the paho MQTT client and records the RPC requests sent."""
+
+    def __init__(self):
+        self.requestList = []
+        self._condition = threading.Condition()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        with self._condition:
+            self.requestList.append( json.loads(payload) )
+            self._condition.notify_all()
+        return mqtt.MQTTMessageInfo(len(self.requestList))
+
+    def waitForRequests(self, count):
+        """@brief Wait until count RPC requests have been sent.
+           @return A list of the requests sorted by RPC ID."""
+        with self._condition:
+            self._condition.wait_for(lambda: len(self.requestList) >= count, 5)
+            return sorted(self.requestList, key=lambda requestDict: requestDict[IconsClient.RPC_ID_DICT_KEY])
+
+def getResponse(requestDict, response, echoID=True):
+    """@brief Get the response that the RPC provider returns for a request.
+       @param requestDict The RPC request.
+       @param response The response to the RPC.
+       @param echoID If False the RPC ID is not returned (older RPC providers).
+       @return An RPCMessage instance."""
+    responseDict = dict(requestDict)
+    responseDict[MQTTRPCClient.RESPONSE_DICT_KEY] = response
+    if not echoID:
+        del responseDict[IconsClient.RPC_ID_DICT_KEY]
+    return RPCMessage(responseDict)
+
+class RPCRoutingTest(unittest.TestCase):
+    """@brief Tests routing RPC responses to the threads waiting for them."""
+
+    def setUp(self):
+        self._gw = IconsGW(QuietUIO(), IconsGWBench.GetGWOptions())
+        self._gw._mqttClient = RequestRecorder()
+        self._resultDict = {}
+        self._threadList = []
+
+    def tearDown(self):
+        for thread in self._threadList:
+            thread.join(IconsClient.RPC_TIMEOUT_SECONDS+1)
+
+    def _callRPC(self, name):
+        """@brief Call an RPC on another thread. The result is stored by the method name."""
+        def callRPC():
+            try:
+                self._resultDict[name] = self._gw._rpcCall(name, [])
+
+            except IconsRPCError as ex:
+                self._resultDict[name] = ex
+        thread = threading.Thread(target=callRPC)
+        thread.start()
+        self._threadList.append(thread)
+
+    def _joinAll(self):
+        for thread in self._threadList:
+            thread.join(5)
+
+    def test_route_by_id(self):
+        for name in ("first", "second", "third"):
+            self._callRPC(name)
+        requestList = self._gw._mqttClient.waitForRequests(3)
+        # Respond in reverse order.
+        for requestDict in reversed(requestList):
+            self._gw._onRPCMessage(None, None, getResponse(requestDict, requestDict[MQTTRPCClient.METHOD_DICT_KEY]+"_response"))
+        self._joinAll()
+        self.assertEqual(self._resultDict, {"first":  "first_response",
+                                            "second": "second_response",
+                                            "third":  "third_response"})
+        self.assertFalse(self._gw._rpcSerialised)
+
+    def test_no_id_oldest_waiter(self):
+        self._callRPC("first")
+        self._gw._mqttClient.waitForRequests(1)
+        self._callRPC("second")
+        requestList = self._gw._mqttClient.waitForRequests(2)
+        # Without an RPC ID the response goes to the oldest RPC in progress.
+        self._gw._onRPCMessage(None, None, getResponse(requestList[1], 1, echoID=False))
+        self._threadList[0].join(5)
+        self.assertEqual(self._resultDict, {"first": 1})
+        self.assertTrue(self._gw._rpcSerialised)
+        self._gw._onRPCMessage(None, None, getResponse(requestList[1], 2, echoID=False))
+        self._joinAll()
+        self.assertEqual(self._resultDict, {"first": 1, "second": 2})
+
+    def test_unknown_id_ignored(self):
+        self._callRPC("first")
+        requestDict = self._gw._mqttClient.waitForRequests(1)[0]
+        responseDict = dict(requestDict)
+        responseDict[IconsClient.RPC_ID_DICT_KEY] = 1000
+        responseDict[MQTTRPCClient.RESPONSE_DICT_KEY] = "wrong"
+        self._gw._onRPCMessage(None, None, RPCMessage(responseDict))
+        self._gw._onRPCMessage(None, None, getResponse(requestDict, "right"))
+        self._joinAll()
+        self.assertEqual(self._resultDict, {"first": "right"})
+
+    def test_error_response(self):
+        self._callRPC("first")
+        requestDict = self._gw._mqttClient.waitForRequests(1)[0]
+        errorDict = dict(requestDict)
+        errorDict[IconsClient.RPC_ERROR_DICT_KEY] = "Unable to find a provider of the first method."
+        self._gw._onRPCMessage(None, None, RPCMessage(errorDict))
+        self._joinAll()
+        self.assertIsInstance(self._resultDict["first"], IconsRPCError)
+
+    def test_invalid_response(self):
+        class InvalidMessage(object):
+            payload = b"{"
+        self._gw._onRPCMessage(None, None, InvalidMessage())
+        self._gw._onRPCMessage(None, None, RPCMessage([1, 2]))
+        self._gw._onRPCMessage(None, None, RPCMessage({"A": 1}))
+
+    def test_timeout(self):
+        rpcTimeout = IconsClient.RPC_TIMEOUT_SECONDS
+        IconsClient.RPC_TIMEOUT_SECONDS = 0.1
+        try:
+            self.assertIsNone(self._gw._rpcCall("first", []))
+
+        finally:
+            IconsClient.RPC_TIMEOUT_SECONDS = rpcTimeout
+        self.assertEqual(self._gw._rpcWaiterDict, {})
+        self.assertEqual(self._gw._stats.get(IconsClient.STAT_RPC_TIMEOUTS), 1)
+
+class AsyncRPCRoutingTest(unittest.TestCase):
+    """@brief Tests routing RPC responses to the tasks waiting for them."""
+
+    def setUp(self):
+        self._gw = AsyncIconsGW(QuietUIO(), IconsGWBench.GetGWOptions())
+        self._gw._mqttClient = RequestRecorder()
+
+    def _run(self, coro):
+        async def run():
+            self._gw._initEventLoop()
+            return await coro()
+        return asyncio.run( run() )
+
+    async def _callRPCs(self, nameList):
+        """@brief Start an RPC task for each name.
+           @return A list of the tasks and a list of the requests sent."""
+        taskList = []
+        for name in nameList:
+            taskList.append( asyncio.ensure_future( self._gw._rpcCallAsync(name, []) ) )
+            # Let the task send its request.
+            await asyncio.sleep(0)
+        return taskList, self._gw._mqttClient.waitForRequests( len(nameList) )
+
+    def test_route_by_id(self):
+        async def test():
+            taskList, requestList = await self._callRPCs( ("first", "second") )
+            for requestDict in reversed(requestList):
+                self._gw._onRPCMessage(None, None, getResponse(requestDict, requestDict[MQTTRPCClient.METHOD_DICT_KEY]+"_response"))
+            return await asyncio.gather(*taskList)
+        self.assertEqual(self._run(test), ["first_response", "second_response"])
+        self.assertFalse(self._gw._rpcSerialised)
+
+    def test_no_id_oldest_waiter(self):
+        async def test():
+            taskList, requestList = await self._callRPCs( ("first", "second") )
+            self._gw._onRPCMessage(None, None, getResponse(requestList[1], 1, echoID=False))
+            self._gw._onRPCMessage(None, None, getResponse(requestList[0], 2, echoID=False))
+            return await asyncio.gather(*taskList)
+        self.assertEqual(self._run(test), [1, 2])
+        self.assertTrue(self._gw._rpcSerialised)
+
+    def test_error_response(self):
+        async def test():
+            taskList, requestList = await self._callRPCs( ("first",) )
+            errorDict = dict(requestList[0])
+            errorDict[IconsClient.RPC_ERROR_DICT_KEY] = "Unable to find a provider of the first method."
+            self._gw._onRPCMessage(None, None, RPCMessage(errorDict))
+            return await asyncio.gather(*taskList, return_exceptions=True)
+        resultList = self._run(test)
+        self.assertIsInstance(resultList[0], IconsRPCError)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import  threading
+import  unittest
+
+from    icons_gw.icons_gw import ServerPortAllocator, IconsGWError, IconsRPCError
+
+class FakeRPCProvider(object):
+    """@brief Answers the RPCs called by a ServerPortAllocator."""
+
+    def __init__(self, methodList):
+        """@brief Constructor
+           @param methodList The names of the RPCs the provider supports."""
+        self._methodList = methodList
+        self._nextPort = 10000
+        self.leasedPortSet = set()
+        self.callList = []
+        self.timeoutCount = 0
+
+    def _getPortList(self, count):
+        portList = list( range(self._nextPort, self._nextPort+count) )
+        self._nextPort = self._nextPort+count
+        return portList
+
+    def rpcCall(self, methodName, argList):
+        self.callList.append(methodName)
+        if self.timeoutCount > 0:
+            self.timeoutCount = self.timeoutCount - 1
+            return None
+
+        if methodName not in self._methodList:
+            raise IconsRPCError("Unable to find a provider of the %s method." % (methodName) )
+
+        if methodName == "getFreeTCPPort":
+            return self._getPortList(1)[0]
+
+        if methodName == "getFreeTCPPortList":
+            return self._getPortList(argList[0])
+
+        if methodName == "leaseTCPPortList":
+            portList = self._getPortList(argList[0])
+            self.leasedPortSet.update(portList)
+            return {"PORTS": portList, "TTL": 300}
+
+        if methodName == "renewTCPPortList":
+            return [port for port in argList[1] if port in self.leasedPortSet]
+
+        if methodName == "releaseTCPPortList":
+            self.leasedPortSet.difference_update(argList[1])
+            return len(argList[1])
+
+class BlockingRPCProvider(FakeRPCProvider):
+    """@brief Holds each RPC until it is allowed to complete."""
+
+    def __init__(self, methodList):
+        FakeRPCProvider.__init__(self, methodList)
+        self.calledEvent = threading.Event()
+        self.completeEvent = threading.Event()
+
+    def rpcCall(self, methodName, argList):
+        self.calledEvent.set()
+        self.completeEvent.wait(5)
+        return FakeRPCProvider.rpcCall(self, methodName, argList)
+
+LEASE_METHOD_LIST = ("getFreeTCPPort", "getFreeTCPPortList", "leaseTCPPortList", "renewTCPPortList", "releaseTCPPortList")
+
+class ServerPortAllocatorTest(unittest.TestCase):
+
+    def test_lease(self):
+        provider = FakeRPCProvider(LEASE_METHOD_LIST)
+        allocator = ServerPortAllocator(provider.rpcCall, 4, "LOC1")
+        self.assertEqual(allocator.getPorts(2), [10000, 10001])
+        self.assertEqual(allocator.getPorts(2), [10002, 10003])
+        self.assertEqual(allocator.getPorts(1), [10004])
+        self.assertEqual(provider.callList, ["leaseTCPPortList", "leaseTCPPortList"])
+
+    def test_preferred_ports(self):
+        provider = FakeRPCProvider(LEASE_METHOD_LIST)
+        allocator = ServerPortAllocator(provider.rpcCall, 4, "LOC1")
+        allocator.getPorts(1)
+        self.assertEqual(allocator.getPorts(3, [None, 10003, 20000]), [10001, 10003, 10002])
+
+    def test_timeout_keeps_lease(self):
+        provider = FakeRPCProvider(LEASE_METHOD_LIST)
+        allocator = ServerPortAllocator(provider.rpcCall, 4, "LOC1")
+        provider.timeoutCount = 1
+        self.assertRaises(IconsGWError, allocator.getPorts, 1)
+        # A lost response does not stop the ports being leased.
+        self.assertEqual(allocator.getPorts(1), [10000])
+        self.assertEqual(provider.callList, ["leaseTCPPortList", "leaseTCPPortList"])
+
+    def test_timeout_keeps_batch(self):
+        provider = FakeRPCProvider(("getFreeTCPPort", "getFreeTCPPortList"))
+        allocator = ServerPortAllocator(provider.rpcCall, 4, "LOC1")
+        allocator.getPorts(4)
+        provider.timeoutCount = 1
+        self.assertRaises(IconsGWError, allocator.getPorts, 1)
+        allocator.getPorts(1)
+        self.assertEqual(provider.callList, ["leaseTCPPortList", "getFreeTCPPortList", "getFreeTCPPortList", "getFreeTCPPortList"])
+
+    def test_timeout_single_port(self):
+        provider = FakeRPCProvider(("getFreeTCPPort",))
+        allocator = ServerPortAllocator(provider.rpcCall, 4)
+        allocator.getPorts(1)
+        provider.timeoutCount = 1
+        self.assertRaises(IconsGWError, allocator.getPorts, 1)
+
+    def test_no_lease_provider(self):
+        provider = FakeRPCProvider(("getFreeTCPPort", "getFreeTCPPortList"))
+        allocator = ServerPortAllocator(provider.rpcCall, 4, "LOC1")
+        self.assertEqual(allocator.getPorts(2), [10000, 10001])
+        self.assertEqual(allocator.getPorts(3), [10002, 10003, 10004])
+        self.assertEqual(provider.callList, ["leaseTCPPortList", "getFreeTCPPortList", "getFreeTCPPortList"])
+        self.assertEqual(allocator.claimPorts([10000]), [])
+        self.assertFalse(allocator.isRenewDue())
+
+    def test_single_port_provider(self):
+        provider = FakeRPCProvider(("getFreeTCPPort",))
+        allocator = ServerPortAllocator(provider.rpcCall, 4, "LOC1")
+        self.assertEqual(allocator.getPorts(2), [10000, 10001])
+        self.assertEqual(allocator.getPorts(1), [10002])
+        self.assertEqual(provider.callList, ["leaseTCPPortList", "getFreeTCPPortList", "getFreeTCPPort", "getFreeTCPPort", "getFreeTCPPort"])
+
+    def test_no_location(self):
+        provider = FakeRPCProvider(LEASE_METHOD_LIST)
+        allocator = ServerPortAllocator(provider.rpcCall, 4)
+        allocator.getPorts(1)
+        self.assertEqual(provider.callList, ["getFreeTCPPortList"])
+
+    def test_release(self):
+        provider = FakeRPCProvider(LEASE_METHOD_LIST)
+        allocator = ServerPortAllocator(provider.rpcCall, 2, "LOC1")
+        portList = allocator.getPorts(2)
+        allocator.releasePorts(portList)
+        self.assertEqual(sorted(allocator.getPorts(2)), portList)
+        self.assertEqual(provider.callList, ["leaseTCPPortList"])
+
+    def test_renew(self):
+        provider = FakeRPCProvider(LEASE_METHOD_LIST)
+        allocator = ServerPortAllocator(provider.rpcCall, 2, "LOC1")
+        self.assertFalse(allocator.isRenewDue())
+        portList = allocator.getPorts(6)
+        allocator.releasePorts(portList[:4])
+        self.assertTrue(allocator.isRenewDue(now=allocator._lastRenewTime+100))
+        # The lease of a port is lost.
+        provider.leasedPortSet.discard(portList[5])
+        self.assertEqual(allocator.renewLeases(), [portList[5]])
+        self.assertEqual(provider.callList[-2:], ["releaseTCPPortList", "renewTCPPortList"])
+        # Free ports beyond one batch were released.
+        self.assertEqual(provider.leasedPortSet, set(portList[:2]+portList[4:5]))
+
+    def test_renew_timeout(self):
+        provider = FakeRPCProvider(LEASE_METHOD_LIST)
+        allocator = ServerPortAllocator(provider.rpcCall, 2, "LOC1")
+        allocator.getPorts(2)
+        provider.timeoutCount = 1
+        self.assertEqual(allocator.renewLeases(), [])
+        provider.leasedPortSet.clear()
+        self.assertEqual(len(allocator.renewLeases()), 2)
+
+    def test_renew_error(self):
+        provider = FakeRPCProvider(("getFreeTCPPort", "getFreeTCPPortList", "leaseTCPPortList"))
+        allocator = ServerPortAllocator(provider.rpcCall, 2, "LOC1")
+        allocator.getPorts(2)
+        self.assertEqual(allocator.renewLeases(), [])
+        self.assertFalse(allocator.isRenewDue(now=allocator._lastRenewTime+1000))
+
+    def test_claim(self):
+        provider = FakeRPCProvider(LEASE_METHOD_LIST)
+        provider.leasedPortSet.update([20000, 20001])
+        allocator = ServerPortAllocator(provider.rpcCall, 2, "LOC1")
+        self.assertEqual(allocator.claimPorts([20000, 20001, 20002]), [20000, 20001])
+        # Claimed ports are only used when preferred.
+        self.assertEqual(allocator.getPorts(2, [None, 20001]), [10000, 20001])
+
+    def test_claim_timeout(self):
+        provider = FakeRPCProvider(LEASE_METHOD_LIST)
+        allocator = ServerPortAllocator(provider.rpcCall, 2, "LOC1")
+        provider.timeoutCount = 1
+        self.assertEqual(allocator.claimPorts([20000]), [])
+        # A lost response does not stop the ports being leased.
+        allocator.getPorts(1)
+        self.assertEqual(provider.callList, ["renewTCPPortList", "leaseTCPPortList"])
+
+class ServerPortAllocatorThreadTest(unittest.TestCase):
+
+    def setUp(self):
+        self._provider = BlockingRPCProvider(LEASE_METHOD_LIST)
+        self._allocator = ServerPortAllocator(self._provider.rpcCall, 4, "LOC1")
+        self._resultDict = {}
+        self._threadList = []
+
+    def tearDown(self):
+        self._provider.completeEvent.set()
+        for thread in self._threadList:
+            thread.join(5)
+
+    def _getPorts(self, name, count, preferredPortList=None):
+        """@brief Call getPorts() on another thread.
+           @param name The name of the result."""
+        def getPorts():
+            try:
+                self._resultDict[name] = self._allocator.getPorts(count, preferredPortList)
+
+            except IconsGWError as ex:
+                self._resultDict[name] = ex
+        thread = threading.Thread(target=getPorts)
+        thread.start()
+        self._threadList.append(thread)
+        return thread
+
+    def test_held_ports_not_blocked(self):
+        self._provider.completeEvent.set()
+        self._allocator.getPorts(2)
+        self._provider.completeEvent.clear()
+        self._provider.calledEvent.clear()
+
+        self._getPorts("fetch", 4)
+        self.assertTrue(self._provider.calledEvent.wait(5))
+        # The ports held are given out while the RPC is in progress.
+        self.assertEqual(self._allocator.getPorts(1, [10003]), [10003])
+        self.assertEqual(self._allocator.getPorts(1), [10002])
+
+        self._provider.completeEvent.set()
+        self._threadList[0].join(5)
+        self.assertEqual(self._resultDict["fetch"], [10004, 10005, 10006, 10007])
+
+    def test_single_fetch(self):
+        self._getPorts("first", 1)
+        self.assertTrue(self._provider.calledEvent.wait(5))
+        self._getPorts("second", 1)
+        self._provider.completeEvent.set()
+        for thread in self._threadList:
+            thread.join(5)
+        # The second thread is given a port from the batch the first requested.
+        self.assertEqual(sorted(self._resultDict["first"]+self._resultDict["second"]), [10000, 10001])
+        self.assertEqual(self._provider.callList, ["leaseTCPPortList"])
+
+    def test_fetch_error_wakes_waiters(self):
+        self._provider.timeoutCount = 1
+        self._getPorts("first", 1)
+        self.assertTrue(self._provider.calledEvent.wait(5))
+        self._getPorts("second", 1)
+        self._provider.completeEvent.set()
+        for thread in self._threadList:
+            thread.join(5)
+        self.assertIsInstance(self._resultDict["first"], IconsGWError)
+        self.assertEqual(self._resultDict["second"], [10000])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,211 @@
 #!/usr/bin/python
 
 from    optparse import OptionParser
+import  json
 import  socket
+import  threading
+import  heapq
+from    time import time
 from    pjalib.mqtt_rpc import MQTTRPCClient, MQTTRPCProviderClient
 from    pjalib.uio import UIO as UO
 
+class PortPool(object):
+    """@brief Responsible for leasing TCP ports from a range reserved for the reverse ssh
+              tunnels of the ICONS gateways. Each gateway location is given blocks of
+              ports from the range as it needs them so that gateways never compete for
+              the same port. Leases expire unless renewed so that the ports of a gateway
+              that goes away are reused. Leases are held in memory, no sockets are used."""
+
+    DEFAULT_FIRST_PORT  = 10000
+    DEFAULT_LAST_PORT   = 19999
+    DEFAULT_BLOCK_SIZE  = 64
+    DEFAULT_LEASE_TTL   = 300
+    EPHEMERAL_PORT_FILE = "/proc/sys/net/ipv4/ip_local_port_range"
+
+    @staticmethod
+    def GetEphemeralPortRange():
+        """@return A tuple of the first and last ports the OS allocates to sockets bound
+                   to port 0 or None if unknown."""
+        try:
+            fd = open(PortPool.EPHEMERAL_PORT_FILE)
+            try:
+                elems = fd.read().split()
+            finally:
+                fd.close()
+            return ( int(elems[0]), int(elems[1]) )
+        except (IOError, OSError, ValueError, IndexError):
+            return None
+
+    def __init__(self, firstPort, lastPort, blockSize, leaseTTL):
+        """@brief Constructor
+           @param firstPort The first port in the range.
+           @param lastPort The last port in the range.
+           @param blockSize The number of ports reserved for a location at a time.
+           @param leaseTTL The number of seconds a lease lasts unless renewed."""
+        if firstPort < 1 or lastPort > 65535 or lastPort < firstPort:
+            raise ValueError("%d-%d is not a valid TCP port range." % (firstPort, lastPort) )
+        self._firstPort = firstPort
+        self._lastPort = lastPort
+        self._blockSize = max(blockSize, 1)
+        self.leaseTTL = leaseTTL
+        self._lock = threading.Lock()
+        self._freeBlockList = list( range(firstPort, lastPort+1, self._blockSize) )
+        self._freeBlockList.reverse()
+        self._blockOwnerDict = {}
+        self._blockLeaseCountDict = {}
+        self._freePortSetDict = {}
+        self._leaseDict = {}
+        self._expiryHeap = []
+
+    def _getBlock(self, port):
+        """@return The first port of the block that holds port."""
+        return self._firstPort + ( (port-self._firstPort) // self._blockSize ) * self._blockSize
+
+    def _getBlockPortList(self, block):
+        """@return The ports in a block."""
+        return list( range(block, min(block+self._blockSize, self._lastPort+1)) )
+
+    def _reserveBlock(self, location):
+        """@brief Reserve another block of ports for a location. If no blocks are free a
+                  block without leased ports is taken from another location.
+           @param location The gateway location.
+           @return True if a block was reserved."""
+        if self._freeBlockList:
+            block = self._freeBlockList.pop()
+
+        else:
+            block = None
+            for ownedBlock, owner in self._blockOwnerDict.items():
+                if owner != location and self._blockLeaseCountDict.get(ownedBlock, 0) == 0:
+                    block = ownedBlock
+                    break
+            if block is None:
+                return False
+            self._freePortSetDict[owner].difference_update( self._getBlockPortList(block) )
+
+        self._assignBlock(block, location)
+        return True
+
+    def _assignBlock(self, block, location):
+        """@brief Assign a block of ports to a location."""
+        self._blockOwnerDict[block] = location
+        self._blockLeaseCountDict[block] = 0
+        self._freePortSetDict.setdefault(location, set()).update( self._getBlockPortList(block) )
+
+    def _claimBlock(self, port, location):
+        """@brief Assign the block holding a port to a location if the block is free.
+           @return True if the block was assigned."""
+        if port < self._firstPort or port > self._lastPort:
+            return False
+        block = self._getBlock(port)
+        if block not in self._freeBlockList:
+            return False
+        self._freeBlockList.remove(block)
+        self._assignBlock(block, location)
+        return True
+
+    def _setLease(self, port, location, now):
+        """@brief Lease a port to a location until now+leaseTTL."""
+        expiry = now+self.leaseTTL
+        self._leaseDict[port] = (location, expiry)
+        heapq.heappush(self._expiryHeap, (expiry, port) )
+
+    def _freePort(self, port, location):
+        """@brief Return a leased port to the free ports of the location that owns it."""
+        del self._leaseDict[port]
+        block = self._getBlock(port)
+        self._blockLeaseCountDict[block] = self._blockLeaseCountDict[block]-1
+        self._freePortSetDict[location].add(port)
+
+    def _expire(self, now):
+        """@brief Free the ports whose leases have expired."""
+        while self._expiryHeap and self._expiryHeap[0][0] <= now:
+            expiry, port = heapq.heappop(self._expiryHeap)
+            lease = self._leaseDict.get(port)
+            # Renewed leases leave their old expiry in the heap.
+            if lease and lease[1] <= now:
+                self._freePort(port, lease[0])
+
+    def lease(self, location, count, now=None):
+        """@brief Lease ports to a location.
+           @param location The gateway location.
+           @param count The number of ports required.
+           @param now The current time. If None then the time is read.
+           @return A list of TCP port numbers. This may hold fewer than count ports if the range is exhausted."""
+        if now is None:
+            now = time()
+        with self._lock:
+            self._expire(now)
+            freePortSet = self._freePortSetDict.setdefault(location, set())
+            while len(freePortSet) < count and self._reserveBlock(location):
+                pass
+
+            portList = []
+            while freePortSet and len(portList) < count:
+                port = freePortSet.pop()
+                self._setLease(port, location, now)
+                block = self._getBlock(port)
+                self._blockLeaseCountDict[block] = self._blockLeaseCountDict[block]+1
+                portList.append(port)
+            return portList
+
+    def renew(self, location, portList, now=None):
+        """@brief Renew the leases of ports. A port whose lease has expired is leased
+                  again if it has not been leased to another location. This allows a
+                  gateway to keep its ports after it or the RPC provider restarts.
+           @param location The gateway location.
+           @param portList The TCP port numbers to renew.
+           @param now The current time. If None then the time is read.
+           @return A list of the ports that are leased to the location."""
+        if now is None:
+            now = time()
+        with self._lock:
+            self._expire(now)
+            freePortSet = self._freePortSetDict.setdefault(location, set())
+            renewedList = []
+            for port in portList:
+                lease = self._leaseDict.get(port)
+                if lease:
+                    if lease[0] != location:
+                        continue
+                elif port in freePortSet or self._claimBlock(port, location):
+                    freePortSet.discard(port)
+                    block = self._getBlock(port)
+                    self._blockLeaseCountDict[block] = self._blockLeaseCountDict[block]+1
+                else:
+                    continue
+                self._setLease(port, location, now)
+                renewedList.append(port)
+            return renewedList
+
+    def release(self, location, portList):
+        """@brief Release leased ports.
+           @param location The gateway location.
+           @param portList The TCP port numbers to release.
+           @return The number of ports released."""
+        with self._lock:
+            releaseCount = 0
+            for port in portList:
+                lease = self._leaseDict.get(port)
+                if lease and lease[0] == location:
+                    self._freePort(port, location)
+                    releaseCount = releaseCount + 1
+            return releaseCount
+
+    def getLeaseCount(self):
+        """@return The number of ports leased."""
+        return len(self._leaseDict)
+
 class RPCMethodProvider(object):
 
+    MAX_PORT_LIST_SIZE = 256
+
+    def __init__(self, portPool=None):
+        """@brief Constructor
+           @param portPool The PortPool that leases ports to gateways. If None the
+                  port lease RPCs are not available."""
+        self._portPool = portPool
+
     @staticmethod
     def GetFreeTCPPort():
         """@brief Get a free port and return to the client. If no port is available
@@ -23,12 +222,128 @@ class RPCMethodProvider(object):
             pass
         return tcpPort
 
+    @staticmethod
+    def GetFreeTCPPortList(count):
+        """@brief Get a list of free ports. All the sockets are bound before any are
+                  closed so that the ports returned are all different.
+           @param count The number of ports required.
+           @return A list of free TCP port numbers. This may hold fewer than count
+                   ports if not enough ports are available."""
+        tcpPortList=[]
+        sockList=[]
+        try:
+            for _ in range(0, count):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sockList.append(sock)
+                sock.bind(('', 0))
+                tcpPortList.append( sock.getsockname()[1] )
+        except socket.error:
+            pass
+        finally:
+            for sock in sockList:
+                sock.close()
+        return tcpPortList
+
     def getFreeTCPPort(self):
         """@brief Get a free port and return to the client. If no port is available
                   then -1 is returned.
            @return the free TCP port number or -1 if no port is available."""
         return RPCMethodProvider.GetFreeTCPPort()
 
+    def getFreeTCPPortList(self, args):
+        """@brief Get a number of free ports in a single RPC.
+           @param args The RPC argument list. The first element is the number of
+                  ports required (max MAX_PORT_LIST_SIZE).
+           @return A list of free TCP port numbers."""
+        count = min( int(args[0]), RPCMethodProvider.MAX_PORT_LIST_SIZE)
+        return RPCMethodProvider.GetFreeTCPPortList(count)
+
+    def leaseTCPPortList(self, args):
+        """@brief Lease ports from the port pool.
+           @param args The RPC argument list. The first element is the number of
+                  ports required (max MAX_PORT_LIST_SIZE), the second is the gateway location.
+           @return A dict holding the list of ports leased (PORTS) and the number of
+                   seconds the leases last unless renewed (TTL)."""
+        count = min( int(args[0]), RPCMethodProvider.MAX_PORT_LIST_SIZE)
+        return {"PORTS": self._portPool.lease(str(args[1]), count), "TTL": self._portPool.leaseTTL}
+
+    def renewTCPPortList(self, args):
+        """@brief Renew port leases.
+           @param args The RPC argument list. The first element is the gateway location,
+                  the second is a list of the ports to renew.
+           @return A list of the ports that are leased to the gateway location."""
+        return self._portPool.renew(str(args[0]), [int(port) for port in args[1]])
+
+    def releaseTCPPortList(self, args):
+        """@brief Release leased ports.
+           @param args The RPC argument list. The first element is the gateway location,
+                  the second is a list of the ports to release.
+           @return The number of ports released."""
+        return self._portPool.release(str(args[0]), [int(port) for port in args[1]])
+
+class ICONSRPCProviderClient(MQTTRPCProviderClient):
+    """@brief Responsible for calling the RPCs requested by the ICONS gateways. Unlike
+              the MQTTRPCProviderClient an error response is returned if an RPC is not
+              known or fails so that a gateway can tell an older RPC provider from a
+              lost response."""
+
+    ERROR_DICT_KEY = "ERROR"
+
+    def __init__(self, uo, options, rpcMethodProviderList, **kwargs):
+        """@brief Constructor
+           @param uo A UIO instance.
+           @param options The command line options.
+           @param rpcMethodProviderList The objects that provide the RPC methods.
+           @param kwargs Passed to the MQTTRPCProviderClient constructor."""
+        MQTTRPCProviderClient.__init__(self, uo, options, rpcMethodProviderList, **kwargs)
+        self._rpcUO = uo
+        self._rpcProviderList = rpcMethodProviderList
+
+    def _getMethod(self, methodName):
+        """@param methodName The name of the RPC.
+           @return The method that provides the RPC or None if not found."""
+        if not isinstance(methodName, str) or methodName.startswith("_"):
+            return None
+        for rpcMethodProvider in self._rpcProviderList:
+            method = getattr(rpcMethodProvider, methodName, None)
+            if callable(method):
+                return method
+        return None
+
+    def _onMessage(self, client, userdata, msg):
+        """@brief Called when an RPC request is received from the MQTT server.
+           @param client The MQTT client instance.
+           @param userdata The private user data as set in Client() or userdata_set().
+           @param msg An instance of MQTTMessage."""
+        try:
+            jsonDict = json.loads( msg.payload.decode() )
+
+        except ValueError:
+            self._rpcUO.error("Invalid RPC request received: %s" % (str(msg.payload)) )
+            return
+
+        if not isinstance(jsonDict, dict) or MQTTRPCClient.CLIENT_ID_DICT_KEY not in jsonDict or MQTTRPCClient.METHOD_DICT_KEY not in jsonDict:
+            return
+
+        methodName = jsonDict[MQTTRPCClient.METHOD_DICT_KEY]
+        args = jsonDict.get(MQTTRPCClient.ARGS_DICT_KEY)
+        try:
+            method = self._getMethod(methodName)
+            if method is None:
+                raise AttributeError("Unable to find a provider of the %s method." % (methodName) )
+
+            if args:
+                response = method(args)
+            else:
+                response = method()
+            jsonDict[MQTTRPCClient.RESPONSE_DICT_KEY] = response
+
+        except Exception as ex:
+            self._rpcUO.error("%s RPC failed: %s" % (methodName, str(ex)) )
+            jsonDict[ICONSRPCProviderClient.ERROR_DICT_KEY] = str(ex)
+
+        client.publish(jsonDict[MQTTRPCClient.CLIENT_ID_DICT_KEY], json.dumps(jsonDict))
+
 def main():
     uo = UO()
 
@@ -39,19 +354,28 @@ def main():
     opts.add_option("--keepalive",  help="The number of seconds between each keepalive message (default=%d)." % (MQTTRPCClient.DEFAULT_KEEPALIVE_SECONDS) , type="int", default=MQTTRPCClient.DEFAULT_KEEPALIVE_SECONDS)
     opts.add_option("--sid",        help="The ID number that uniquely identifies the MQTT RPC server to send the RPC request to (default=%d)." % (MQTTRPCClient.DEFAULT_SRV_ID) , type="int", default=MQTTRPCClient.DEFAULT_SRV_ID)
     opts.add_option("--cid",        help="The ID number that uniquely identifies this MQTT RPC client from which the RPC request is made (default=%d)." % (MQTTRPCClient.DEFAULT_SRV_ID) , type="int", default=MQTTRPCClient.DEFAULT_SRV_ID)
+    opts.add_option("--first_port", help="The first TCP port leased to ICONS gateways (default=%d)." % (PortPool.DEFAULT_FIRST_PORT) , type="int", default=PortPool.DEFAULT_FIRST_PORT)
+    opts.add_option("--last_port",  help="The last TCP port leased to ICONS gateways (default=%d)." % (PortPool.DEFAULT_LAST_PORT) , type="int", default=PortPool.DEFAULT_LAST_PORT)
+    opts.add_option("--block_size", help="The number of ports reserved for an ICONS gateway location at a time (default=%d)." % (PortPool.DEFAULT_BLOCK_SIZE) , type="int", default=PortPool.DEFAULT_BLOCK_SIZE)
+    opts.add_option("--lease_ttl",  help="The number of seconds a port lease lasts unless the ICONS gateway renews it (default=%d)." % (PortPool.DEFAULT_LEASE_TTL) , type="int", default=PortPool.DEFAULT_LEASE_TTL)
     opts.add_option("--enable_auto_start",  help="Enable auto start this program when this computer starts.", action="store_true", default=False)
     opts.add_option("--disable_auto_start", help="Disable auto start this program when this computer starts.", action="store_true", default=False)
 
     try:
         (options, args) = opts.parse_args()
 
-        rpcMethodProvider = RPCMethodProvider()
+        portPool = PortPool(options.first_port, options.last_port, options.block_size, options.lease_ttl)
+        ephemeralPortRange = PortPool.GetEphemeralPortRange()
+        if ephemeralPortRange and options.first_port <= ephemeralPortRange[1] and options.last_port >= ephemeralPortRange[0]:
+            uo.warn("Ports %d-%d overlap the ephemeral port range (%d-%d)." % (options.first_port, options.last_port, ephemeralPortRange[0], ephemeralPortRange[1]) )
+
+        rpcMethodProvider = RPCMethodProvider(portPool)
 
-        mqttRPCProviderClient = MQTTRPCProviderClient(uo, options, (rpcMethodProvider,), autoStartUser="root", allowRootAutoStartUser=True)
+        mqttRPCProviderClient = ICONSRPCProviderClient(uo, options, (rpcMethodProvider,), autoStartUser="root", allowRootAutoStartUser=True)
 
         if options.enable_auto_start:
             #This tool has no persistent config. All parameters are passed on the command line.
-            mqttRPCProviderClient.enableAutoStart(argString="--server {} --port={} --keepalive={} --sid={} --cid={}".format(options.server, options.port, options.keepalive, options.sid, options.cid) )
+            mqttRPCProviderClient.enableAutoStart(argString="--server {} --port={} --keepalive={} --sid={} --cid={} --first_port={} --last_port={} --block_size={} --lease_ttl={}".format(options.server, options.port, options.keepalive, options.sid, options.cid, options.first_port, options.last_port, options.block_size, options.lease_ttl) )
 
         elif options.disable_auto_start:
             mqttRPCProviderClient.disableAutoStart()
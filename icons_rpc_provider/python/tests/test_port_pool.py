@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import  unittest
+
+from    icons_mqtt_rpc_provider import PortPool
+
+class PortPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        # Three blocks of four ports.
+        self._portPool = PortPool(10000, 10011, 4, 300)
+
+    def test_invalid_range(self):
+        self.assertRaises(ValueError, PortPool, 0, 100, 4, 300)
+        self.assertRaises(ValueError, PortPool, 100, 70000, 4, 300)
+        self.assertRaises(ValueError, PortPool, 200, 100, 4, 300)
+
+    def test_lease(self):
+        portList = self._portPool.lease("LOC1", 3, now=0)
+        self.assertEqual(len(portList), 3)
+        self.assertEqual(len(set(portList)), 3)
+        for port in portList:
+            self.assertTrue(10000 <= port <= 10011)
+        self.assertEqual(self._portPool.getLeaseCount(), 3)
+
+    def test_locations_use_separate_blocks(self):
+        portList1 = self._portPool.lease("LOC1", 2, now=0)
+        portList2 = self._portPool.lease("LOC2", 2, now=0)
+        blockSet1 = set( [port//4 for port in portList1] )
+        blockSet2 = set( [port//4 for port in portList2] )
+        self.assertFalse(blockSet1 & blockSet2)
+
+    def test_lease_several_blocks(self):
+        portList = self._portPool.lease("LOC1", 6, now=0)
+        self.assertEqual(len(set(portList)), 6)
+
+    def test_exhausted(self):
+        portList = self._portPool.lease("LOC1", 20, now=0)
+        self.assertEqual(len(portList), 12)
+        self.assertEqual(self._portPool.lease("LOC2", 1, now=0), [])
+
+    def test_release(self):
+        portList = self._portPool.lease("LOC1", 12, now=0)
+        # Ports leased to another location are not released.
+        self.assertEqual(self._portPool.release("LOC2", portList[:2]), 0)
+        self.assertEqual(self._portPool.release("LOC1", portList[:2]), 2)
+        self.assertEqual(self._portPool.release("LOC1", portList[:2]), 0)
+        self.assertEqual(self._portPool.getLeaseCount(), 10)
+        self.assertEqual(sorted(self._portPool.lease("LOC1", 2, now=0)), sorted(portList[:2]))
+
+    def test_expire(self):
+        self._portPool.lease("LOC1", 12, now=0)
+        self.assertEqual(self._portPool.lease("LOC1", 1, now=299), [])
+        self.assertEqual(len(self._portPool.lease("LOC1", 12, now=300)), 12)
+        self.assertEqual(self._portPool.getLeaseCount(), 12)
+
+    def test_renew(self):
+        portList = self._portPool.lease("LOC1", 4, now=0)
+        self.assertEqual(self._portPool.renew("LOC1", portList, now=200), portList)
+        # The renewed leases do not expire at the original expiry time.
+        self._portPool.lease("LOC2", 1, now=350)
+        self.assertEqual(self._portPool.getLeaseCount(), 5)
+        self.assertEqual(self._portPool.renew("LOC1", portList, now=400), portList)
+
+    def test_renew_other_location(self):
+        portList = self._portPool.lease("LOC1", 2, now=0)
+        self.assertEqual(self._portPool.renew("LOC2", portList, now=10), [])
+
+    def test_renew_after_restart(self):
+        # A gateway keeps its ports when the RPC provider restarts with no leases.
+        portList = self._portPool.lease("LOC1", 2, now=0)
+        portPool = PortPool(10000, 10011, 4, 300)
+        self.assertEqual(portPool.renew("LOC1", portList, now=10), portList)
+        self.assertEqual(portPool.getLeaseCount(), 2)
+        # The block holding the ports now belongs to LOC1.
+        for port in portPool.lease("LOC2", 2, now=10):
+            self.assertNotEqual(port//4, portList[0]//4)
+
+    def test_renew_outside_range(self):
+        self.assertEqual(self._portPool.renew("LOC1", [9999, 10012], now=0), [])
+
+    def test_reclaim_unused_block(self):
+        # When no blocks are free a block with no leased ports is taken from another location.
+        portList = self._portPool.lease("LOC1", 12, now=0)
+        self._portPool.release("LOC1", [port for port in portList if port < 10004])
+        self.assertEqual(sorted(self._portPool.lease("LOC2", 4, now=0)), [10000, 10001, 10002, 10003])
+        self.assertEqual(self._portPool.lease("LOC1", 1, now=0), [])
+
+if __name__ == '__main__':
+    unittest.main()
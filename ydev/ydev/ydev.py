@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 
+import  os
 import  socket
 import  platform
 import  json
+import  struct
+import  select
+import  threading
+import  ctypes
+import  ctypes.util
 
 from    time import time, sleep
 from    optparse import OptionParser
@@ -21,16 +27,22 @@ class AYTListener(object):
     UDP_DEV_DISCOVERY_PORT   = 2934
     UDP_RX_BUFFER_SIZE       = 2048
     AYT_KEY                  = "AYT"
+    IF_CHECK_SECONDS         = 10
 
     def __init__(self, uo, options, deviceConfig):
         """@Constructor
             @param uo A UserOutput instance.
             @param options Command line options from OptionParser.
-            @param deviceConfig The device configuration instance."""
+            @param deviceConfig The DeviceConfig or DeviceConfigFolder instance."""
         self._uio=uo
         self._options=options
         self._deviceConfig=deviceConfig
         self._sock=None
+        self._configWatcher = None
+        self._configDictList = None
+        self._responseDict = {}
+        self._ifNameDict = {}
+        self._nextIFCheckTime = 0
 
         self._osName = platform.system()
 
@@ -41,34 +53,27 @@ class AYTListener(object):
 
         try:
             while True:
-                #Inside loop so we re read config if changed by another instance using --config option.
-                jsonDict = self._deviceConfig.getConfigDict()
 
                 #Wait for RX data
                 rxData, addressPort = self._sock.recvfrom(AYTListener.UDP_RX_BUFFER_SIZE)
                 try:
+                    configDictList = self._getConfigDictList()
+
                     rxDict = json.loads(rxData)
                     if AYTListener.AYT_KEY in rxDict:
                         aytString = rxDict[AYTListener.AYT_KEY].strip()
-                        if jsonDict[DeviceConfig.AYT_MSG] == aytString:
+                        responseList = self._getResponseList(addressPort[0], aytString)
+                        if responseList:
                             self._uio.debug("AYT string matched")
                             self._lastAYTMsgTime = time()
 
-                            #Get the name of the interface on which we received the rxData
-                            ifName = self._netIF.getIFName(addressPort[0])
-
-                            #Add the interface address on this machine as the source of the message for yview
-                            jsonDict[AYTListener.IP_ADDRESS_KEY] = self._netIF.getIFIPAddress(ifName)
-                            jsonDict[AYTListener.OS_KEY] = self._osName
-                            jsonDictStr = json.dumps( jsonDict, sort_keys=True, indent=4, separators=(',', ': '))
-
-                            self._uio.debug("%s: %s" % (self.__class__.__name__, jsonDictStr) )
-
-                            self._sock.sendto( jsonDictStr.encode(), addressPort)
-                            self._uio.debug("Sent above message to {}:{}".format(addressPort[0],addressPort[1]))
+                            for response in responseList:
+                                self._sock.sendto(response, addressPort)
+                            self._uio.debug("Sent {} response/s to {}:{}".format(len(responseList), addressPort[0], addressPort[1]))
                         else:
                             self._uio.error("AYT mismatch:")
-                            self._uio.info("Expected: {}".format(jsonDict[DeviceConfig.AYT_MSG]) )
+                            if len(configDictList) == 1:
+                                self._uio.info("Expected: {}".format(configDictList[0][DeviceConfig.AYT_MSG]) )
                             self._uio.info("Found:    {}".format(aytString) )
 
                     else:
@@ -81,6 +86,76 @@ class AYTListener(object):
             self._uio.errorException()
             self._uio.info("Shutdown device listener.")
 
+    def _getConfigDictList(self):
+        """@brief Get the config dicts of the devices we respond for. The config is
+                  loaded again by the config watcher when it is changed (E.G by another
+                  instance using the --config option) so this does not touch the config
+                  file. The cached responses are dropped when a new config is swapped in.
+           @return A tuple of config dicts."""
+        configDictList = self._deviceConfig.getConfigDictList()
+        if configDictList is not self._configDictList:
+            if self._configDictList is not None:
+                self._uio.debug("Config changed, cleared cached responses.")
+            self._responseDict = {}
+            self._configDictList = configDictList
+        return configDictList
+
+    def _getIFName(self, srcAddress):
+        """@brief Get the name of the interface on which a message was received.
+                  The state of the network interfaces is read again at most every
+                  IF_CHECK_SECONDS so that an address change is noticed.
+           @param srcAddress The address the message was received from.
+           @return The interface name or None if not found."""
+        if time() >= self._nextIFCheckTime:
+            self._netIF.getIFDict(readNow=True)
+            self._ifNameDict = {}
+            self._nextIFCheckTime = time() + AYTListener.IF_CHECK_SECONDS
+
+        if srcAddress not in self._ifNameDict:
+            self._ifNameDict[srcAddress] = self._netIF.getIFName(srcAddress)
+        return self._ifNameDict[srcAddress]
+
+    def _getResponseList(self, srcAddress, aytString):
+        """@brief Get the AYT response messages. The serialized messages are cached per
+                  interface and only built again when the config or the address of the
+                  interface changes.
+           @param srcAddress The address the AYT message was received from.
+           @param aytString The AYT string received.
+           @return A list of response message bytes, one for each device that the AYT
+                   string is for (empty if none)."""
+        ifName = self._getIFName(srcAddress)
+        ipAddress = self._netIF.getIFIPAddress(ifName)
+
+        cachedResponse = self._responseDict.get(ifName)
+        if not cachedResponse or cachedResponse[0] != ipAddress:
+            cachedResponse = (ipAddress, self._getResponseDict(ifName, ipAddress))
+            self._responseDict[ifName] = cachedResponse
+
+        return cachedResponse[1].get(aytString, ())
+
+    def _getResponseDict(self, ifName, ipAddress):
+        """@brief Build the AYT response messages for an interface.
+           @param ifName The name of the interface.
+           @param ipAddress The address of the interface.
+           @return A dict of response message bytes lists keyed by AYT string."""
+        responseDict = {}
+        for configDict in self._configDictList:
+            jsonDict = dict( configDict )
+            if AYTListener.IP_ADDRESS_KEY not in jsonDict:
+                #Add the interface address on this machine as the source of the message for yview
+                jsonDict[AYTListener.IP_ADDRESS_KEY] = ipAddress
+                jsonDict[AYTListener.OS_KEY] = self._osName
+            if self._options.pretty:
+                jsonDictStr = json.dumps( jsonDict, sort_keys=True, indent=4, separators=(',', ': '))
+            else:
+                jsonDictStr = json.dumps( jsonDict, sort_keys=True, separators=(',', ':'))
+
+            self._uio.debug("%s: %s: %s" % (self.__class__.__name__, ifName, jsonDictStr) )
+
+            responseDict.setdefault(jsonDict[DeviceConfig.AYT_MSG], []).append( jsonDictStr.encode() )
+
+        return responseDict
+
     def run(self):
         """@brief Called to start sending UDP broadcast (beacon) messages."""
 
@@ -94,6 +169,9 @@ class AYTListener(object):
 
         self.initAYTTime()
 
+        self._configWatcher = ConfigWatcher(self._uio, self._deviceConfig.getConfigPath(), self._deviceConfig.reloadIfModified)
+        self._configWatcher.start()
+
         try:
 
             while True:
@@ -107,6 +185,10 @@ class AYTListener(object):
 
     def shutDown(self):
         """@brief Shutdown the network connection if connected."""
+        if self._configWatcher:
+            self._configWatcher.shutDown()
+            self._configWatcher = None
+
         if self._sock:
             self._sock.close()
 
@@ -136,6 +218,12 @@ class AYTListener(object):
         if self._options.debug:
             argString = argString + " --debug"
 
+        if self._options.pretty:
+            argString = argString + " --pretty"
+
+        if self._options.config_dir:
+            argString = argString + " --config_dir %s" % (self._deviceConfig.getConfigPath())
+
         bootManager.add(user=self._options.user, argString=argString)
 
     def disableAutoStart(self):
@@ -152,6 +240,118 @@ class AYTListener(object):
                 self._uio.info(line)
 
 
+class ConfigWatcher(threading.Thread):
+    """@brief Responsible for detecting changes to the config file or to the files in
+              a config folder. On Linux the kernel notifies us when a file is written
+              (inotify). If this is not available the change callback is called
+              periodically to check the modified time of the file/s."""
+
+    POLL_SECONDS            = 1
+    INOTIFY_RX_TIMEOUT      = 1
+    INOTIFY_RX_BUFFER_SIZE  = 4096
+    INOTIFY_EVENT_HEADER    = struct.Struct("iIII")
+    IN_CLOSE_WRITE          = 0x00000008
+    IN_MOVED_FROM           = 0x00000040
+    IN_MOVED_TO             = 0x00000080
+    IN_DELETE               = 0x00000200
+    IN_CLOEXEC              = 0o2000000
+
+    def __init__(self, uo, configPath, changeCallback, pollSeconds=POLL_SECONDS):
+        """@brief Constructor
+           @param uo The UserOutput object
+           @param configPath The absolute path of the config file or config folder.
+           @param changeCallback The method called (on this thread) when the config file may have changed.
+           @param pollSeconds The period in seconds between checking the config file if inotify is not available."""
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._uo = uo
+        if os.path.isdir(configPath):
+            self._folder = configPath
+            # Files being added or removed matter as well as files being written.
+            self._fileName = None
+            self._eventMask = ConfigWatcher.IN_CLOSE_WRITE | ConfigWatcher.IN_MOVED_TO | ConfigWatcher.IN_MOVED_FROM | ConfigWatcher.IN_DELETE
+        else:
+            self._folder = os.path.dirname(configPath) or "."
+            self._fileName = os.path.basename(configPath).encode()
+            self._eventMask = ConfigWatcher.IN_CLOSE_WRITE | ConfigWatcher.IN_MOVED_TO
+        self._changeCallback = changeCallback
+        self._pollSeconds = pollSeconds
+        self._stopEvent = threading.Event()
+
+    def _openInotify(self):
+        """@brief Watch the config folder or the folder holding the config file so that
+                  the file being replaced as well as written is noticed.
+           @return The inotify file descriptor or None if inotify is not supported on this platform."""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(ConfigWatcher.IN_CLOEXEC)
+            if fd < 0:
+                return None
+
+            if libc.inotify_add_watch(fd, self._folder.encode(), self._eventMask) < 0:
+                os.close(fd)
+                return None
+
+            return fd
+
+        except (AttributeError, OSError):
+            return None
+
+    def _waitForInotifyChange(self, fd):
+        """@brief Wait for an inotify event.
+           @param fd The inotify file descriptor.
+           @return True if the config file changed."""
+        readList, _, _ = select.select([fd], [], [], ConfigWatcher.INOTIFY_RX_TIMEOUT)
+        if not readList:
+            return False
+
+        rxData = os.read(fd, ConfigWatcher.INOTIFY_RX_BUFFER_SIZE)
+        headerSize = ConfigWatcher.INOTIFY_EVENT_HEADER.size
+        changed = False
+        offset = 0
+        while offset + headerSize <= len(rxData):
+            _, _, _, nameLen = ConfigWatcher.INOTIFY_EVENT_HEADER.unpack_from(rxData, offset)
+            name = rxData[offset+headerSize:offset+headerSize+nameLen].rstrip(b"\0")
+            if self._fileName is None or name == self._fileName:
+                changed = True
+            offset = offset + headerSize + nameLen
+
+        return changed
+
+    def run(self):
+        fd = self._openInotify()
+        if fd is not None:
+            self._uo.debug("Watching for config file changes (inotify).")
+        else:
+            self._uo.debug("Watching for config file changes (every %.1f seconds)." % (self._pollSeconds) )
+
+        try:
+            while not self._stopEvent.is_set():
+                if fd is not None:
+                    changed = self._waitForInotifyChange(fd)
+
+                else:
+                    if self._stopEvent.wait(self._pollSeconds):
+                        break
+                    # The callback checks the modified time of the config file/s.
+                    changed = True
+
+                if changed and not self._stopEvent.is_set():
+                    try:
+                        self._changeCallback()
+
+                    except Exception:
+                        self._uo.errorException()
+
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def shutDown(self):
+        """@brief shutdown the thread"""
+        self._stopEvent.set()
+
+
 class DeviceConfig(object):
     """@brief Responsible for managing the configuration used by the ydev application."""
 
@@ -175,8 +375,10 @@ class DeviceConfig(object):
            @param configFile Config file instance."""
         self._uio     = uio
 
+        self._configFile = ConfigManager.GetConfigFile(configFile)
         self._configManager = ConfigManager(self._uio, configFile, DeviceConfig.DEFAULT_CONFIG)
         self._configManager.load()
+        self._configDictList = ( DeviceConfig.GetValidConfigDict( self._configManager.getConfigDict() ), )
 
     def configure(self):
         """@brief configure the required parameters for normal operation."""
@@ -251,14 +453,174 @@ class DeviceConfig(object):
            @param key The key for the value we're after."""
 
         #If the config file has been modified then read the config to get the updated state.
+        self.reloadIfModified()
+
+        return self._configManager.getAttr(key)
+
+    def reloadIfModified(self):
+        """@brief Load the config again if the config file has been modified. The
+                  tuple returned by getConfigDictList() is replaced with a copy of
+                  the new config once it has been checked. If the new config is not
+                  valid the previous config is kept.
+           @return True if the config was loaded."""
         if self._configManager.isModified():
-            self._configManager.load(showLoadedMsg=False)
+            # Update the modified time first so that an invalid config file is only reported once.
             self._configManager.updateModifiedTime()
+            try:
+                self._configManager.load(showLoadedMsg=False)
+                self._configDictList = ( DeviceConfig.GetValidConfigDict( self._configManager.getConfigDict() ), )
+                return True
+
+            except Exception as ex:
+                self._uio.warn("Ignored invalid config in %s: %s" % (self._configFile, str(ex)) )
+
+        return False
+
+    @staticmethod
+    def GetValidConfigDict(configDict):
+        """@brief Check a config dict.
+           @param configDict The config dict loaded from the config file.
+           @return A copy of the config dict."""
+        if not isinstance(configDict, dict):
+            raise ValueError("The config is not a dict.")
+
+        aytMsg = configDict.get(DeviceConfig.AYT_MSG)
+        if not isinstance(aytMsg, str) or len(aytMsg) == 0:
+            raise ValueError("%s is not set." % (DeviceConfig.AYT_MSG) )
+
+        return dict(configDict)
+
+    def getConfigDictList(self):
+        """@brief Get the config. The tuple returned is not changed. A new tuple is
+                  returned after the config has been loaded again.
+           @return A tuple holding the config dict."""
+        return self._configDictList
+
+    def getConfigPath(self):
+        """@return The absolute path of the config file."""
+        return self._configFile
+
+class DeviceConfigFolder(object):
+    """@brief Responsible for loading the configuration of many devices from the files
+              in a folder so that one ydev instance can respond for them all. Each
+              *.cfg file holds the JSON config of one device with the same keys as
+              the ydev config file. A device on another machine (E.G a PLC or camera)
+              must also have an IP_ADDRESS key (an address or host name). A device
+              without an IP_ADDRESS is this machine."""
+
+    CONFIG_FILE_SUFFIX                  = ".cfg"
+    IP_ADDRESS                          = "IP_ADDRESS"
+    LOOPBACK_PREFIX                     = "127."
+
+    @staticmethod
+    def GetLocalAddressSet():
+        """@return A set of the addresses of the local network interfaces."""
+        localAddressSet = set()
+        for ipList in NetIF().getIFDict(readNow=True).values():
+            for elem in ipList:
+                localAddressSet.add( elem.split("/")[0] )
+        return localAddressSet
+
+    def __init__(self, uio, folder):
+        """@brief Constructor.
+           @param uio UIO instance.
+           @param folder The folder holding the device config files."""
+        self._uio     = uio
+        self._folder  = os.path.abspath(folder)
+        if not os.path.isdir(self._folder):
+            raise Exception("%s folder not found." % (self._folder) )
+
+        # The modified time and config dict of each config file keyed by filename.
+        self._fileDict = {}
+        self._configDictList = ()
+        self.reloadIfModified()
+        self._uio.info("Loaded %d device config/s from %s" % (len(self._configDictList), self._folder) )
+
+    def _getModifiedTimeDict(self):
+        """@return A dict of the modified times of the config files keyed by filename."""
+        mTimeDict = {}
+        for dirEntry in os.scandir(self._folder):
+            if dirEntry.name.endswith(DeviceConfigFolder.CONFIG_FILE_SUFFIX) and dirEntry.is_file():
+                try:
+                    mTimeDict[dirEntry.name] = dirEntry.stat().st_mtime
 
-        return self._configManager.getAttr(key)
+                except OSError:
+                    pass
+
+        return mTimeDict
 
-    def getConfigDict(self):
-        return self._configManager._configDict
+    def _loadConfigDict(self, fileName):
+        """@brief Load a device config file.
+           @param fileName The name of the file in the config folder.
+           @return The config dict or None if the file is not valid."""
+        configFile = os.path.join(self._folder, fileName)
+        try:
+            with open(configFile, "r") as fd:
+                loadedDict = DeviceConfig.GetValidConfigDict( json.load(fd) )
+
+            configDict = dict(DeviceConfig.DEFAULT_CONFIG)
+            configDict.update(loadedDict)
+            if DeviceConfigFolder.IP_ADDRESS in configDict:
+                configDict[DeviceConfigFolder.IP_ADDRESS] = socket.gethostbyname( configDict[DeviceConfigFolder.IP_ADDRESS] )
+            return configDict
+
+        except (OSError, ValueError, socket.error) as ex:
+            self._uio.warn("Ignored invalid config in %s: %s" % (configFile, str(ex)) )
+            return None
+
+    def reloadIfModified(self):
+        """@brief Load the config files that have been added or modified since they were
+                  last loaded. The tuple returned by getConfigDictList() is replaced
+                  with a new tuple if anything changed. If a modified config file is not
+                  valid the previous config from the file is kept.
+           @return True if the config was loaded."""
+        mTimeDict = self._getModifiedTimeDict()
+        if mTimeDict == dict( [(fileName, fileDetails[0]) for fileName, fileDetails in self._fileDict.items()] ):
+            return False
+
+        fileDict = {}
+        configDictList = []
+        # The config file that uses each address keyed by address (None for this machine).
+        usedByDict = {}
+        localAddressSet = DeviceConfigFolder.GetLocalAddressSet()
+        for fileName in sorted(mTimeDict.keys()):
+            fileDetails = self._fileDict.get(fileName)
+            if not fileDetails or fileDetails[0] != mTimeDict[fileName]:
+                configDict = self._loadConfigDict(fileName)
+                if configDict is None and fileDetails:
+                    configDict = fileDetails[1]
+                fileDetails = (mTimeDict[fileName], configDict)
+            fileDict[fileName] = fileDetails
+
+            configDict = fileDetails[1]
+            if configDict is None:
+                continue
+
+            # yview identifies devices by address so only one device may use each address.
+            # A device without an address responds with the address of this machine.
+            ipAddress = configDict.get(DeviceConfigFolder.IP_ADDRESS)
+            if ipAddress in localAddressSet or (ipAddress and ipAddress.startswith(DeviceConfigFolder.LOOPBACK_PREFIX)):
+                ipAddress = None
+            if ipAddress in usedByDict:
+                self._uio.warn("Ignored %s as %s is already used by %s." % (fileName, ipAddress or "this machine", usedByDict[ipAddress]) )
+                continue
+            usedByDict[ipAddress] = fileName
+
+            configDictList.append(configDict)
+
+        self._fileDict = fileDict
+        self._configDictList = tuple(configDictList)
+        return True
+
+    def getConfigDictList(self):
+        """@brief Get the config of all the devices. The tuple returned is not changed.
+                  A new tuple is returned after the config has been loaded again.
+           @return A tuple of config dicts."""
+        return self._configDictList
+
+    def getConfigPath(self):
+        """@return The absolute path of the config folder."""
+        return self._folder
 
 #Very simple cmd line template using optparse
 def main():
@@ -272,6 +634,8 @@ def main():
     opts.add_option("--check_auto_start",   help="Check the status of an auto started ydev instance.", action="store_true", default=False)
     opts.add_option("--user",               help="Set the user for auto start.")
     opts.add_option("--enable_syslog",      help="Enable syslog on this instance of ydev. By default syslog is disabled.", action="store_true", default=False)
+    opts.add_option("--config_dir",         help="Respond for all the devices configured in the *.cfg files in this folder rather than this machine only. Each file holds the JSON config of one device. A device on another machine must have an IP_ADDRESS.")
+    opts.add_option("--pretty",             help="Send indented JSON AYT responses. By default compact JSON is sent.", action="store_true", default=False)
 
     try:
         (options, args) = opts.parse_args()
@@ -280,7 +644,10 @@ def main():
         if options.enable_syslog:
             uio.enableSyslog(True)
 
-        deviceConfig = DeviceConfig(uio, "ydev.cfg")
+        if options.config_dir and not options.config:
+            deviceConfig = DeviceConfigFolder(uio, options.config_dir)
+        else:
+            deviceConfig = DeviceConfig(uio, "ydev.cfg")
         aytListener = AYTListener(uio, options, deviceConfig)
 
         if options.config:
@@ -2,7 +2,7 @@
 set -e
 
 #Check the python files and exit on error.
-python3.9 -m pyflakes ydev2db.py dba.py
+python3.9 -m pyflakes ydev2db.py dba.py dev_state_codec.py
 
 sudo python3.9 -m pipenv2deb pipenv2deb
 
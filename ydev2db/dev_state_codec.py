@@ -0,0 +1 @@
+../icons_gw/icons_gw/dev_state_codec.py
\ No newline at end of file
@@ -3,8 +3,6 @@
 #TODO
 # Encrypt data on disk
 
-import  json
-
 from time import sleep, time
 
 from   optparse import OptionParser
@@ -17,6 +15,8 @@ from p3lib.helper import logTraceBack, GetFreeTCPPort, getHomePath, printDict
 from p3lib.ssh import SSH, SSHTunnelManager
 from p3lib.database_if import DBConfig, DatabaseIF
 
+from dev_state_codec import DevStateCodec
+
 class YDev2DBClientConfig(ConfigManager):
     """@brief Responsible for managing the configuration used by the ydev application."""
 
@@ -205,9 +205,16 @@ class YDev2DBClient(object):
 
     def _messageReceived(self, client, userdata, msg):
         """@brief Called when a message is received from the ICONS MQTT server."""
+        # A zero length message clears the state retained for a device that has gone offline.
+        if not msg.payload:
+            return
         try:
-            rxStr = msg.payload.decode()
-            rxDict = json.loads(rxStr)
+            # Device state may be JSON or in the compact encoding.
+            rxDict = DevStateCodec.Decode(msg.payload)
+            # The icons_gw publishes this when a device stops responding. It holds no device data.
+            if rxDict.get("OFFLINE"):
+                self._uio.info("{} is offline.".format(rxDict.get("UNIT_NAME")))
+                return
             if self._options.show_all:
                 self._showDevData(rxDict)
             else: